@@ -0,0 +1,137 @@
+'''
+Fires parallel POSTs at booking.create from several processes and reports
+throughput, conflicts and errors.
+
+    python -m benchmarks.booking_concurrency --workers 8 --requests 50
+
+Two scenarios run against a fresh temporary database:
+
+same-car       every request books the same car for the same dates, so
+               exactly one must succeed and all others must get a 409
+different-cars every request books its own car, so all must succeed
+'''
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from werkzeug.security import generate_password_hash
+
+from car_app import create_app
+from car_app.db import get_db, init_db
+
+START_DATE = '2030-06-01'
+END_DATE = '2030-06-07'
+
+
+def make_app(database, image_store):
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'DATABASE': database,
+        'IMAGE_STORE': image_store,
+    })
+
+
+def seed(app, cars, customers):
+    with app.app_context():
+        init_db()
+        db = get_db()
+        password = generate_password_hash('benchmark')
+        db.executemany(
+            'INSERT INTO customer (name, last_name, phone_number, email, password)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            [('Bench', str(i), '000', f'bench{i}@example.com', password)
+             for i in range(customers)]
+        )
+        db.executemany(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, image_hash, price)'
+            ' VALUES (?, ?, 1, 5, 4, ?, ?, ?)',
+            [(f'Car {i}', 'Bench', 'Automatic', '0' * 64, '100') for i in range(cars)]
+        )
+        db.commit()
+
+
+def worker(database, image_store, worker_id, car_ids, queue):
+    '''Books every car in car_ids as customer worker_id + 1'''
+    app = make_app(database, image_store)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['customer_id'] = worker_id + 1
+
+    counts = {'ok': 0, 'conflict': 0, 'busy': 0, 'error': 0}
+    for car_id in car_ids:
+        response = client.post(
+            f'/wheels_on_rent/booking/create/{car_id}',
+            data={'start_date': START_DATE, 'end_date': END_DATE},
+        )
+        if response.status_code == 302:
+            counts['ok'] += 1
+        elif response.status_code == 409:
+            counts['conflict'] += 1
+        elif response.status_code == 503:
+            counts['busy'] += 1
+        else:
+            counts['error'] += 1
+    queue.put(counts)
+
+
+def run_scenario(name, workers, requests, same_car):
+    directory = tempfile.mkdtemp(prefix='booking-bench-')
+    database = os.path.join(directory, 'bench.sqlite')
+    image_store = os.path.join(directory, 'images')
+    seed(make_app(database, image_store), cars=workers * requests, customers=workers)
+
+    queue = multiprocessing.Queue()
+    processes = []
+    for worker_id in range(workers):
+        if same_car:
+            car_ids = [1] * requests
+        else:
+            first = worker_id * requests + 1
+            car_ids = range(first, first + requests)
+        processes.append(multiprocessing.Process(
+            target=worker, args=(database, image_store, worker_id, list(car_ids), queue)))
+
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    totals = {'ok': 0, 'conflict': 0, 'busy': 0, 'error': 0}
+    for _ in processes:
+        for key, value in queue.get().items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    app = make_app(database, image_store)
+    with app.app_context():
+        booked = get_db().execute('SELECT COUNT(*) FROM booking').fetchone()[0]
+
+    total = workers * requests
+    failed = totals['busy'] + totals['error']
+    print(f'{name:15} {total:6d} requests in {elapsed:6.2f}s'
+          f'  {total / elapsed:8.1f} req/s'
+          f'  ok={totals["ok"]} conflict={totals["conflict"]}'
+          f' busy={totals["busy"]} error={totals["error"]}'
+          f'  error rate={failed / total:.2%}  rows={booked}')
+
+    expected = 1 if same_car else total
+    if booked != expected:
+        print(f'  !! expected {expected} booking rows, found {booked}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8, help='parallel processes')
+    parser.add_argument('--requests', type=int, default=50, help='bookings per process')
+    args = parser.parse_args()
+
+    run_scenario('same-car', args.workers, args.requests, same_car=True)
+    run_scenario('different-cars', args.workers, args.requests, same_car=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+'''
+Seeds a database with a synthetic fleet, customers and bookings.
+
+    python -m benchmarks.datagen bench.sqlite --cars 10000 --customers 100000 --bookings 1000000
+    python -m benchmarks.datagen postgresql://localhost/bench --images bench-images
+
+The same --seed always gives the same rows. Booking dates are laid out
+around --today (the real today by default) so a run sees the same mix of
+past, current and future bookings whenever it happens: each car gets its
+share of bookings back to back, a few days each with gaps in between,
+mostly in the past and some still to come.
+
+Rows go in with the schema's tables only; the stats tables and the search
+index are built once at the end, the way `flask rebuild-stats` and
+`flask rebuild-search` would, instead of firing a trigger per row, and
+the change log starts out empty. The occupancy bitmaps are filled at the
+end as well, as by `flask rebuild-occupancy`. A PostgreSQL database gets
+its whole schema up front with the triggers switched off until the rows
+are in.
+'''
+import argparse
+import io
+import os
+import random
+import time
+from datetime import date, timedelta
+
+from PIL import Image
+from flask import current_app
+
+from car_app import create_app
+from car_app.db import get_db, get_dialect, immediate_transaction
+from car_app.images import make_variants, store_original, store_variants
+from car_app.invalidation import install_change_log
+from car_app.occupancy import fill_occupancy
+from car_app.passwords import hash_password
+from car_app.pricing import install_pricing
+from car_app.search import install_search
+from car_app.stats import install_stats, rebuild_stats
+
+MAKES = {
+    'Toyota': ['Corolla', 'Camry', 'Yaris', 'Vitz', 'Hilux', 'RAV4'],
+    'Hyundai': ['Elantra', 'Tucson', 'Accent', 'Santa Fe'],
+    'Ford': ['Focus', 'Fiesta', 'Ranger', 'F150'],
+    'Mercedes': ['C200', 'E300', 'Sprinter'],
+    'Volkswagen': ['Golf', 'Polo', 'Passat', 'Tiguan'],
+    'Suzuki': ['Swift', 'Dzire', 'Alto'],
+    'Nissan': ['Sunny', 'Patrol', 'Navara'],
+    'Kia': ['Rio', 'Picanto', 'Sportage'],
+}
+
+PASSWORD = 'benchmark'
+ADMIN_EMAIL = 'admin@example.com'
+
+# Share of each car's bookings that lie after today
+FUTURE_SHARE = 0.1
+
+
+def customer_email(number):
+    '''Email of generated customer number (1 based)'''
+    return f'customer{number}@example.com'
+
+
+def is_url(database):
+    return '://' in database
+
+
+def make_app(database, images=None, **config):
+    '''App on database, an SQLite file or a PostgreSQL URL. The image store
+    is images, by default next to the SQLite file.'''
+    if is_url(database):
+        config['DATABASE_URL'] = database
+    else:
+        config['DATABASE'] = database
+        images = images or os.path.join(os.path.dirname(os.path.abspath(database)), 'images')
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'IMAGE_STORE': images,
+        **config,
+    })
+
+
+def sample_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (1200, 800), (40, 90, 160)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def car_rows(rng, cars, image):
+    makes = list(MAKES)
+    for _ in range(cars):
+        make = rng.choice(makes)
+        yield (make, f'{rng.choice(MAKES[make])} {rng.randint(2005, 2024)}', '1',
+               rng.choice((2, 4, 5, 7, 8)), rng.choice((2, 4)),
+               rng.choice(('Automatic', 'Manual')), f'{rng.uniform(300, 3000):.2f} Birr',
+               image['image_type'], image['image_hash'], image['image_updated'])
+
+
+def booking_rows(rng, cars, customers, bookings, today):
+    '''Bookings spread evenly over the cars, never overlapping on one car'''
+    per_car, extra = divmod(bookings, cars)
+    for car_id in range(1, cars + 1):
+        count = per_car + (car_id <= extra)
+        # Walk forward from far enough back that about FUTURE_SHARE of
+        # the car's bookings end up after today
+        day = today - timedelta(days=int(count * (1 - FUTURE_SHARE) * 5))
+        for _ in range(count):
+            day += timedelta(days=rng.randint(0, 3))
+            end = day + timedelta(days=rng.randint(0, 3))
+            yield (rng.randint(2, customers + 1), car_id, day.isoformat(), end.isoformat())
+            day = end + timedelta(days=1)
+
+
+def generate(app, cars, customers, bookings, seed=42, today=None):
+    '''Creates the schema in app's database and fills it. Customer 1 is an
+    admin, customers 2 and up are customer_email(1), customer_email(2)...
+    and everyone's password is PASSWORD.'''
+    rng = random.Random(seed)
+    today = today or date.today()
+    with app.app_context():
+        db = get_db()
+        postgresql = get_dialect() == 'postgresql'
+        with current_app.open_resource(
+                'schema_postgresql.sql' if postgresql else 'schema.sql') as f:
+            db.executescript(f.read().decode('utf8'))
+        if postgresql:
+            for table in ('car', 'customer', 'booking'):
+                db.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+
+        # Every car shares one photo, the store keeps a single copy
+        image_data = sample_image()
+        image = store_original(image_data)
+        variants = store_variants(make_variants(image_data))
+
+        db.executemany(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, price,'
+            ' image_type, image_hash, image_updated)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            car_rows(rng, cars, image)
+        )
+        db.executemany(
+            'INSERT INTO car_image (car_id, size, content_type, image_hash) VALUES (?, ?, ?, ?)',
+            ((car_id, *variant) for car_id in range(1, cars + 1) for variant in variants)
+        )
+
+        password = hash_password(PASSWORD)
+        db.execute(
+            'INSERT INTO customer (name, last_name, phone_number, email, password, role)'
+            " VALUES ('Admin', 'Bench', '0', ?, ?, 1)", (ADMIN_EMAIL, password))
+        db.executemany(
+            'INSERT INTO customer (name, last_name, phone_number, email, password)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (('Customer', str(number), f'09{rng.randrange(10 ** 8):08d}',
+              customer_email(number), password) for number in range(1, customers + 1))
+        )
+
+        db.executemany(
+            'INSERT INTO booking (customer_id, car_id, start_date, end_date) VALUES (?, ?, ?, ?)',
+            booking_rows(rng, cars, customers, bookings, today)
+        )
+        db.commit()
+
+        if postgresql:
+            for table in ('car', 'customer', 'booking'):
+                db.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER')
+            rebuild_stats()
+        else:
+            install_stats(db)
+            rebuild_stats()
+            install_search(db)
+            db.execute("INSERT INTO car_search (car_search) VALUES ('rebuild')")
+            install_change_log(db)
+            install_pricing(db)
+            db.commit()
+        immediate_transaction(fill_occupancy)
+        db.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database', help='SQLite file to create, must not exist yet,'
+                                         ' or a PostgreSQL URL whose tables are replaced')
+    parser.add_argument('--images', help='image store directory, required with a PostgreSQL URL')
+    parser.add_argument('--cars', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--bookings', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--today', type=date.fromisoformat,
+                        help='date the bookings are laid out around, YYYY-MM-DD')
+    args = parser.parse_args()
+
+    if is_url(args.database):
+        if not args.images:
+            parser.error('--images is required with a PostgreSQL URL')
+    elif os.path.exists(args.database):
+        parser.error(f'{args.database} already exists')
+    started = time.perf_counter()
+    generate(make_app(args.database, args.images), args.cars, args.customers, args.bookings,
+             seed=args.seed, today=args.today)
+    print(f'Seeded {args.cars} cars, {args.customers} customers and {args.bookings}'
+          f' bookings in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''
+Checks that worker processes never serve a customer or the catalog from
+their caches after another process changed it, and times the per-request
+check.
+
+    python -m benchmarks.invalidation --workers 4 --rounds 200
+
+Every process caches the same customers with a TTL far longer than the
+run, and the catalog grid in its LRU catalog cache. Then, with one
+process writing and every process reading back, as a new request, what
+it must now see:
+
+  rename    a customer renamed, --rounds times, the writer taking turns
+  catalog   a car renamed and repriced, its grid entry and quote
+  overflow  every customer renamed in one transaction, more changes than
+            CHANGE_LOG_MAX_READ, so every process clears its caches
+  trim      two customers renamed and the change log trimmed with
+            --keep 0 before the others read it, so they clear too
+
+Stale reads, and processes that did not clear their caches in the last
+two phases, are counted and make the script exit with status 1.
+Afterwards each process times sync() on requests that follow no write.
+'''
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from werkzeug.security import generate_password_hash
+
+from car_app import create_app, invalidation
+from car_app.cache import bump_catalog_version
+from car_app.customer import get_cached_customer
+from car_app.db import get_db, immediate_transaction, init_db
+from car_app.invalidation import sync, trim_change_log
+
+# Renaming every customer at once overflows the log read
+MAX_READ = 10
+
+
+def make_app(database):
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'DATABASE': database,
+        'METRICS_ENABLED': False,
+        'CUSTOMER_CACHE_TTL': 3600,
+        'CHANGE_LOG_MAX_READ': MAX_READ,
+    })
+
+
+def seed(app, customers, cars):
+    with app.app_context():
+        init_db()
+        db = get_db()
+        password = generate_password_hash('benchmark')
+        db.executemany(
+            'INSERT INTO customer (name, last_name, phone_number, email, password)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            [('Bench', str(i), '000', f'bench{i}@example.com', password)
+             for i in range(customers)]
+        )
+        db.executemany(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, image_hash, price)'
+            " VALUES (?, 'Bench', '1', 5, 4, 'Manual', '', '100')",
+            [(f'Car {i}',) for i in range(cars)]
+        )
+        db.commit()
+
+
+def read_names(app, customer_ids):
+    # A request context of its own, as every request has
+    with app.test_request_context():
+        return [get_cached_customer(customer_id)['name'] for customer_id in customer_ids]
+
+
+def rename_customers(app, names):
+    with app.test_request_context():
+        immediate_transaction(lambda db: db.executemany(
+            'UPDATE customer SET name = ? WHERE id = ?',
+            [(name, customer_id) for customer_id, name in names.items()]))
+
+
+def change_car(app, car_id, name, price):
+    # The write car.update makes
+    with app.test_request_context():
+        immediate_transaction(lambda db: db.execute(
+            'UPDATE car SET name = ?, price = ?, change_seq = ? WHERE id = ?',
+            (name, str(price), bump_catalog_version(db), car_id)))
+
+
+def catalog_shows(client, name, price):
+    page = client.get('/wheels_on_rent/car/guest_mode').get_data(as_text=True)
+    return f'>{name}</h5>' in page and f'{price:.2f}' in page
+
+
+def worker(database, connection, customers, repeat):
+    app = make_app(database)
+    client = app.test_client()
+    cleared = [0]
+    invalidation.subscribe('customer', lambda row_ids: cleared.__setitem__(
+        0, cleared[0] + (row_ids is None)))
+    read_names(app, range(1, customers + 1))
+    client.get('/wheels_on_rent/car/guest_mode')
+    connection.send('ready')
+
+    stale = 0
+    while True:
+        command = connection.recv()
+        if command is None:
+            break
+        action, argument = command
+        if action == 'rename':
+            rename_customers(app, argument)
+        elif action == 'trim':
+            rename_customers(app, argument)
+            with app.test_request_context():
+                immediate_transaction(lambda db: trim_change_log(db, keep=0))
+        elif action == 'car':
+            change_car(app, *argument)
+        elif action == 'read':
+            ids = sorted(argument)
+            stale += sum(name != argument[customer_id] for customer_id, name
+                         in zip(ids, read_names(app, ids)))
+        elif action == 'catalog':
+            stale += not catalog_shows(client, *argument[1:])
+        connection.send(cleared[0])
+
+    # Requests that follow no write
+    spent = 0.0
+    for _ in range(repeat):
+        with app.test_request_context():
+            get_db()
+            started = time.perf_counter()
+            sync()
+            spent += time.perf_counter() - started
+    connection.send((stale, spent / repeat))
+
+
+def everyone(connections, command):
+    '''Sends command to every process, returns how often each has cleared
+    its caches'''
+    for connection in connections:
+        connection.send(command)
+    return [connection.recv() for connection in connections]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help='worker processes')
+    parser.add_argument('--rounds', type=int, default=200, help='renames')
+    parser.add_argument('--customers', type=int, default=50, help='customers cached')
+    parser.add_argument('--cars', type=int, default=20, help='cars on the catalog page')
+    parser.add_argument('--repeat', type=int, default=10000,
+                        help='requests timed after the rounds, per process')
+    args = parser.parse_args()
+    if args.customers <= MAX_READ:
+        parser.error(f'--customers must be more than {MAX_READ}')
+
+    directory = tempfile.mkdtemp(prefix='invalidation-bench-')
+    database = os.path.join(directory, 'bench.sqlite')
+    seed(make_app(database), args.customers, args.cars)
+
+    connections, processes = [], []
+    for _ in range(args.workers):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=worker, args=(database, child, args.customers, args.repeat))
+        process.start()
+        connections.append(parent)
+        processes.append(process)
+    for connection in connections:
+        connection.recv()
+
+    def write(round_number, command):
+        writer = connections[round_number % len(connections)]
+        writer.send(command)
+        writer.recv()
+
+    rng = random.Random(42)
+    names = {customer_id: 'Bench' for customer_id in range(1, args.customers + 1)}
+    started = time.perf_counter()
+    for round_number in range(args.rounds):
+        customer_id = rng.randint(1, args.customers)
+        names[customer_id] = f'Renamed {round_number}'
+        write(round_number, ('rename', {customer_id: names[customer_id]}))
+        everyone(connections, ('read', {customer_id: names[customer_id]}))
+    elapsed = time.perf_counter() - started
+
+    for round_number in range(max(args.rounds // 10, 1)):
+        car = (rng.randint(1, args.cars), f'Changed {round_number}', 1000 + round_number)
+        write(round_number, ('car', car))
+        everyone(connections, ('catalog', car))
+
+    not_cleared = 0
+    before = everyone(connections, ('read', {}))
+    names.update({customer_id: f'Overflow {customer_id}' for customer_id in names})
+    write(0, ('rename', names))
+    after = everyone(connections, ('read', names))
+    not_cleared += sum(a == b for a, b in zip(before, after))
+
+    before = after
+    names.update({1: 'Trimmed 1', 2: 'Trimmed 2'})
+    write(1, ('trim', {1: names[1], 2: names[2]}))
+    after = everyone(connections, ('read', names))
+    not_cleared += sum(a == b for a, b in zip(before, after))
+
+    stale, sync_seconds = 0, []
+    for connection in connections:
+        connection.send(None)
+    for connection in connections:
+        worker_stale, seconds = connection.recv()
+        stale += worker_stale
+        sync_seconds.append(seconds)
+    for process in processes:
+        process.join()
+
+    reads = args.rounds * args.workers
+    print(f'{args.rounds} renames, {reads} reads by {args.workers} processes'
+          f' in {elapsed:.2f}s, stale reads: {stale}')
+    print(f'processes that kept their caches after an overflow or trim: {not_cleared}')
+    print(f'sync() with nothing changed: {1e6 * sum(sync_seconds) / len(sync_seconds):.1f} us'
+          ' per request')
+    sys.exit(1 if stale or not_cleared else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Logs customers in from several processes and reports logins per second,
+overall and per process (each process keeps about one core busy).
+
+    python -m benchmarks.login_throughput --workers 4 --logins 20
+    python -m benchmarks.login_throughput --method pbkdf2:sha256:600000
+
+Every method given runs against a fresh temporary database whose
+passwords were hashed with that method, so no login needs a rehash.
+'''
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from car_app import create_app
+from car_app.db import get_db, init_db
+from car_app.passwords import hash_password
+
+PASSWORD = 'benchmark'
+
+
+def make_app(database, method):
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'DATABASE': database,
+        'PASSWORD_METHOD': method,
+    })
+
+
+def seed(app, customers):
+    with app.app_context():
+        init_db()
+        db = get_db()
+        password = hash_password(PASSWORD)
+        db.executemany(
+            'INSERT INTO customer (name, last_name, phone_number, email, password)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            [('Bench', str(i), '000', f'bench{i}@example.com', password)
+             for i in range(customers)]
+        )
+        db.commit()
+
+
+def worker(database, method, worker_id, logins, queue):
+    client = make_app(database, method).test_client()
+    failed = 0
+    started = time.perf_counter()
+    for _ in range(logins):
+        response = client.post('/wheels_on_rent/customer/login', data={
+            'email': f'bench{worker_id}@example.com', 'password': PASSWORD})
+        if response.status_code != 302:
+            failed += 1
+    queue.put((failed, time.perf_counter() - started))
+
+
+def run_method(method, workers, logins):
+    directory = tempfile.mkdtemp(prefix='login-bench-')
+    database = os.path.join(directory, 'bench.sqlite')
+    seed(make_app(database, method), customers=workers)
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+        target=worker, args=(database, method, worker_id, logins, queue))
+        for worker_id in range(workers)]
+
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    failed = sum(result[0] for result in results)
+    # Timed inside each process, so start up costs are left out
+    busy = sum(result[1] for result in results) / workers
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    total = workers * logins
+    print(f'{method:24} {total:5d} logins in {elapsed:6.2f}s'
+          f'  {total / elapsed:8.1f} logins/s'
+          f'  {logins / busy:7.1f} logins/s per core'
+          f'  failed={failed}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='parallel processes')
+    parser.add_argument('--logins', type=int, default=20, help='logins per process')
+    parser.add_argument('--method', action='append',
+                        help='hash method to measure, may be repeated')
+    args = parser.parse_args()
+
+    for method in args.method or ['scrypt', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:100000']:
+        run_method(method, args.workers, args.logins)
+
+
+if __name__ == '__main__':
+    main()
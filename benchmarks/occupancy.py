@@ -0,0 +1,143 @@
+'''
+Times the occupancy calendar and utilization report on a synthetic fleet.
+
+    python -m benchmarks.occupancy --cars 5000 --repeat 20
+
+Builds a temporary database with --cars cars, each booked back to back
+for a few days at a time with gaps in between over --year, and a share
+of the cars (--idle) never booked. Reports, in milliseconds:
+
+  fill     building every bitmap from the bookings, as rebuild-occupancy
+  report   utilization_report for the year, what the admin page reads
+  csv      the same for every car, what the CSV download reads
+  mark     setting and clearing one booking's days in a transaction
+
+The booked days per car are then checked against a count taken from the
+booking table, and any difference makes the script exit with status 1.
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from car_app import create_app
+from car_app.db import get_db, immediate_transaction, init_db
+from car_app.occupancy import fill_occupancy, mark, utilization_report
+
+
+def seed(app, cars, year, idle):
+    rng = random.Random(42)
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.executemany(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, image_hash, price)'
+            " VALUES (?, 'Bench', '1', 5, 4, 'Manual', '', '100')",
+            ((f'Car {number}',) for number in range(cars))
+        )
+        db.execute(
+            "INSERT INTO customer (name, last_name, phone_number, email, password)"
+            " VALUES ('Bench', 'Mark', '0', 'bench@example.com', '')"
+        )
+        rows = []
+        for car_id in range(1, cars + 1):
+            if rng.random() < idle:
+                continue
+            day = date(year, 1, 1) + timedelta(days=rng.randint(0, 10))
+            while day.year == year:
+                end = day + timedelta(days=rng.randint(0, 6))
+                rows.append((car_id, day.isoformat(), end.isoformat()))
+                day = end + timedelta(days=rng.randint(1, 10))
+        db.executemany(
+            'INSERT INTO booking (customer_id, car_id, start_date, end_date) VALUES (1, ?, ?, ?)',
+            rows
+        )
+        db.commit()
+        return len(rows)
+
+
+def timed(function, repeat):
+    '''Milliseconds each of repeat calls of function() took'''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+    print(f'{name:8} mean {statistics.mean(times):8.3f}  median {statistics.median(times):8.3f}'
+          f'  p95 {p95:8.3f}')
+
+
+def booked_days(db, year):
+    '''{car id: days booked in year}, counted from the booking table'''
+    first, last = date(year, 1, 1).isoformat(), date(year, 12, 31).isoformat()
+    return {row[0]: row[1] for row in db.execute(
+        'SELECT car_id, SUM(julianday(MIN(end_date, ?)) - julianday(MAX(start_date, ?)) + 1)'
+        ' FROM booking WHERE end_date >= ? AND start_date <= ? GROUP BY car_id',
+        (last, first, first, last))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cars', type=int, default=5000)
+    parser.add_argument('--year', type=int, default=2030)
+    parser.add_argument('--idle', type=float, default=0.05, help='share of cars never booked')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='occupancy-bench-')
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': os.path.join(directory, 'bench.sqlite'),
+        'METRICS_ENABLED': False,
+    })
+    bookings = seed(app, args.cars, args.year, args.idle)
+    print(f'{args.cars} cars, {bookings} bookings in {args.year}')
+
+    with app.app_context():
+        db = get_db()
+        report('fill', timed(lambda: immediate_transaction(fill_occupancy), 1))
+        limit = app.config['PAGE_SIZE']
+        report('report', timed(lambda: utilization_report(db, args.year, limit=limit),
+                               args.repeat))
+        report('csv', timed(lambda: utilization_report(db, args.year), args.repeat))
+
+        rng = random.Random(7)
+
+        def book_and_cancel():
+            car_id = rng.randint(1, args.cars)
+            start = date(args.year, 1, 1) + timedelta(days=rng.randint(0, 358))
+            end = start + timedelta(days=rng.randint(0, 6))
+
+            def work(db):
+                mark(db, car_id, start, end)
+                mark(db, car_id, start, end, booked=False)
+
+            immediate_transaction(work)
+
+        report('mark', timed(book_and_cancel, args.repeat * 10))
+        # Cancelling cleared days that were booked before, put them back
+        immediate_transaction(fill_occupancy)
+
+        expected = booked_days(db, args.year)
+        result = utilization_report(db, args.year)
+        wrong = sum(1 for car in result['cars']
+                    if car['booked_days'] != expected.get(car['id'], 0))
+
+    print(f"utilization {result['utilization']:.1%}, {result['idle_cars']} idle cars,"
+          f" {wrong} cars whose booked days differ from the booking table")
+    sys.exit(1 if wrong else 0)
+
+
+if __name__ == '__main__':
+    main()
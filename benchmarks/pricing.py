@@ -0,0 +1,100 @@
+'''
+Times price quotes for the whole fleet.
+
+    python -m benchmarks.pricing --cars 50000 --repeat 200
+
+Builds a temporary database with --cars listed cars, the way
+benchmarks.search does, and pricing rules with a season running over new
+year, dearer weekends and two length discounts. Reports, in milliseconds:
+
+  load     reading the fleet's daily rates, once per pricing version
+  quote    quoting every listed car for a range not quoted before
+  cached   a range quoted before, served from the quote cache
+  grid     picking the quotes of one catalog page of cars
+
+Each range is random, from one day to four weeks long.
+'''
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+
+from car_app import create_app
+from car_app.db import get_db
+from car_app.pricing import fleet_quotes, fleet_rates, quote_cars
+
+from benchmarks.search import START, seed
+
+RULES = {
+    'PRICING_WEEKEND_MULTIPLIER': 1.2,
+    'PRICING_SEASONS': (('06-15', '08-31', 1.3), ('12-15', '01-05', 1.5)),
+    'PRICING_LENGTH_DISCOUNTS': ((7, 0.1), (28, 0.25)),
+}
+
+
+def timed(function, repeat):
+    '''Milliseconds each of repeat calls of function() took'''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+    print(f'{name:8} mean {statistics.mean(times):8.3f}  median {statistics.median(times):8.3f}'
+          f'  p95 {p95:8.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cars', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--page', type=int, default=100, help='cars on a catalog page')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pricing-bench-')
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': os.path.join(directory, 'bench.sqlite'),
+        'METRICS_ENABLED': False,
+        'PRICING_CACHE_SIZE': args.repeat,
+        **RULES,
+    })
+    seed(app, args.cars)
+
+    rng = random.Random(42)
+    ranges = []
+    for _ in range(args.repeat):
+        start = START + timedelta(days=rng.randint(0, 365))
+        ranges.append((start, start + timedelta(days=rng.randint(0, 27))))
+
+    with app.app_context():
+        db = get_db()
+
+        def load():
+            app.extensions.pop('pricing_fleet', None)
+            fleet_rates(db)
+
+        report('load', timed(load, max(1, args.repeat // 10)))
+
+        pending = iter(ranges)
+        report('quote', timed(lambda: fleet_quotes(db, *next(pending)), len(ranges)))
+
+        pending = iter(ranges)
+        report('cached', timed(lambda: fleet_quotes(db, *next(pending)), len(ranges)))
+
+        page = rng.sample(range(1, args.cars + 1), min(args.page, args.cars))
+        pending = iter(ranges)
+        report('grid', timed(lambda: quote_cars(db, page, *next(pending)), len(ranges)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+'''
+Times the hot endpoints through the Flask test client and reports p50,
+p95 and p99 latency and SQL statements per request.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --database bench.sqlite --compare results.json
+    python -m benchmarks.run --database postgresql://localhost/bench --images bench-images
+
+Without --database a throwaway database is generated first (see
+benchmarks.datagen for the scale options); with it, an existing file
+seeded by `python -m benchmarks.datagen` is reused, which saves the
+seeding time between runs. booking.create adds bookings to it. A
+PostgreSQL URL runs the same scenarios against that server: a throwaway
+one is fine, the database is seeded when it has no car table yet.
+
+--compare reads the JSON of an earlier run and flags every endpoint whose
+p95 grew by more than --threshold, or that now runs more SQL statements
+per request, and exits with status 1 when there is one.
+'''
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from car_app.db import get_db, get_dialect
+from car_app.metrics import Registry, get_registry
+
+from benchmarks.datagen import (
+    ADMIN_EMAIL, PASSWORD, customer_email, generate, is_url, make_app)
+
+
+def scenarios(cars, booking_start):
+    '''(name, endpoint, client, method, request kwargs for iteration i,
+    expected status). booking.create books from booking_start on.'''
+    today = date.today()
+
+    def booking(i):
+        # A new car, or the next free week of one, on every call
+        start = booking_start + timedelta(days=7 * (i // cars))
+        return {'path': f'/wheels_on_rent/booking/create/{i % cars + 1}',
+                'data': {'start_date': start.isoformat(),
+                         'end_date': (start + timedelta(days=2)).isoformat()}}
+
+    return [
+        ('guest_mode', 'car.guest_mode', 'guest', 'GET',
+         lambda i: {'path': '/wheels_on_rent/car/guest_mode'}, 200),
+        ('available', 'car.available', 'customer', 'GET',
+         lambda i: {'path': '/wheels_on_rent/car/available',
+                    'query_string': {'start_date': today.isoformat(),
+                                     'end_date': (today + timedelta(days=i % 7)).isoformat()}},
+         200),
+        ('my_bookings', 'booking.my_bookings', 'customer', 'GET',
+         lambda i: {'path': '/wheels_on_rent/booking/my_bookings'}, 200),
+        ('booking.create', 'booking.create', 'customer', 'POST', booking, 302),
+        ('admin_dashboard', 'customer.admin_dashboard', 'admin', 'GET',
+         lambda i: {'path': '/wheels_on_rent/customer/admin_dashboard'}, 200),
+        ('uploaded_image', 'uploaded_image', 'guest', 'GET',
+         lambda i: {'path': f'/uploads/{i % cars + 1}/card'}, 200),
+        ('login', 'customer.login', 'guest', 'POST',
+         lambda i: {'path': '/wheels_on_rent/customer/login',
+                    'data': {'email': customer_email(i % 100 + 1), 'password': PASSWORD}},
+         302),
+    ]
+
+
+def percentile(timings, share):
+    '''Nearest rank percentile of sorted timings'''
+    return timings[min(len(timings) - 1, max(0, round(share * len(timings)) - 1))]
+
+
+def sql_totals(endpoint):
+    '''(requests, statements) the metrics registry has seen for endpoint'''
+    key = Registry.key('car_app_request_sql_queries', {'endpoint': endpoint})
+    histogram = get_registry().snapshot()['histograms'].get(key)
+    return (histogram['count'], histogram['sum']) if histogram else (0, 0)
+
+
+def log_in(client, email):
+    response = client.post('/wheels_on_rent/customer/login',
+                           data={'email': email, 'password': PASSWORD})
+    if response.status_code != 302:
+        sys.exit(f'Could not log in as {email}')
+
+
+def run_scenario(client, endpoint, method, make_request, expected, requests, warmup):
+    for i in range(warmup):
+        client.open(method=method, **make_request(i)).close()
+
+    before = sql_totals(endpoint)
+    timings = []
+    failed = 0
+    for i in range(warmup, warmup + requests):
+        started = time.perf_counter()
+        response = client.open(method=method, **make_request(i))
+        response.get_data()
+        timings.append((time.perf_counter() - started) * 1000)
+        response.close()
+        if response.status_code != expected:
+            failed += 1
+    after = sql_totals(endpoint)
+
+    timings.sort()
+    counted = after[0] - before[0]
+    return {
+        'requests': requests,
+        'failed': failed,
+        'mean_ms': sum(timings) / len(timings),
+        'p50_ms': percentile(timings, 0.50),
+        'p95_ms': percentile(timings, 0.95),
+        'p99_ms': percentile(timings, 0.99),
+        'queries_per_request': (after[1] - before[1]) / counted if counted else None,
+    }
+
+
+def print_results(results):
+    print(f"{'endpoint':16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'failed':>7}")
+    for name, result in results['endpoints'].items():
+        queries = result['queries_per_request']
+        print(f"{name:16} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} {result['p99_ms']:9.2f}"
+              f" {'-' if queries is None else f'{queries:.1f}':>8} {result['failed']:7d}")
+
+
+def compare(results, baseline, threshold):
+    '''Prints the changes against baseline, returns the regressed endpoints'''
+    regressions = []
+    print(f"\n{'endpoint':16} {'p95 before':>11} {'p95 now':>9} {'change':>8}"
+          f" {'queries':>13}")
+    for name, result in results['endpoints'].items():
+        old = baseline['endpoints'].get(name)
+        if old is None:
+            print(f'{name:16} {"new":>11}')
+            continue
+        change = result['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0
+        queries_up = (result['queries_per_request'] or 0) > (old['queries_per_request'] or 0)
+        flag = ''
+        if change > threshold or queries_up:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:16} {old['p95_ms']:11.2f} {result['p95_ms']:9.2f} {change:+8.0%}"
+              f" {old['queries_per_request'] or 0:6.1f} -> {result['queries_per_request'] or 0:4.1f}"
+              f'{flag}')
+    return regressions
+
+
+def is_seeded(app):
+    with app.app_context():
+        db = get_db()
+        if get_dialect() == 'postgresql':
+            query = "SELECT 1 FROM pg_tables WHERE tablename = 'car'"
+        else:
+            query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'car'"
+        return db.execute(query).fetchone() is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help='database seeded by benchmarks.datagen to reuse,'
+                                           ' an SQLite file or a PostgreSQL URL')
+    parser.add_argument('--images', help='image store of a PostgreSQL database')
+    parser.add_argument('--cars', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--bookings', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests first')
+    parser.add_argument('--endpoint', action='append',
+                        help='only run this endpoint, may be repeated')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='p95 growth counted as a regression, 0.2 = 20%%')
+    parser.add_argument('--audit', action='store_true',
+                        help='fail on statements that scan or sort whole tables'
+                             ' (QUERY_PLAN_AUDIT, SQLite only)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-')
+    database = args.database
+    # The slow query log would drown the report, the timings cover it
+    app_config = {'METRICS_DIR': os.path.join(directory, 'metrics'), 'SLOW_QUERY_MS': None,
+                  'QUERY_PLAN_AUDIT': args.audit}
+    images = args.images
+    if database is None:
+        database = os.path.join(directory, 'bench.sqlite')
+    elif is_url(database) and images is None:
+        # Fine for a database seeded by this run, pass the --images of the
+        # datagen run that seeded it otherwise
+        images = os.path.join(directory, 'images')
+    app = make_app(database, images, **app_config)
+    if not is_seeded(app):
+        started = time.perf_counter()
+        generate(app, args.cars, args.customers, args.bookings, seed=args.seed)
+        print(f'Seeded {args.cars} cars, {args.customers} customers and {args.bookings}'
+              f' bookings in {time.perf_counter() - started:.1f}s')
+
+    with app.app_context():
+        db = get_db()
+        cars = db.execute('SELECT COUNT(*) FROM car').fetchone()[0]
+        # After every booking so far, earlier runs included
+        last_day = db.execute('SELECT MAX(end_date) FROM booking').fetchone()[0]
+        backend = (db.execute('SHOW server_version').fetchone()[0]
+                   if get_dialect() == 'postgresql' else sqlite3.sqlite_version)
+    if isinstance(last_day, str):
+        # SQLite gives the aggregate back as text
+        last_day = date.fromisoformat(last_day)
+    booking_start = max(last_day or date.today(), date.today()) + timedelta(days=1)
+    clients = {'guest': app.test_client(), 'customer': app.test_client(),
+               'admin': app.test_client()}
+    log_in(clients['customer'], customer_email(1))
+    log_in(clients['admin'], ADMIN_EMAIL)
+
+    results = {
+        'database': database if is_url(database) else os.path.abspath(database),
+        'date': date.today().isoformat(),
+        'python': platform.python_version(),
+        'backend': f"{'postgresql' if is_url(database) else 'sqlite'} {backend}",
+        'cars': cars,
+        'endpoints': {},
+    }
+    for name, endpoint, client, method, make_request, expected in scenarios(cars, booking_start):
+        if args.endpoint and name not in args.endpoint:
+            continue
+        results['endpoints'][name] = run_scenario(
+            clients[client], endpoint, method, make_request, expected,
+            args.requests, args.warmup)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nWrote {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(f"\nRegressed: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Times fleet searches on a synthetic fleet.
+
+    python -m benchmarks.search --cars 100000 --repeat 200
+
+Builds a temporary database with --cars listed cars (and a booking for
+about a third of them over the searched dates), then runs each query
+below --repeat times through search.search_cars and reports the mean,
+median and 95th percentile in milliseconds.
+'''
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date
+
+from car_app import create_app
+from car_app.db import get_db, init_db
+from car_app.search import search_cars
+
+from benchmarks.datagen import MAKES
+
+START = date(2030, 6, 1)
+END = date(2030, 6, 7)
+
+QUERIES = (
+    ('make', {'q': 'ford'}),
+    ('make, by price', {'q': 'ford', 'sort': 'price'}),
+    ('make and model', {'q': 'toyota corolla'}),
+    ('model and year', {'q': 'corolla 2019', 'sort': 'price'}),
+    ('gearbox and seats', {'gearbox': 'Manual', 'min_seats': 7}),
+    ('price range', {'min_price': 1000, 'max_price': 1100, 'sort': 'price'}),
+    ('cheapest', {'sort': 'price'}),
+    ('everything', {'q': 'kia rio', 'gearbox': 'Automatic', 'min_seats': 5,
+                    'doors': 4, 'max_price': 2000, 'sort': 'price'}),
+)
+
+COLUMNS = 'car.id, car.name, car.model, car.seat, car.door, car.gearbox, car.image_hash, car.price'
+
+
+def seed(app, cars):
+    rng = random.Random(42)
+    with app.app_context():
+        init_db()
+        db = get_db()
+        makes = list(MAKES)
+        rows = []
+        for i in range(cars):
+            make = rng.choice(makes)
+            rows.append((make, f'{rng.choice(MAKES[make])} {rng.randint(2005, 2024)}',
+                         rng.choice((2, 4, 5, 7, 8)), rng.choice((2, 4)),
+                         rng.choice(('Automatic', 'Manual')),
+                         f'{rng.uniform(300, 3000):.2f} Birr'))
+        db.executemany(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, image_hash, price)'
+            " VALUES (?, ?, '1', ?, ?, ?, '', ?)",
+            rows
+        )
+        db.execute(
+            "INSERT INTO customer (name, last_name, phone_number, email, password)"
+            " VALUES ('Bench', 'Mark', '0', 'bench@example.com', '')"
+        )
+        db.executemany(
+            'INSERT INTO booking (customer_id, car_id, start_date, end_date) VALUES (1, ?, ?, ?)',
+            [(car_id, START.isoformat(), END.isoformat())
+             for car_id in range(1, cars + 1) if rng.random() < 0.33]
+        )
+        db.commit()
+        db.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cars', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=50, help='results per search')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='search-bench-')
+    app = create_app({'TESTING': True, 'SECRET_KEY': 'benchmark',
+                      'DATABASE': os.path.join(directory, 'bench.sqlite')})
+    started = time.perf_counter()
+    seed(app, args.cars)
+    print(f'Seeded {args.cars} cars in {time.perf_counter() - started:.1f}s')
+
+    with app.app_context():
+        db = get_db()
+        for name, filters in QUERIES:
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                rows = search_cars(db, START, END, COLUMNS, filters, limit=args.limit)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            print(f'{name:20} {len(rows):4d} rows'
+                  f'  mean {statistics.mean(timings):7.3f} ms'
+                  f'  p50 {timings[len(timings) // 2]:7.3f} ms'
+                  f'  p95 {timings[int(len(timings) * 0.95)]:7.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+Fires parallel booking POSTs from the threads of one worker process and
+compares committed writes per second with each request committing on its
+own connection against the write coordinator's group commits.
+
+    python -m benchmarks.write_throughput --threads 16 --requests 50
+    python -m benchmarks.write_throughput --synchronous FULL --window 0.005
+
+Every request books its own car, so all of them must succeed. Each mode
+and synchronous setting runs against a fresh temporary database. With
+synchronous = FULL every commit is an fsync, which is where batching
+saves the most.
+'''
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from werkzeug.security import generate_password_hash
+
+from car_app import create_app
+from car_app.db import get_db, init_db
+
+START_DATE = '2030-06-01'
+END_DATE = '2030-06-07'
+
+
+def make_app(database, synchronous, coordinator, window, batch_size):
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'DATABASE': database,
+        'IMAGE_STORE': os.path.join(os.path.dirname(database), 'images'),
+        'METRICS_ENABLED': False,
+        'SQLITE_SYNCHRONOUS': synchronous,
+        'SQLITE_WRITE_COORDINATOR': coordinator,
+        'SQLITE_WRITE_BATCH_WINDOW': window,
+        'SQLITE_WRITE_BATCH_SIZE': batch_size,
+    })
+
+
+def seed(app, cars, customers):
+    with app.app_context():
+        init_db()
+        db = get_db()
+        password = generate_password_hash('benchmark')
+        db.executemany(
+            'INSERT INTO customer (name, last_name, phone_number, email, password)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            [('Bench', str(i), '000', f'bench{i}@example.com', password)
+             for i in range(customers)]
+        )
+        db.executemany(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, image_hash, price)'
+            ' VALUES (?, ?, 1, 5, 4, ?, ?, ?)',
+            [(f'Car {i}', 'Bench', 'Automatic', '0' * 64, '100') for i in range(cars)]
+        )
+        db.commit()
+
+
+def worker(app, thread_id, car_ids, counts, lock):
+    '''Books every car in car_ids as customer thread_id + 1'''
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['customer_id'] = thread_id + 1
+
+    for car_id in car_ids:
+        response = client.post(
+            f'/wheels_on_rent/booking/create/{car_id}',
+            data={'start_date': START_DATE, 'end_date': END_DATE},
+        )
+        key = {302: 'ok', 503: 'busy'}.get(response.status_code, 'error')
+        with lock:
+            counts[key] += 1
+
+
+def run_mode(name, args, synchronous, coordinator):
+    directory = tempfile.mkdtemp(prefix='write-bench-')
+    app = make_app(os.path.join(directory, 'bench.sqlite'), synchronous, coordinator,
+                   args.window, args.batch_size)
+    seed(app, cars=args.threads * args.requests, customers=args.threads)
+
+    counts = {'ok': 0, 'busy': 0, 'error': 0}
+    lock = threading.Lock()
+    threads = []
+    for thread_id in range(args.threads):
+        first = thread_id * args.requests + 1
+        threads.append(threading.Thread(
+            target=worker,
+            args=(app, thread_id, range(first, first + args.requests), counts, lock)))
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        booked = get_db().execute('SELECT COUNT(*) FROM booking').fetchone()[0]
+
+    total = args.threads * args.requests
+    line = (f'{name:12} {synchronous:7} {total:6d} requests in {elapsed:6.2f}s'
+            f'  {counts["ok"] / elapsed:8.1f} commits/s'
+            f'  ok={counts["ok"]} busy={counts["busy"]} error={counts["error"]}')
+    coordinator = app.extensions.get('write_coordinator')
+    if coordinator is not None:
+        stats = coordinator.stats()
+        line += (f'  batches={stats["batches"]}'
+                 f' mean batch={stats["units"] / max(stats["batches"], 1):.1f}')
+    print(line)
+    if booked != total:
+        print(f'  !! expected {total} booking rows, found {booked}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16, help='parallel request threads')
+    parser.add_argument('--requests', type=int, default=50, help='bookings per thread')
+    parser.add_argument('--synchronous', action='append', choices=('OFF', 'NORMAL', 'FULL'),
+                        help='SQLITE_SYNCHRONOUS to run with, may be repeated'
+                             ' (default NORMAL and FULL)')
+    parser.add_argument('--window', type=float, default=0.002,
+                        help='SQLITE_WRITE_BATCH_WINDOW in seconds')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='SQLITE_WRITE_BATCH_SIZE')
+    args = parser.parse_args()
+
+    for synchronous in args.synchronous or ['NORMAL', 'FULL']:
+        run_mode('direct', args, synchronous, coordinator=False)
+        run_mode('coordinated', args, synchronous, coordinator=True)
+
+
+if __name__ == '__main__':
+    main()
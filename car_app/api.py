@@ -0,0 +1,259 @@
+'''
+Module: api
+Versioned JSON API for the mobile client and partner aggregators.
+
+  GET /api/v1/cars              the whole fleet, or what changed since a cursor
+  GET /api/v1/cars/available    cars free for ?start_date= / ?end_date=,
+                                searched with ?q=, ?gearbox= and the like
+  GET /api/v1/cars/<id>         one car
+  GET /api/v1/bookings          the logged in customer's bookings
+
+?fields=name,price limits the response to those fields, and only their
+columns are read. Every response carries a strong ETag worked out from the
+catalog version before anything else is queried, so polling clients that
+send If-None-Match get a 304 for the price of one single-row read.
+'''
+import gzip
+import hashlib
+import json
+
+from flask import Blueprint, current_app, g, request
+from werkzeug.exceptions import HTTPException, abort
+
+from car_app.availability import InvalidRange, parse_range
+from car_app.cache import get_catalog_version
+from car_app.db import get_db
+from car_app.images import image_url
+from car_app.pagination import decode_cursor, encode_cursor, get_page_size
+from car_app.search import InvalidFilter, parse_filters, search_cars
+from car_app.shared_variables import get_today_date
+
+bp = Blueprint('api', __name__, url_prefix='/wheels_on_rent/api/v1')
+
+# API field name -> the column it is read from
+CAR_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'model': 'model',
+    'status': 'status',
+    'seat': 'seat',
+    'door': 'door',
+    'gearbox': 'gearbox',
+    'price': 'price',
+    'image': 'image_hash',
+    'change_seq': 'change_seq',
+}
+
+BOOKING_FIELDS = {
+    'id': 'b.id',
+    'car_id': 'b.car_id',
+    'car': 'ca.name',
+    'start_date': 'b.start_date',
+    'end_date': 'b.end_date',
+    'image': 'ca.image_hash',
+}
+
+
+def select_fields(available):
+    '''The fields asked for with ?fields=, all of them by default. The id is
+    always included. Aborts with 400 on an unknown field.'''
+    requested = request.args.get('fields')
+    if not requested:
+        return list(available)
+    fields = ['id']
+    for field in requested.split(','):
+        field = field.strip()
+        if field not in available:
+            abort(400, f'Unknown field {field!r}.')
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def select_columns(fields, available):
+    return ', '.join(f'{available[field]} AS {field}' for field in fields)
+
+
+def serialize(row, fields, car_id_field='id'):
+    item = {field: row[field] for field in fields}
+    if 'image' in item:
+        item['image'] = image_url(row[car_id_field], item['image'], 'card')
+    if 'status' in item:
+        item['status'] = int(item['status'])
+    return item
+
+
+def request_etag(version, *parts):
+    '''Strong ETag for the current request. Every write that changes a car
+    or booking bumps the catalog version, so the version plus whatever
+    selects the data is enough to tell whether a response changed.'''
+    key = json.dumps([version, request.path,
+                      sorted(request.args.items(multi=True)), *parts], default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def not_modified(etag):
+    '''304 response when the client already has this representation'''
+    # Gzipped bodies carry a variant of the tag, see json_response
+    for tag in (etag, etag + '-gzip'):
+        if request.if_none_match.contains(tag):
+            response = current_app.response_class(status=304)
+            response.set_etag(tag)
+            return response
+    return None
+
+
+def json_response(payload, etag, status=200):
+    '''Compact JSON, gzipped when it is large and the client accepts it'''
+    body = json.dumps(payload, separators=(',', ':'), default=str).encode()
+    response = current_app.response_class(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+
+    if (len(body) >= current_app.config['API_GZIP_MIN_SIZE']
+            and 'gzip' in request.accept_encodings):
+        response.set_data(gzip.compress(body, current_app.config['API_GZIP_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+        # Strong ETags must differ between byte-different representations
+        etag = etag + '-gzip'
+
+    if etag:
+        response.set_etag(etag)
+    return response
+
+
+# Clients may keep responses but must revalidate them with the ETag
+@bp.after_request
+def add_cache_headers(response):
+    if request.endpoint == 'api.bookings':
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@bp.errorhandler(HTTPException)
+def json_error(e):
+    return json_response({'error': e.description}, None, e.code)
+
+
+# The whole fleet, listed or not. With ?changed_since=<cursor> only the cars
+# created or edited after that cursor, plus the ids of deleted ones. Every
+# response ends with the cursor to send next time.
+@bp.route('/cars')
+def cars():
+    db = get_db()
+    # Anything written after this point is picked up by the next sync
+    version = get_catalog_version(db)
+    etag = request_etag(version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    fields = select_fields(CAR_FIELDS)
+    limit = get_page_size()
+    after = decode_cursor(request.args.get('changed_since')) or [-1, 0]
+    if len(after) != 2 or not all(isinstance(value, int) for value in after):
+        abort(400, 'Invalid changed_since cursor.')
+
+    rows = db.execute(
+        f"SELECT {select_columns(fields, CAR_FIELDS)}, change_seq AS _seq, id AS _id"
+        ' FROM car WHERE (change_seq, id) > (?, ?)'
+        ' ORDER BY change_seq, id LIMIT ?',
+        (after[0], after[1], limit + 1)
+    ).fetchall()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows and (more or rows[-1]['_seq'] >= version):
+        # Past the last car sent, which the next sync must not repeat
+        cursor = [rows[-1]['_seq'], rows[-1]['_id']]
+    else:
+        # Every change up to version was sent, the last ones may have been
+        # bookings; never behind the cursor the client sent
+        cursor = max([version, 0], list(after))
+    upper = cursor[0]
+
+    deleted = [row['car_id'] for row in db.execute(
+        'SELECT car_id FROM car_tombstone'
+        ' WHERE change_seq > ? AND change_seq <= ?'
+        ' ORDER BY change_seq',
+        (after[0], upper)
+    )] if after[0] >= 0 else []
+
+    return json_response({
+        'cars': [serialize(row, fields, '_id') for row in rows],
+        'deleted': deleted,
+        'changed_since': encode_cursor(cursor),
+        'more': more,
+    }, etag)
+
+
+# Listed cars with no booking overlapping the requested dates, narrowed
+# down by the same search filters as the catalog page (see search.py)
+@bp.route('/cars/available')
+def available():
+    try:
+        start_date, end_date = parse_range(
+            request.args.get('start_date'), request.args.get('end_date'))
+        filters = parse_filters(request.args)
+    except (InvalidRange, InvalidFilter) as e:
+        abort(400, str(e))
+
+    db = get_db()
+    etag = request_etag(get_catalog_version(db), start_date, end_date)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    fields = select_fields(CAR_FIELDS)
+    rows = search_cars(db, start_date, end_date, select_columns(fields, CAR_FIELDS), filters)
+    return json_response({
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'cars': [serialize(row, fields) for row in rows],
+    }, etag)
+
+
+@bp.route('/cars/<int:id>')
+def car(id):
+    db = get_db()
+    etag = request_etag(get_catalog_version(db))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    fields = select_fields(CAR_FIELDS)
+    row = db.execute(
+        f'SELECT {select_columns(fields, CAR_FIELDS)} FROM car WHERE id = ?', (id,)
+    ).fetchone()
+    if row is None:
+        abort(404, f"Car id {id} doesn't exist.")
+    return json_response(serialize(row, fields), etag)
+
+
+# Bookings of the logged in customer, ?upcoming=1 leaves out past ones
+@bp.route('/bookings')
+def bookings():
+    if g.customer is None:
+        abort(401, 'Log in first.')
+
+    db = get_db()
+    today = get_today_date()
+    etag = request_etag(get_catalog_version(db), g.customer['id'], today)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    fields = select_fields(BOOKING_FIELDS)
+    query = (f'SELECT {select_columns(fields, BOOKING_FIELDS)}, b.car_id AS _car_id'
+             ' FROM booking b JOIN car ca ON ca.id = b.car_id'
+             ' WHERE b.customer_id = ?')
+    params = [g.customer['id']]
+    if request.args.get('upcoming', type=int):
+        query += ' AND b.end_date >= ?'
+        params.append(today.isoformat())
+    rows = db.execute(query + ' ORDER BY b.start_date, b.id', params).fetchall()
+
+    return json_response(
+        {'bookings': [serialize(row, fields, '_car_id') for row in rows]}, etag)
@@ -0,0 +1,268 @@
+'''
+Module: assets
+Fingerprinted, precompressed static files.
+
+`flask build-assets` hashes every file under static/ into manifest.json and
+writes .gz (and .br, when the brotli package is installed) siblings of the
+text assets. url_for('static', ...) then adds the file's hash as ?v=, and
+the static route serves the smallest encoding the client accepts with a
+year long immutable Cache-Control on fingerprinted URLs. Without a build,
+hashes are worked out the first time a file is linked.
+
+A file edited after the build is not served from what the build left
+behind: its manifest entry, which records the size and mtime it was hashed
+at, is ignored, and compressed siblings older than it are skipped.
+'''
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import abort, current_app, request, send_file
+from werkzeug.utils import safe_join
+
+from car_app.images import IMMUTABLE_MAX_AGE
+
+try:
+    import brotli
+except ImportError:  # .br files are only built when it is installed
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# Only text formats shrink enough to be worth a compressed copy
+COMPRESSIBLE = {'.css', '.js', '.svg', '.map', '.json', '.ttf', '.eot', '.txt', '.html'}
+COMPRESS_MIN_SIZE = 1024
+
+# Compressed siblings, best first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# References to static files in templates and stylesheets
+TEMPLATE_REFERENCE = re.compile(r"""filename\s*=\s*['"]([^'"]+)['"]""")
+CSS_REFERENCE = re.compile(r"""url\(\s*['"]?([^'")?#]+)""")
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def iter_static_files(static_folder):
+    '''Relative paths of the source files, leaving out built artifacts'''
+    for root, dirs, files in os.walk(static_folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(('.gz', '.br')) or name == MANIFEST:
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_folder).replace(os.sep, '/')
+
+
+def compress_file(path):
+    '''Writes the compressed siblings of path that are missing or stale.
+    Returns how many were written.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    source_mtime = os.path.getmtime(path)
+
+    written = 0
+    for encoding, suffix in ENCODINGS:
+        if encoding == 'br' and brotli is None:
+            continue
+        target = path + suffix
+        if os.path.exists(target) and os.path.getmtime(target) >= source_mtime:
+            continue
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=11)
+        else:
+            # mtime=0 keeps the output identical between builds
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) >= len(data):
+            continue
+        with open(target, 'wb') as f:
+            f.write(compressed)
+        written += 1
+    return written
+
+
+def file_stamp(path):
+    '''What tells whether a file changed since it was hashed'''
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_assets(static_folder):
+    '''Writes manifest.json and the compressed siblings.
+    Returns (files hashed, compressed files written).'''
+    manifest = {}
+    written = 0
+    for filename in iter_static_files(static_folder):
+        path = os.path.join(static_folder, filename)
+        manifest[filename] = {'hash': file_hash(path), **file_stamp(path)}
+        if (os.path.splitext(filename)[1].lower() in COMPRESSIBLE
+                and os.path.getsize(path) >= COMPRESS_MIN_SIZE):
+            written += compress_file(path)
+
+    with open(os.path.join(static_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    return len(manifest), written
+
+
+def load_manifest(app):
+    '''Hashes from manifest.json of the files unchanged since the build'''
+    try:
+        with open(os.path.join(app.static_folder, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    versions = {}
+    for filename, entry in manifest.items():
+        # Entries of older builds carry no stamp and are hashed again
+        if not isinstance(entry, dict):
+            continue
+        path = safe_join(app.static_folder, filename)
+        try:
+            stamp = file_stamp(path) if path else None
+        except OSError:
+            continue
+        if stamp and all(entry.get(key) == value for key, value in stamp.items()):
+            versions[filename] = entry['hash']
+    return versions
+
+
+def asset_version(filename):
+    '''Content hash of a static file, None if it does not exist'''
+    versions = current_app.extensions['asset_versions']
+    # In debug mode files change under us, so never trust old hashes
+    if filename not in versions or current_app.debug:
+        path = safe_join(current_app.static_folder, filename)
+        versions[filename] = file_hash(path) if path and os.path.isfile(path) else None
+    return versions[filename]
+
+
+def add_static_version(endpoint, values):
+    '''url_defaults hook adding ?v=<content hash> to static URLs'''
+    if endpoint != 'static' or 'v' in values or 'filename' not in values:
+        return
+    version = asset_version(values['filename'])
+    if version:
+        values['v'] = version
+
+
+def compressed_sibling(path, suffix):
+    '''True when path + suffix exists and was built from the current path'''
+    try:
+        return os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def serve_static(filename):
+    '''Replaces Flask's static view: serves the smallest encoding the client
+    accepts and lets browsers keep fingerprinted files forever'''
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    served, content_encoding = path, None
+    for encoding, suffix in ENCODINGS:
+        if encoding in request.accept_encodings and compressed_sibling(path, suffix):
+            served, content_encoding = path + suffix, encoding
+            break
+
+    response = send_file(served, mimetype=mimetype, conditional=True)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+
+    requested_version = request.args.get('v')
+    if requested_version and requested_version == asset_version(filename):
+        response.cache_control.public = True
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.cache_control.max_age = None
+    return response
+
+
+def referenced_assets(app):
+    '''Static files linked from a template, plus everything the linked
+    stylesheets pull in through url()'''
+    static_folder = app.static_folder
+    referenced = set()
+    for name in app.jinja_env.list_templates():
+        source = app.jinja_env.loader.get_source(app.jinja_env, name)[0]
+        referenced.update(TEMPLATE_REFERENCE.findall(source))
+
+    pending = [name for name in referenced if name.endswith('.css')]
+    while pending:
+        stylesheet = pending.pop()
+        path = safe_join(static_folder, stylesheet)
+        if path is None or not os.path.isfile(path):
+            continue
+        with open(path, encoding='utf8', errors='replace') as f:
+            urls = CSS_REFERENCE.findall(f.read())
+        base = os.path.dirname(stylesheet)
+        for url in urls:
+            if url.startswith(('data:', 'http:', 'https:', '//')):
+                continue
+            target = os.path.normpath(os.path.join(base, url)).replace(os.sep, '/')
+            if target not in referenced:
+                referenced.add(target)
+                if target.endswith('.css'):
+                    pending.append(target)
+    return referenced
+
+
+@click.command('build-assets')
+def build_assets_command():
+    """Hash the static files into manifest.json and precompress them."""
+    hashed, written = build_assets(current_app.static_folder)
+    if brotli is None:
+        click.echo('brotli is not installed, only .gz files were built.')
+    click.echo(f'Hashed {hashed} static files, wrote {written} compressed copies.')
+
+
+@click.command('unused-assets')
+@click.option('--list', 'list_files', is_flag=True, help='Print every unused file.')
+def unused_assets_command(list_files):
+    """Report static files no template or stylesheet refers to."""
+    static_folder = current_app.static_folder
+    referenced = referenced_assets(current_app)
+
+    unused = {}
+    for filename in iter_static_files(static_folder):
+        if filename not in referenced:
+            unused[filename] = os.path.getsize(os.path.join(static_folder, filename))
+
+    by_folder = {}
+    for filename, size in unused.items():
+        folder = os.path.dirname(filename)
+        count, total = by_folder.get(folder, (0, 0))
+        by_folder[folder] = (count + 1, total + size)
+
+    for folder, (count, total) in sorted(by_folder.items(), key=lambda item: -item[1][1]):
+        click.echo(f'{total / 1024:10.1f} KiB {count:5d} files  {folder or "."}')
+    if list_files:
+        for filename in sorted(unused):
+            click.echo(filename)
+    click.echo(f'{len(unused)} unused files, {sum(unused.values()) / 1024 / 1024:.1f} MiB.')
+
+
+def init_app(app):
+    app.extensions['asset_versions'] = load_manifest(app)
+    app.url_defaults(add_static_version)
+    app.view_functions['static'] = serve_static
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(unused_assets_command)
@@ -0,0 +1,56 @@
+'''
+Module: availability
+Date-range availability of cars, answered from the booking table.
+
+Bookings are inclusive ranges of days. Two ranges overlap when each one
+starts on or before the day the other ends. Every query below filters on
+booking (car_id, end_date, start_date), which the booking_car_dates index
+covers: for a car, SQLite seeks straight to the bookings that have not
+ended before the requested start, so past bookings cost nothing however
+many of them pile up.
+'''
+from datetime import date
+
+from car_app.shared_variables import get_today_date
+
+
+class InvalidRange(ValueError):
+    pass
+
+
+def parse_range(start, end, default=None):
+    '''Turns two ISO date strings into dates. Missing values fall back to
+    default (today when not given); raises InvalidRange otherwise'''
+    default = default or get_today_date()
+    try:
+        start_date = date.fromisoformat(start) if start else default
+        end_date = date.fromisoformat(end) if end else start_date
+    except ValueError:
+        raise InvalidRange('Dates must look like YYYY-MM-DD.')
+
+    if end_date < start_date:
+        raise InvalidRange('End date must be on or after the start date.')
+    return start_date, end_date
+
+
+def find_conflict(db, car_id, start_date, end_date, exclude_booking_id=None):
+    '''Returns the first booking of the car overlapping the range, or None'''
+    # Booking ids start at 1, so excluding 0 excludes nothing
+    return db.execute(
+        'SELECT id, start_date, end_date FROM booking'
+        ' WHERE car_id = ? AND end_date >= ? AND start_date <= ?'
+        ' AND id <> ?'
+        ' LIMIT 1',
+        (car_id, start_date.isoformat(), end_date.isoformat(), exclude_booking_id or 0)
+    ).fetchone()
+
+
+# True for a car row with no booking overlapping (start date, end date),
+# the two parameters it takes. search.py builds the catalog queries on it.
+NOT_BOOKED = (
+    'NOT EXISTS ('
+    ' SELECT 1 FROM booking b'
+    ' WHERE b.car_id = car.id AND b.end_date >= ? AND b.start_date <= ?'
+    ')'
+)
+
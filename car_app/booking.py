@@ -1,30 +1,109 @@
+import sqlite3
+from datetime import MAXYEAR, MINYEAR
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for, session
+    Blueprint, current_app, flash, g, redirect, render_template, request, url_for, session
 )
 from werkzeug.exceptions import abort
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from car_app.availability import InvalidRange, find_conflict, parse_range
+from car_app.cache import bump_catalog_version
 from car_app.customer import login_required
-from car_app.db import get_db
+from car_app.db import get_db, immediate_transaction, is_busy
+from car_app.occupancy import mark, utilization_report
+from car_app.pagination import keyset_page, stream_csv
+from car_app.pricing import quote_car
+from car_app.query_plans import FULL_DUMP
 from car_app.car import get_car
 from car_app.shared_variables import get_greeting, get_today_date
+from car_app.sweeper import format_report, sweep_expired_bookings
 
 bp = Blueprint('booking', __name__, url_prefix='/wheels_on_rent/booking')
 
+UNAVAILABLE_MESSAGE = 'Sorry, this car is no longer available for those dates.'
+BUSY_MESSAGE = 'We are handling a lot of bookings right now, please try again.'
+
+
+# Raised when another booking got the car first
+class CarUnavailable(Exception):
+    pass
+
+
+# Checks and writes a booking in one BEGIN IMMEDIATE transaction, so two
+# customers racing for the same car can never both get overlapping dates.
+# The booking keeps the quote for its car and dates at the time it was made,
+# and the occupancy bitmaps move with its days.
+def save_booking(car_id, customer_id, start_date, end_date, booking_id=None):
+    def work(db):
+        old = None if booking_id is None else db.execute(
+            'SELECT car_id, start_date, end_date FROM booking WHERE id = ?', (booking_id,)
+        ).fetchone()
+        # A booking may keep its car once the car is unlisted, but not move to one
+        if (old is None or old['car_id'] != car_id) and db.execute(
+                'SELECT 1 FROM car WHERE id = ? AND status = 1', (car_id,)
+        ).fetchone() is None:
+            raise CarUnavailable
+        if find_conflict(db, car_id, start_date, end_date, exclude_booking_id=booking_id):
+            raise CarUnavailable
+
+        # Either way the car drops out of the catalog for these dates
+        bump_catalog_version(db)
+        total_price = quote_car(db, car_id, start_date, end_date)
+        if booking_id is None:
+            new_id = db.execute(
+                'INSERT INTO booking (car_id, customer_id, start_date, end_date, total_price)'
+                ' VALUES (?, ?, ?, ?, ?) RETURNING id',
+                (car_id, customer_id, start_date.isoformat(), end_date.isoformat(), total_price)
+            ).fetchone()[0]
+            mark(db, car_id, start_date, end_date)
+            return new_id
+
+        db.execute(
+            'UPDATE booking SET car_id = ?, start_date = ?, end_date = ?, customer_id = ?,'
+            ' total_price = ? WHERE id = ?',
+            (car_id, start_date.isoformat(), end_date.isoformat(), customer_id, total_price,
+             booking_id)
+        )
+        if old is not None:
+            mark(db, old['car_id'], old['start_date'], old['end_date'], booked=False)
+        mark(db, car_id, start_date, end_date)
+        return booking_id
+
+    return immediate_transaction(work)
+
 
 # Admin can see all bookings
 @bp.route('/')
 @login_required
 def index():
     db = get_db()
-    bookings = db.execute(
+    if request.args.get('format') == 'csv':
+        return stream_csv(
+            'bookings.csv',
+            ('id', 'car_id', 'car', 'customer_id', 'name', 'last_name', 'start_date', 'end_date',
+             'total_price'),
+            db.execute(
+                'SELECT b.id, b.car_id, ca.name, b.customer_id, cu.name, cu.last_name, start_date,'
+                ' end_date, total_price'
+                ' FROM booking b'
+                ' JOIN customer cu ON b.customer_id = cu.id'
+                ' JOIN car ca on b.car_id = ca.id'
+                ' ORDER BY start_date, b.id' + FULL_DUMP
+            )
+        )
+
+    bookings, next_cursor = keyset_page(
+        db,
         'SELECT b.id, ca.name, cu.name, cu.last_name, start_date, end_date'
         ' FROM booking b'
         ' JOIN customer cu ON b.customer_id = cu.id'
-        ' JOIN car ca on b.car_id = ca.id'
-        ' ORDER BY start_date ASC'
-    ).fetchall()
-    return render_template('admin/booking_index.html', bookings=bookings)
+        ' JOIN car ca on b.car_id = ca.id',
+        order_by=('start_date', 'b.id'),
+        row_key=lambda booking: (booking['start_date'], booking['id']),
+    )
+    return render_template('admin/booking_index.html', bookings=bookings,
+                           next_cursor=next_cursor)
 
 # Customer can see his own bookings
 @bp.route('/my_bookings')
@@ -39,7 +118,8 @@ def my_bookings():
 
     # Modify the SQL query to filter by customer_id
     bookings = db.execute(
-        'SELECT b.id, car_id, ca.id, ca.name, customer_id, cu.id, cu.name, cu.last_name, start_date, end_date'
+        'SELECT b.id, car_id, ca.id, ca.name, customer_id, cu.id, cu.name, cu.last_name, start_date, end_date, ca.image_hash,'
+        ' total_price'
         ' FROM booking b'
         ' JOIN customer cu ON customer_id = cu.id'
         ' JOIN car ca ON car_id = ca.id'
@@ -66,26 +146,42 @@ def create(car_id):
         if not end_date:
             error = 'End date is required.'
 
+        if error is None:
+            try:
+                start_date, end_date = parse_range(start_date, end_date)
+            except InvalidRange as e:
+                error = str(e)
+
         if error is not None:
-            flash(error)
+            flash(error, 'error')
         else:
-            customer_id = g.customer['id']
-
-            db = get_db()
-            db.execute(
-                'INSERT INTO booking (car_id, customer_id, start_date, end_date)'
-                ' VALUES (?, ?, ?, ?)',
-                (car_id, customer_id, start_date, end_date)
-            )
-            db.execute(
-                'UPDATE car SET status = 0 WHERE id = ?',
-                (car_id,)
-            )
-            db.commit()
+            try:
+                save_booking(car_id, g.customer['id'], start_date, end_date)
+            except CarUnavailable:
+                flash(UNAVAILABLE_MESSAGE, 'error')
+                return render_template('booking/create.html', today_date=today_date, car=car,
+                                       start_date=start_date, end_date=end_date), 409
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                flash(BUSY_MESSAGE, 'error')
+                return render_template('booking/create.html', today_date=today_date, car=car,
+                                       start_date=start_date, end_date=end_date), 503
             flash('You have successfully booked your car !', 'success')
             return redirect(url_for('booking.my_bookings'))
 
-    return render_template('booking/create.html', today_date=today_date, car=car)
+    # Quote the dates the catalog was searched for
+    start_date = request.args.get('start_date', today_date)
+    end_date = request.args.get('end_date', '')
+    quote = None
+    if end_date:
+        try:
+            quote = quote_car(get_db(), car_id,
+                              *parse_range(request.args.get('start_date'), end_date))
+        except InvalidRange:
+            pass
+    return render_template('booking/create.html', today_date=today_date, car=car,
+                           start_date=start_date, end_date=end_date, quote=quote)
 
 # Getting booking with the same booking id
 def get_booking(id, check_author=True):
@@ -113,7 +209,7 @@ def update(id):
     #car = get_car(car_id)
     db = get_db()
     cars = db.execute(
-        'SELECT id, name, model, seat, door, gearbox, image, price'
+        'SELECT id, name, model, seat, door, gearbox, price'
         ' FROM car'
         ' ORDER BY name ASC'
     ).fetchall()
@@ -123,7 +219,7 @@ def update(id):
 
     if request.method == 'POST':
         if 'update' in request.form:
-            car_id = request.form['car_id']
+            car_id = request.form.get('car_id', type=int)
             start_date = request.form['start_date']
             end_date = request.form['end_date']
         elif 'cancel' in request.form:
@@ -134,16 +230,28 @@ def update(id):
             error = 'Start date is required.'
         if not end_date:
             error = 'End date is required.'
+        if car_id is None:
+            error = 'Car is required.'
+
+        if error is None:
+            try:
+                start_date, end_date = parse_range(start_date, end_date)
+            except InvalidRange as e:
+                error = str(e)
 
         if error is not None:
-            flash(error)
+            flash(error, 'error')
         else:
-            db.execute(
-                'UPDATE booking SET car_id = ?, start_date = ?, end_date = ?, customer_id = ?'
-                ' WHERE id = ?',
-                (car_id, start_date, end_date, g.customer['id'], id)
-            )
-            db.commit()
+            try:
+                save_booking(car_id, g.customer['id'], start_date, end_date, booking_id=id)
+            except CarUnavailable:
+                flash(UNAVAILABLE_MESSAGE, 'error')
+                return render_template('booking/update.html', booking=booking, cars=cars), 409
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                flash(BUSY_MESSAGE, 'error')
+                return render_template('booking/update.html', booking=booking, cars=cars), 503
             return redirect(url_for('booking.my_bookings'))
 
     return render_template('booking/update.html', booking=booking, cars=cars)
@@ -151,48 +259,55 @@ def update(id):
 @bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
-    booking = get_booking(id)
-    car_id = booking['car_id']  # Get the car_id associated with this booking
-    db = get_db()
-    db.execute('DELETE FROM booking WHERE id = ?', (id,))
-    db.execute('UPDATE car SET status = 1 WHERE id = ?', (car_id,))  # Update car status to 1 (available)
-    db.commit()
+    get_booking(id)
+
+    # The dates are free again as soon as the booking row is gone
+    def work(db):
+        booking = db.execute('DELETE FROM booking WHERE id = ?'
+                             ' RETURNING car_id, start_date, end_date', (id,)).fetchone()
+        if booking is not None:
+            mark(db, booking['car_id'], booking['start_date'], booking['end_date'], booked=False)
+        bump_catalog_version(db)
+
+    immediate_transaction(work)
     if g.customer['role'] == 1:
         return redirect(url_for('booking.index'))
     return redirect(url_for('booking.my_bookings'))
 
 
-# This is a function to run periodicaly to check expired bookings
-# To delete them
-# This should be run at least once per a day
-# This is an alternative automation if the customer or admin did not delete the expired booking
-@bp.route('/check_and_update_car_status')
-def check_and_update_car_status():
-    # This route checks for cars with end dates that have passed
-    # and updates their status to 1 (available for rent)
-
-    today_date = get_today_date()
-
-    db = get_db()
-
-    # Step 1: Update car status
-    expired_cars = db.execute(
-        'SELECT id FROM booking WHERE end_date < ?',
-        (today_date,)
-    ).fetchall()
-
-    for car_id in expired_cars:
-        db.execute(
-            'UPDATE car SET status = 1 WHERE id = ?',
-            (car_id,)
+# Admin calendar of how much of the fleet is booked on each day of a year,
+# and the cars that sit idle. Read from the occupancy bitmaps, so it costs
+# the same however many bookings there are.
+@bp.route('/occupancy')
+@login_required
+def occupancy():
+    if g.customer['role'] != 1:
+        abort(403)
+    year = request.args.get('year', type=int) or get_today_date().year
+    if not MINYEAR <= year < MAXYEAR:
+        abort(404)
+
+    if request.args.get('format') == 'csv':
+        report = utilization_report(get_db(), year)
+        months = [f'month_{month}' for month in range(1, 13)]
+        return stream_csv(
+            f'utilization-{year}.csv',
+            ('id', 'name', 'model', 'booked_days', 'utilization', *months),
+            ((car['id'], car['name'], car['model'], car['booked_days'],
+              round(car['utilization'], 4), *car['months']) for car in report['cars'])
         )
+    return render_template('admin/occupancy.html',
+                           **utilization_report(get_db(), year,
+                                                limit=current_app.config['PAGE_SIZE']))
 
-    # Step 2: Delete expired bookings
-    db.execute(
-        'DELETE FROM booking WHERE end_date < ?',
-        (today_date,)
-    )
 
-    db.commit()
+# Archives expired bookings on demand. The same sweep runs from
+# `flask sweep-bookings` and, when SWEEPER_INTERVAL is set, from the
+# in-process scheduler (see sweeper.py)
+@bp.route('/check_and_update_car_status')
+@login_required
+def check_and_update_car_status():
+    if g.customer['role'] != 1:
+        abort(403)
 
-    return 'Car statuses updated and expired bookings deleted.'
+    return format_report(sweep_expired_bookings())
@@ -0,0 +1,143 @@
+'''
+Module: cache
+Small key/value caches for rendered fragments, with hit/miss counters.
+
+CATALOG_CACHE picks the backend:
+  'lru'     in-process LRU (default), each worker has its own copy
+  'sqlite'  one SQLite file shared by every worker on the host
+  None      caching disabled
+'''
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'backend': 'lru', 'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+
+class SQLiteCache:
+    '''Shared by all processes through one WAL mode SQLite file. Each thread
+    keeps its own connection to it.'''
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                ' key TEXT PRIMARY KEY,'
+                ' value TEXT NOT NULL,'
+                ' accessed REAL NOT NULL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            db.commit()
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, value):
+        db = self.connection()
+        try:
+            db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, accessed) VALUES (?, ?, ?)',
+                (key, value, time.time()))
+            self.writes += 1
+            # Trim the oldest entries every now and then, not on every write
+            if self.writes % 100 == 0:
+                db.execute(
+                    'DELETE FROM cache WHERE key NOT IN ('
+                    ' SELECT key FROM cache ORDER BY accessed DESC LIMIT ?)',
+                    (self.max_entries,))
+            db.commit()
+        except sqlite3.OperationalError:
+            # A busy cache is not worth failing the request for
+            db.rollback()
+
+    def stats(self):
+        entries = self.connection().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return {'backend': 'sqlite', 'hits': self.hits, 'misses': self.misses,
+                'entries': entries}
+
+
+def make_cache(app):
+    backend = app.config['CATALOG_CACHE']
+    size = app.config['CATALOG_CACHE_SIZE']
+    if backend == 'lru':
+        return LRUCache(size)
+    if backend == 'sqlite':
+        return SQLiteCache(app.config['CATALOG_CACHE_PATH']
+                           or os.path.join(app.instance_path, 'cache.sqlite'), size)
+    if backend:
+        raise ValueError(f'Unknown CATALOG_CACHE backend {backend!r}')
+    return None
+
+
+def get_catalog_cache():
+    '''The configured catalog cache, or None when caching is off'''
+    extensions = current_app.extensions
+    if 'catalog_cache' not in extensions:
+        extensions['catalog_cache'] = make_cache(current_app)
+    return extensions['catalog_cache']
+
+
+def get_catalog_version(db):
+    return db.execute('SELECT version FROM catalog_version').fetchone()[0]
+
+
+def bump_catalog_version(db):
+    '''Called in the same transaction as any write that changes what the
+    catalog shows, so cached fragments keyed by the old version are never
+    served again. Returns the new version.'''
+    return db.execute(
+        'UPDATE catalog_version SET version = version + 1 RETURNING version'
+    ).fetchone()[0]
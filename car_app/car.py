@@ -1,13 +1,22 @@
+import json
 import os
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, url_for,current_app
 )
+from markupsafe import Markup
 from werkzeug.exceptions import abort
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 
+from car_app.availability import InvalidRange, parse_range
+from car_app.cache import bump_catalog_version, get_catalog_cache, get_catalog_version
 from car_app.customer import login_required
-from car_app.db import get_db
+from car_app.db import get_db, immediate_transaction
+from car_app.pagination import keyset_page, stream_csv
+from car_app.pricing import quote_cars, rules_key
+from car_app.query_plans import FULL_DUMP
+from car_app.search import InvalidFilter, gearbox_choices, parse_filters, search_cars
+from car_app.images import InvalidImage, ingest_image, save_variant_rows, store_variants
 from car_app.shared_variables import get_greeting
 
 bp = Blueprint('car', __name__, url_prefix='/wheels_on_rent/car')
@@ -25,12 +34,84 @@ def get_upload_path(filename):
 @login_required
 def index():
     db = get_db()
-    cars = db.execute(
-        'SELECT id, name, model, seat, door, gearbox, image, price'
-        ' FROM car'
-        ' ORDER BY name ASC'
-    ).fetchall()
-    return render_template('admin/car_index.html', cars=cars)
+    if request.args.get('format') == 'csv':
+        # Full dump, streamed row by row straight off the cursor
+        columns = ('id', 'name', 'model', 'status', 'seat', 'door', 'gearbox', 'price')
+        return stream_csv('cars.csv', columns, db.execute(
+            f"SELECT {', '.join(columns)} FROM car ORDER BY name, id" + FULL_DUMP))
+
+    cars, next_cursor = keyset_page(
+        db,
+        'SELECT id, name, model, seat, door, gearbox, image_hash, price FROM car',
+        order_by=('name', 'id'),
+        row_key=lambda car: (car['name'], car['id']),
+    )
+    return render_template('admin/car_index.html', cars=cars, next_cursor=next_cursor)
+
+# Dates the customer wants the car for, today when nothing was picked
+def get_requested_range():
+    try:
+        return parse_range(request.args.get('start_date'), request.args.get('end_date'))
+    except InvalidRange as e:
+        flash(str(e), 'error')
+        return parse_range(None, None)
+
+# Search text and filters from the form, none when they do not make sense
+def get_requested_filters():
+    try:
+        return parse_filters(request.args)
+    except InvalidFilter as e:
+        flash(str(e), 'error')
+        return {}
+
+# The car grid for a date range and search, with each car's quote for the
+# range, rendered once per catalog version and pricing rules and served
+# from the catalog cache until a car or booking changes. Anything personal
+# (greeting, flashed messages) stays in car/index.html.
+def render_catalog_grid(start_date, end_date, filters):
+    db = get_db()
+    cache = get_catalog_cache()
+    if cache is not None:
+        key = (f'catalog-grid:{get_catalog_version(db)}:{rules_key()}:{start_date}:{end_date}:'
+               f'{sorted(filters.items())}')
+        grid = cache.get(key)
+        if grid is not None:
+            return Markup(grid)
+
+    limit = current_app.config['CATALOG_RESULTS']
+    cars = search_cars(
+        db, start_date, end_date,
+        'car.id, car.name, car.model, car.seat, car.door, car.gearbox, car.image_hash, car.price',
+        filters, limit=limit
+    )
+    quotes = quote_cars(db, [car['id'] for car in cars], start_date, end_date)
+    grid = render_template('car/_grid.html', cars=cars, limit=limit, quotes=quotes,
+                           days=(end_date - start_date).days + 1,
+                           start_date=start_date, end_date=end_date)
+    if cache is not None:
+        cache.set(key, grid)
+    return Markup(grid)
+
+# Gearboxes offered in the search form, cached alongside the grid
+def get_gearbox_choices():
+    db = get_db()
+    cache = get_catalog_cache()
+    if cache is None:
+        return gearbox_choices(db)
+    key = f'gearboxes:{get_catalog_version(db)}'
+    choices = cache.get(key)
+    if choices is None:
+        choices = json.dumps(gearbox_choices(db))
+        cache.set(key, choices)
+    return json.loads(choices)
+
+def render_catalog(**context):
+    start_date, end_date = get_requested_range()
+    filters = get_requested_filters()
+    return render_template('car/index.html',
+                           grid=render_catalog_grid(start_date, end_date, filters),
+                           gearboxes=get_gearbox_choices(), filters=filters,
+                           start_date=start_date, end_date=end_date, **context)
 
 # Car list
 @bp.route('/available')
@@ -38,29 +119,13 @@ def index():
 def available():
     # Say Good Morning/Good Afternoon your customer
     greeting = get_greeting()
-
-    # connect to database
-    db = get_db()
-    cars = db.execute(
-        'SELECT id, name, model, seat, door, gearbox,  image, price'
-        ' FROM car'
-        ' WHERE status = 1'
-        ' ORDER BY name ASC'
-    ).fetchall()
-    return render_template('car/index.html', greeting=greeting, cars=cars)
+    return render_catalog(greeting=greeting)
 
 # Guest mode page, Customer can see without logging in if he wish
 @bp.route('/guest_mode')
 def guest_mode():
     guest = 1
-    db = get_db()
-    cars = db.execute(
-        'SELECT id, name, model, seat, door, gearbox, image, price'
-        ' FROM car'
-        ' WHERE status = 1'
-        ' ORDER BY name ASC'
-    ).fetchall()
-    return render_template('car/index.html', guest=guest, cars=cars)
+    return render_catalog(guest=guest)
 
 ## Admin can create new car entry ##
 @bp.route('/create', methods=('GET', 'POST'))
@@ -96,20 +161,35 @@ def create():
             flash(error)
         else:
             # Check if an image was uploaded
+            variants = None
+            image_error = 'Invalid or missing image.'
             if image and allowed_file(image.filename):
-                image_data = image.read()  # Read the binary image data
-
-                db = get_db()
-                db.execute(
-                    'INSERT INTO car (name, model, status, seat, door, gearbox, image, price)'
-                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                    (name, model, status, seat, door, gearbox, image_data, price)
-                )
-                db.commit()
+                # Streamed from its spool, the extension alone proves nothing
+                try:
+                    metadata, variants = ingest_image(image.stream)
+                except InvalidImage as e:
+                    image_error = f'The image {e}.'
+
+            if variants is not None:
+                # Store the resized copies the catalog pages serve
+                stored = store_variants(variants)
+
+                def work(db):
+                    car_id = db.execute(
+                        'INSERT INTO car (name, model, status, seat, door, gearbox,'
+                        ' image_type, image_hash, image_updated, price, change_seq)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id',
+                        (name, model, status, seat, door, gearbox,
+                         metadata['image_type'], metadata['image_hash'],
+                         metadata['image_updated'], price, bump_catalog_version(db))
+                    ).fetchone()[0]
+                    save_variant_rows(db, car_id, stored)
+
+                immediate_transaction(work)
                 return redirect(url_for('car.index'))
             else:
                 # Handle invalid or missing image
-                flash('Invalid or missing image.')
+                flash(image_error)
 
     return render_template('admin/car_create.html')
 
@@ -117,7 +197,7 @@ def create():
 # Getting a car associated with a given id to update it
 def get_car(id, check_author=True):
     car = get_db().execute(
-        'SELECT id, name, model, status, seat, door, gearbox, image, price'
+        'SELECT id, name, model, status, seat, door, gearbox, image_hash, price'
         ' FROM car'
         ' WHERE car.id = ?',
         (id,)
@@ -160,27 +240,40 @@ def update(id):
         if not price:
             error = 'Price is required.'
 
+        # Check if an image was uploaded
+        variants = None
+        if error is None and image and allowed_file(image.filename):
+            try:
+                metadata, variants = ingest_image(image.stream)
+            except InvalidImage as e:
+                error = f'The image {e}.'
+
         if error is not None:
             flash(error)
         else:
-            # Check if an image was uploaded
-            db = get_db()
-            if image and allowed_file(image.filename):
-                image_data = image.read() 
+            stored = store_variants(variants) if variants is not None else None
 
-                db.execute(
-                    'UPDATE car SET name = ?, model = ?, status = ?, seat = ?, door = ?, gearbox = ?, image = ?, price = ?'
-                    'WHERE id = ?',
-                    (name, model, status, seat, door, gearbox, image_data, price, id)
-                )
-            else:
-                # Keep the previous image and update other car details
-                db.execute(
-                    'UPDATE car SET name = ?, model = ?, status = ?, seat = ?, door = ?, gearbox = ?, price = ?'
-                    'WHERE id = ?',
-                    (name, model, status, seat, door, gearbox, price, id)
-                )
-            db.commit()
+            def work(db):
+                change_seq = bump_catalog_version(db)
+                if stored is not None:
+                    db.execute(
+                        'UPDATE car SET name = ?, model = ?, status = ?, seat = ?, door = ?, gearbox = ?,'
+                        ' image_type = ?, image_hash = ?, image_updated = ?, price = ?, change_seq = ?'
+                        ' WHERE id = ?',
+                        (name, model, status, seat, door, gearbox,
+                         metadata['image_type'], metadata['image_hash'],
+                         metadata['image_updated'], price, change_seq, id)
+                    )
+                    save_variant_rows(db, id, stored)
+                else:
+                    # Keep the previous image and update other car details
+                    db.execute(
+                        'UPDATE car SET name = ?, model = ?, status = ?, seat = ?, door = ?, gearbox = ?, price = ?,'
+                        ' change_seq = ? WHERE id = ?',
+                        (name, model, status, seat, door, gearbox, price, change_seq, id)
+                    )
+
+            immediate_transaction(work)
             return redirect(url_for('car.index'))
     return render_template('admin/car_update.html', car=car)
 
@@ -189,9 +282,18 @@ def update(id):
 @login_required
 def delete(id):
     get_car(id)
-    db = get_db()
-    db.execute('DELETE FROM car WHERE id = ?', (id,))
-    db.commit()
+
+    def work(db):
+        db.execute('DELETE FROM car_image WHERE car_id = ?', (id,))
+        db.execute('DELETE FROM car WHERE id = ?', (id,))
+        # Left behind for API clients that sync with changed_since
+        db.execute(
+            'INSERT INTO car_tombstone (car_id, change_seq) VALUES (?, ?)'
+            ' ON CONFLICT (car_id) DO UPDATE SET change_seq = excluded.change_seq',
+            (id, bump_catalog_version(db))
+        )
+
+    immediate_transaction(work)
     return redirect(url_for('car.index'))
 
 # About us
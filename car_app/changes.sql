@@ -0,0 +1,59 @@
+-- Change log for cross-worker cache invalidation, see invalidation.py.
+-- The triggers below add a row for every car, customer and booking row
+-- written, in the writing transaction, so a worker that reads the log
+-- from where it stopped learns exactly which rows changed.
+-- `flask trim-change-log` drops old entries; a worker that had not read
+-- them yet clears its caches.
+
+-- AUTOINCREMENT: numbers are never handed out twice, even once the
+-- newest entries were trimmed
+CREATE TABLE IF NOT EXISTS change_log (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  table_name TEXT NOT NULL,
+  row_id INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS car_change_insert AFTER INSERT ON car
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('car', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_change_update AFTER UPDATE ON car
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('car', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_change_delete AFTER DELETE ON car
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('car', OLD.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS customer_change_insert AFTER INSERT ON customer
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('customer', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS customer_change_update AFTER UPDATE ON customer
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('customer', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS customer_change_delete AFTER DELETE ON customer
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('customer', OLD.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS booking_change_insert AFTER INSERT ON booking
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('booking', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS booking_change_update AFTER UPDATE ON booking
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('booking', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS booking_change_delete AFTER DELETE ON booking
+BEGIN
+  INSERT INTO change_log (table_name, row_id) VALUES ('booking', OLD.id);
+END;
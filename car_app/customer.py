@@ -1,12 +1,22 @@
 import functools
+import threading
+import time
+from collections import OrderedDict
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, has_request_context, redirect,
+    render_template, request, session, url_for
 )
+from flask.ctx import _AppCtxGlobals
 from werkzeug.exceptions import abort
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from car_app.db import get_db
+from car_app import invalidation
+from car_app.db import execute_write, get_db, immediate_transaction
+from car_app.pagination import keyset_page, stream_csv
+from car_app.passwords import hash_password, needs_rehash, replacement_hash, verify_password
+from car_app.query_plans import FULL_DUMP
+from car_app.shared_variables import get_today_date
+from car_app.stats import get_dashboard_stats
 
 bp = Blueprint('customer', __name__, url_prefix='/wheels_on_rent/customer')
 
@@ -36,11 +46,10 @@ def register():
 
         if error is None:
             try:
-                db.execute(
+                execute_write(
                     "INSERT INTO customer (name, last_name, phone_number, email,  password) VALUES (?, ?, ?, ?, ?)",
-                    (name, last_name, phone_number, email, generate_password_hash(password)),
+                    (name, last_name, phone_number, email, hash_password(password)),
                 )
-                db.commit()
                 flash('You have registered successfully.', 'success')
             except db.IntegrityError:
                 error = f"Email {email} is already registered."
@@ -65,10 +74,16 @@ def login():
 
         if customer is None:
             error = 'Incorrect email or password, please try again !'
-        elif not check_password_hash(customer['password'], password):
+        elif not verify_password(customer['password'], password):
             error = 'Incorrect email or password, please try again !'
 
         if error is None:
+            # Hashes made with older settings are upgraded while we have
+            # the plain password at hand
+            if needs_rehash(customer['password']):
+                execute_write('UPDATE customer SET password = ? WHERE id = ?',
+                              (hash_password(password), customer['id']))
+                forget_customer(customer['id'])
             session.clear()
             session['customer_id'] = customer['id']
             if customer['role'] == 1:
@@ -79,17 +94,88 @@ def login():
 
     return render_template('customer/login.html')
 
+# Logged in customers, cached per worker process so most requests do not
+# need to query the customer table at all. The views that change a
+# customer evict it straight away, and a change made by any worker is
+# evicted on that worker's next request through the change log (see
+# invalidation.py). Entries also expire after CUSTOMER_CACHE_TTL seconds.
+_customer_cache = OrderedDict()
+_customer_cache_lock = threading.Lock()
+# Counts evictions, so a row read before one is not cached after it
+_customer_cache_evictions = 0
+
+
+def forget_customer(customer_id):
+    evict_customers([customer_id])
+
+
+def evict_customers(customer_ids):
+    '''Drops customers of the current database from the cache, all of them
+    when customer_ids is None'''
+    global _customer_cache_evictions
+    database = current_app.config['DATABASE']
+    with _customer_cache_lock:
+        _customer_cache_evictions += 1
+        if customer_ids is None:
+            for key in [key for key in _customer_cache if key[0] == database]:
+                del _customer_cache[key]
+        else:
+            for customer_id in customer_ids:
+                _customer_cache.pop((database, customer_id), None)
+
+
+invalidation.subscribe('customer', evict_customers)
+
+
+def get_cached_customer(customer_id):
+    key = (current_app.config['DATABASE'], customer_id)
+    invalidation.sync()
+    now = time.monotonic()
+    with _customer_cache_lock:
+        entry = _customer_cache.get(key)
+        if entry is not None and entry[0] > now:
+            _customer_cache.move_to_end(key)
+            return entry[1]
+        evictions = _customer_cache_evictions
+
+    customer = get_db().execute(
+        'SELECT * FROM customer WHERE id = ?', (customer_id,)
+    ).fetchone()
+
+    with _customer_cache_lock:
+        if evictions != _customer_cache_evictions:
+            # The row may have changed while it was read
+            return customer
+        _customer_cache[key] = (now + current_app.config['CUSTOMER_CACHE_TTL'], customer)
+        _customer_cache.move_to_end(key)
+        # Least recently used customers go first when the cache is full
+        while len(_customer_cache) > current_app.config['CUSTOMER_CACHE_SIZE']:
+            _customer_cache.popitem(last=False)
+    return customer
+
+
 # Getting customer id that was previously stored during login
-@bp.before_app_request
 def load_logged_in_customer():
-    customer_id = session.get('customer_id')
+    customer_id = session.get('customer_id') if has_request_context() else None
 
     if customer_id is None:
-        g.customer = None
-    else:
-        g.customer = get_db().execute(
-            'SELECT * FROM customer WHERE id = ?', (customer_id,)
-        ).fetchone()
+        return None
+    return get_cached_customer(customer_id)
+
+
+# g.customer is only looked up the first time a view or template reads it,
+# so images and static files never touch the session or the database
+class CustomerGlobals(_AppCtxGlobals):
+    def __getattr__(self, name):
+        if name == 'customer':
+            self.customer = load_logged_in_customer()
+            return self.customer
+        return super().__getattr__(name)
+
+
+@bp.record_once
+def use_customer_globals(state):
+    state.app.app_ctx_globals_class = CustomerGlobals
 
 # logging out a customer by clearing customer id from the session
 @bp.route('/logout')
@@ -125,13 +211,21 @@ def login_required(view):
 @login_required
 def index():
     db = get_db()
-    customers = db.execute(
-        'SELECT id, name, last_name, email, phone_number'
-        ' FROM customer'
-        ' WHERE role = 0'
-        ' ORDER BY name ASC'
-    ).fetchall()
-    return render_template('admin/customer_index.html', customers=customers)
+    if request.args.get('format') == 'csv':
+        columns = ('id', 'name', 'last_name', 'email', 'phone_number')
+        return stream_csv('customers.csv', columns, db.execute(
+            f"SELECT {', '.join(columns)} FROM customer WHERE role = 0 ORDER BY name, id"
+            + FULL_DUMP))
+
+    customers, next_cursor = keyset_page(
+        db,
+        'SELECT id, name, last_name, email, phone_number FROM customer',
+        where='role = 0',
+        order_by=('name', 'id'),
+        row_key=lambda customer: (customer['name'], customer['id']),
+    )
+    return render_template('admin/customer_index.html', customers=customers,
+                           next_cursor=next_cursor)
 
 # customer can be created by the logged in addmin
 @bp.route('/create', methods=('GET', 'POST'))
@@ -160,11 +254,10 @@ def create():
 
         if error is None:
             try:
-                db.execute(
+                execute_write(
                     "INSERT INTO customer (name, last_name, phone_number, email,  password) VALUES (?, ?, ?, ?, ?)",
-                    (name, last_name, phone_number, email, generate_password_hash(password)),
+                    (name, last_name, phone_number, email, hash_password(password)),
                 )
-                db.commit()
                 flash('You have registered successfully.')
             except db.IntegrityError:
                 error = f"Email {email} is already registered."
@@ -217,13 +310,23 @@ def update():
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'UPDATE customer SET name = ?, last_name = ?, phone_number = ?, email = ?,  password = ?'
-                ' WHERE id = ?',
-                (name, last_name, phone_number, email, generate_password_hash(password), g.customer['id'])
-            )
-            db.commit()
+            customer_id = g.customer['id']
+            # A blank password, or the current one resubmitted, is kept
+            password_hash = (replacement_hash(g.customer['password'], password)
+                             if password else None)
+
+            def work(db):
+                db.execute(
+                    'UPDATE customer SET name = ?, last_name = ?, phone_number = ?, email = ?'
+                    ' WHERE id = ?',
+                    (name, last_name, phone_number, email, customer_id)
+                )
+                if password_hash:
+                    db.execute('UPDATE customer SET password = ? WHERE id = ?',
+                               (password_hash, customer_id))
+
+            immediate_transaction(work)
+            forget_customer(customer_id)
             flash('Profile updated successfully.')
             return redirect(url_for('car.available'))
 
@@ -250,12 +353,22 @@ def edit_profile():
             error = 'Passwords do not match.'
 
         if error is None:
-            db = get_db()
-            db.execute(
-                'UPDATE customer SET name = ?, last_name = ?, email = ?, password = ? WHERE id = ?',
-                (name, last_name, email, generate_password_hash(password), g.customer['id'])
-            )
-            db.commit()
+            customer_id = g.customer['id']
+            # A blank password, or the current one resubmitted, is kept
+            password_hash = (replacement_hash(g.customer['password'], password)
+                             if password else None)
+
+            def work(db):
+                db.execute(
+                    'UPDATE customer SET name = ?, last_name = ?, email = ? WHERE id = ?',
+                    (name, last_name, email, customer_id)
+                )
+                if password_hash:
+                    db.execute('UPDATE customer SET password = ? WHERE id = ?',
+                               (password_hash, customer_id))
+
+            immediate_transaction(work)
+            forget_customer(customer_id)
             flash('Profile updated successfully.')
             return redirect(url_for('customer.admin_dashboard'))
 
@@ -269,9 +382,8 @@ def edit_profile():
 @login_required
 def delete(id):
     get_customer(id)
-    db = get_db()
-    db.execute('DELETE FROM customer WHERE id = ?', (id,))
-    db.commit()
+    execute_write('DELETE FROM customer WHERE id = ?', (id,))
+    forget_customer(id)
     return redirect(url_for('customer.index'))
 
 # Admin Home(Dashboard)
@@ -281,13 +393,8 @@ def admin_dashboard():
 # Connect to the database
     db = get_db()
 
-    # SQL queries to count records in each table
-    car_count = db.execute('SELECT COUNT(*) FROM car').fetchone()[0]
-    customer_count = db.execute('SELECT COUNT(*) FROM customer').fetchone()[0]
-    booking_count = db.execute('SELECT COUNT(*) FROM booking').fetchone()[0]
+    # Every figure comes from the tables the stats triggers keep current
+    stats = get_dashboard_stats(db, get_today_date())
 
     # Render the dashboard template and pass counts as context
-    return render_template('admin/admin_dashboard.html',
-                           car_count=car_count,
-                           customer_count=customer_count,
-                           booking_count=booking_count)
+    return render_template('admin/admin_dashboard.html', **stats)
@@ -1,16 +1,105 @@
+import os
+import random
 import sqlite3
+import threading
+import time
 
 import click
-from flask import current_app, g
+from flask import current_app, g, has_request_context
+
+from car_app import engine
+from car_app.metrics import InstrumentedConnection
+
+# Connections outlive the request: every worker thread keeps one open per
+# database file and hands it out again on the next request.
+_local = threading.local()
+
+
+def connect(read_only=False):
+    config = current_app.config
+    db = sqlite3.connect(
+        config['DATABASE'],
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=config['SQLITE_BUSY_TIMEOUT'] / 1000,
+        cached_statements=config['SQLITE_CACHED_STATEMENTS'],
+        factory=(InstrumentedConnection if config['METRICS_ENABLED'] or config['QUERY_PLAN_AUDIT']
+                 else sqlite3.Connection),
+    )
+    db.row_factory = sqlite3.Row
+
+    db.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+    db.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+    db.execute(f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}")
+    db.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}")
+    db.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}")
+    if read_only:
+        # Its writes go to the write coordinator, see writer.py
+        db.execute('PRAGMA query_only = 1')
+    return db
+
+
+def get_dialect():
+    '''The configured backend, 'sqlite' or 'postgresql'. Query code asks
+    only for the few statements the two spell differently.'''
+    return 'postgresql' if current_app.config['DATABASE_URL'] else 'sqlite'
+
+
+def price_value(column='price'):
+    '''SQL for the number a price such as '645.8 Birr' starts with'''
+    if get_dialect() == 'postgresql':
+        return f'price_value({column})'
+    return f'CAST({column} AS REAL)'
+
+
+def writes_coordinated():
+    '''True when the writes of the current request go through the write
+    coordinator (see writer.py) and its reads through a query_only
+    connection'''
+    config = current_app.config
+    return (config['SQLITE_WRITE_COORDINATOR'] and not config['DATABASE_URL']
+            and has_request_context())
+
+
+def checkout(read_only=False):
+    '''Returns this thread's connection to the configured database, opening
+    a new one if there is none yet or the old one failed its health check.
+    With DATABASE_URL set, borrows one from the pool (see engine.py).'''
+    if current_app.config['DATABASE_URL']:
+        return engine.checkout()
+    if not current_app.config['SQLITE_PERSISTENT_CONNECTIONS']:
+        return connect(read_only)
+
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    key = (current_app.config['DATABASE'], read_only)
+    pid, db = connections.get(key, (None, None))
+    # A connection inherited across fork() must never be used by the child
+    if db is not None and pid != os.getpid():
+        db = None
+
+    if db is not None:
+        try:
+            if db.in_transaction:
+                db.rollback()
+            db.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            try:
+                db.close()
+            except sqlite3.Error:
+                pass
+            db = None
+
+    if db is None:
+        db = connect(read_only)
+        connections[key] = (os.getpid(), db)
+    return db
 
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = checkout(read_only=writes_coordinated())
 
     return g.db
 
@@ -18,14 +107,85 @@ def get_db():
 def close_db(e=None):
     db = g.pop('db', None)
 
-    if db is not None:
+    if db is None:
+        return
+
+    if current_app.config['DATABASE_URL'] or not current_app.config['SQLITE_PERSISTENT_CONNECTIONS']:
         db.close()
+    elif db.in_transaction:
+        # Never hand a half finished transaction to the next request
+        db.rollback()
+
+def is_busy(error):
+    '''True for "database is locked" style errors that are worth retrying'''
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        # SQLITE_BUSY and SQLITE_LOCKED, including their extended codes
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+def immediate_transaction(work):
+    '''Runs work(db) inside BEGIN IMMEDIATE and commits, returning what work
+    returned. Taking the write lock up front means whatever work reads is
+    still true when it writes. A busy database is retried a bounded number
+    of times with jittered exponential backoff before the error is raised.
+    In a request with SQLITE_WRITE_COORDINATOR on, work is handed to the
+    writer thread instead and committed together with other requests'
+    writes; it must then not touch request, session or g.'''
+    if writes_coordinated():
+        from car_app.writer import get_coordinator
+        return get_coordinator().submit(work)
+    return run_immediate(get_db(), work)
+
+
+def execute_write(sql, parameters=()):
+    '''Runs one write statement in its own immediate_transaction and
+    returns the number of rows it changed'''
+    return immediate_transaction(lambda db: db.execute(sql, parameters).rowcount)
+
+
+def run_immediate(db, work):
+    '''immediate_transaction on the given connection'''
+    attempts = current_app.config['SQLITE_WRITE_ATTEMPTS']
+    backoff = current_app.config['SQLITE_WRITE_BACKOFF']
+
+    for attempt in range(attempts):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(db)
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            if db.in_transaction:
+                db.rollback()
+            if not is_busy(e) or attempt == attempts - 1:
+                raise
+            # Full jitter keeps retrying workers from colliding again
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
 
 def init_db():
+    from car_app.migrations import latest_version
+
     db = get_db()
 
-    with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+    if get_dialect() == 'postgresql':
+        with current_app.open_resource('schema_postgresql.sql') as f:
+            db.executescript(f.read().decode('utf8'))
+        return
+
+    # stats.sql adds the dashboard tables and the triggers that fill them,
+    # search.sql the fleet search index, changes.sql the change log and
+    # pricing.sql the pricing version
+    for script in ('schema.sql', 'stats.sql', 'search.sql', 'changes.sql', 'pricing.sql'):
+        with current_app.open_resource(script) as f:
+            db.executescript(f.read().decode('utf8'))
+    # A fresh database already has everything the migrations would add
+    db.execute(f'PRAGMA user_version = {latest_version()}')
 
 
 @click.command('init-db')
@@ -0,0 +1,254 @@
+'''
+Module: fleet
+Bulk import and export of the fleet from the command line.
+
+    flask import-cars cars.csv --images photos/
+    flask export car --format ndjson --output cars.ndjson
+
+Imports read the file one row at a time, check every row and write the
+good ones with executemany in chunks, one short BEGIN IMMEDIATE
+transaction per chunk. Rows that fail validation are reported with their
+line number and skipped. Exports stream straight off the cursor.
+'''
+import csv
+import json
+import os
+import sys
+import time
+
+import click
+
+from car_app import image_store
+from car_app.cache import bump_catalog_version
+from car_app.db import get_db, get_dialect, immediate_transaction
+from car_app.images import InvalidImage, ingest_image, store_variants
+
+CAR_COLUMNS = ('name', 'model', 'status', 'seat', 'door', 'gearbox', 'price')
+
+# Columns written by `flask export`. Customer password hashes stay out.
+EXPORT_COLUMNS = {
+    'car': ('id', 'name', 'model', 'status', 'seat', 'door', 'gearbox', 'price', 'image_hash'),
+    'customer': ('id', 'name', 'last_name', 'phone_number', 'email', 'role'),
+    'booking': ('id', 'customer_id', 'car_id', 'start_date', 'end_date', 'total_price'),
+}
+
+IMAGE_EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+}
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def read_rows(f, file_format):
+    '''Yields (line number, dict) for every record in an open text file'''
+    if file_format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, InvalidRow(f'not valid JSON: {e}')
+            continue
+        if not isinstance(row, dict):
+            row = InvalidRow('expected a JSON object')
+        yield line_number, row
+
+
+def prepare_car(row, image_folder):
+    '''Checks one input row and stores its image. Returns the car column
+    values, the image metadata and the stored variants; raises InvalidRow
+    with the reason otherwise.'''
+    values = {}
+    for column in CAR_COLUMNS:
+        value = row.get(column)
+        value = '' if value is None else str(value).strip()
+        if not value:
+            raise InvalidRow(f'{column} is required')
+        values[column] = value
+
+    for column in ('seat', 'door'):
+        try:
+            values[column] = int(values[column])
+        except ValueError:
+            raise InvalidRow(f'{column} must be a whole number')
+    if values['status'] not in ('0', '1'):
+        raise InvalidRow('status must be 0 or 1')
+
+    image_name = str(row.get('image') or '').strip()
+    if not image_name:
+        raise InvalidRow('image is required')
+    image_path = os.path.join(image_folder, image_name)
+    try:
+        with open(image_path, 'rb') as f:
+            metadata, variants = ingest_image(f)
+    except OSError:
+        raise InvalidRow(f'image {image_name} cannot be read')
+    except InvalidImage as e:
+        raise InvalidRow(f'image {image_name} {e}')
+
+    return values, metadata, store_variants(variants)
+
+
+def reserve_car_ids(db, count):
+    '''Ids for count new cars, never used before'''
+    if get_dialect() == 'postgresql':
+        return [row[0] for row in db.execute(
+            "SELECT nextval(pg_get_serial_sequence('car', 'id')) FROM generate_series(1, ?)",
+            (count,))]
+    next_id = db.execute(
+        'SELECT MAX(COALESCE((SELECT MAX(id) FROM car), 0),'
+        " COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'car'), 0)) + 1"
+    ).fetchone()[0]
+    return range(next_id, next_id + count)
+
+
+def insert_cars(db, prepared):
+    '''Writes one chunk of prepared cars; runs inside immediate_transaction.
+    Ids are handed out up front so the car_image rows can go in with a
+    single executemany as well.'''
+    car_ids = reserve_car_ids(db, len(prepared))
+    change_seq = bump_catalog_version(db)
+
+    car_rows = []
+    image_rows = []
+    for car_id, (values, metadata, variants) in zip(car_ids, prepared):
+        car_rows.append((
+            car_id, *(values[column] for column in CAR_COLUMNS),
+            metadata['image_type'], metadata['image_hash'], metadata['image_updated'],
+            change_seq,
+        ))
+        image_rows.extend((car_id, *variant) for variant in variants)
+
+    db.executemany(
+        f"INSERT INTO car (id, {', '.join(CAR_COLUMNS)},"
+        ' image_type, image_hash, image_updated, change_seq)'
+        f" VALUES ({', '.join('?' * (len(CAR_COLUMNS) + 5))})",
+        car_rows
+    )
+    db.executemany(
+        'INSERT INTO car_image (car_id, size, content_type, image_hash)'
+        ' VALUES (?, ?, ?, ?)',
+        image_rows
+    )
+    return len(car_rows)
+
+
+def import_cars(f, file_format, image_folder, chunk_size):
+    '''Imports every valid row of an open file. Returns a report dict with
+    imported, errors [(line number, reason)] and seconds.'''
+    started = time.perf_counter()
+    report = {'imported': 0, 'errors': []}
+    chunk = []
+
+    def flush():
+        report['imported'] += immediate_transaction(lambda db: insert_cars(db, chunk))
+        chunk.clear()
+
+    for line_number, row in read_rows(f, file_format):
+        try:
+            if isinstance(row, InvalidRow):
+                raise row
+            chunk.append(prepare_car(row, image_folder))
+        except InvalidRow as e:
+            report['errors'].append((line_number, str(e)))
+            continue
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    report['seconds'] = time.perf_counter() - started
+    return report
+
+
+def guess_format(filename, file_format):
+    if file_format:
+        return file_format
+    return 'ndjson' if filename.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+def rate(rows, seconds):
+    return f'{rows} rows in {seconds:.2f}s, {rows / seconds if seconds else 0:.0f} rows/s'
+
+
+@click.command('import-cars')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images', 'image_folder', type=click.Path(exists=True, file_okay=False),
+              help='Folder the image column is relative to, the file\'s own by default.')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='Input format, guessed from the file name by default.')
+@click.option('--chunk-size', type=int, default=500, help='Cars written per transaction.')
+def import_cars_command(filename, image_folder, file_format, chunk_size):
+    """Import cars from a CSV or NDJSON file with image files alongside."""
+    image_folder = image_folder or os.path.dirname(os.path.abspath(filename))
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        report = import_cars(f, guess_format(filename, file_format), image_folder, chunk_size)
+
+    for line_number, reason in report['errors']:
+        click.echo(f'line {line_number}: {reason}', err=True)
+    click.echo(f"Imported {rate(report['imported'], report['seconds'])},"
+               f" rejected {len(report['errors'])}.")
+
+
+@click.command('export')
+@click.argument('table', type=click.Choice(sorted(EXPORT_COLUMNS)))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--output', type=click.Path(dir_okay=False), help='File to write, stdout by default.')
+@click.option('--images', 'image_folder', type=click.Path(file_okay=False),
+              help='Copy car images here and add an image column, so the file can be imported again.')
+def export_command(table, file_format, output, image_folder):
+    """Stream a table out as CSV or NDJSON."""
+    columns = EXPORT_COLUMNS[table]
+    with_images = table == 'car' and image_folder
+    if with_images:
+        os.makedirs(image_folder, exist_ok=True)
+        columns = columns + ('image',)
+
+    db = get_db()
+    cursor = db.execute(f"SELECT {', '.join(EXPORT_COLUMNS[table])}"
+                        f'{", image_type" if with_images else ""}'
+                        f' FROM {table} ORDER BY id')
+    started = time.perf_counter()
+    f = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        writer = csv.writer(f) if file_format == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+        rows = 0
+        for row in cursor:
+            values = list(row)[:len(EXPORT_COLUMNS[table])]
+            if with_images:
+                image_name = f"{row['image_hash']}.{IMAGE_EXTENSIONS.get(row['image_type'], 'img')}"
+                target = os.path.join(image_folder, image_name)
+                if not os.path.exists(target):
+                    with open(target, 'wb') as image_file:
+                        image_file.write(image_store.read(row['image_hash']))
+                values.append(image_name)
+            if writer:
+                writer.writerow(values)
+            else:
+                f.write(json.dumps(dict(zip(columns, values)), separators=(',', ':'), default=str))
+                f.write('\n')
+            rows += 1
+    finally:
+        if output:
+            f.close()
+
+    # stdout may be the export itself, so the summary goes to stderr
+    click.echo(f'Exported {table}: {rate(rows, time.perf_counter() - started)}.', err=True)
+
+
+def init_app(app):
+    app.cli.add_command(import_cars_command)
+    app.cli.add_command(export_command)
@@ -0,0 +1,160 @@
+'''
+Module: image_store
+Content-addressed file store for car images. A file is named after the
+SHA-256 of its bytes, so identical uploads share one file on disk and the
+database only keeps the hash.
+
+Uploads reach the store through a Spool: a temporary file in the store
+that hashes what is written to it, then is renamed to its hash. A file
+is never held in memory whole, and a reader never sees a partial one.
+'''
+import hashlib
+import os
+import tempfile
+import time
+import weakref
+
+from flask import current_app
+
+
+def get_store_root():
+    return current_app.config['IMAGE_STORE']
+
+
+def relative_path(image_hash):
+    '''Path of an image inside the store, fanned out on the first two hex
+    digits so no directory grows too large'''
+    return os.path.join(image_hash[:2], image_hash)
+
+
+def path_for(image_hash):
+    return os.path.join(get_store_root(), relative_path(image_hash))
+
+
+def put(data):
+    '''Stores the bytes if they are not already present and returns their hash'''
+    image_hash = hashlib.sha256(data).hexdigest()
+    path = path_for(image_hash)
+    if os.path.exists(path):
+        return image_hash
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary name first so a reader never sees a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return image_hash
+
+
+class TooLarge(Exception):
+    '''Not a ValueError: werkzeug's form parser takes those for malformed
+    input and drops the whole form'''
+
+
+def _discard(file, path):
+    file.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class Spool:
+    '''Temporary file inside the store that hashes and counts the bytes
+    written to it, and raises TooLarge past max_bytes. commit() moves it
+    into place under its hash; closed or garbage collected without that,
+    the file is removed. Reads and seeks go to the file.'''
+
+    SUFFIX = '.upload'
+
+    def __init__(self, max_bytes=None):
+        root = get_store_root()
+        os.makedirs(root, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=root, suffix=self.SUFFIX)
+        self.file = os.fdopen(fd, 'w+b')
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._cleanup = weakref.finalize(self, _discard, self.file, self.path)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.close()
+            raise TooLarge(f'more than {self.max_bytes} bytes')
+        self._digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def commit(self):
+        '''Moves the file to its place in the store and returns its hash'''
+        self.file.close()
+        image_hash = self._digest.hexdigest()
+        path = path_for(image_hash)
+        if os.path.exists(path):
+            os.unlink(self.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.path, path)
+        self._cleanup.detach()
+        return image_hash
+
+    def close(self):
+        self._cleanup()
+
+
+def spool(stream, max_bytes=None, chunk_size=64 * 1024):
+    '''Copies an open binary stream into a new Spool, chunk by chunk'''
+    target = Spool(max_bytes)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            target.write(chunk)
+    except BaseException:
+        target.close()
+        raise
+    target.seek(0)
+    return target
+
+
+def read(image_hash):
+    with open(path_for(image_hash), 'rb') as f:
+        return f.read()
+
+
+def prune(referenced, spool_max_age=24 * 60 * 60):
+    '''Deletes every stored file whose hash is not in referenced, and the
+    spools a crashed worker left behind, and returns how many were removed'''
+    removed = 0
+    root = get_store_root()
+    if not os.path.isdir(root):
+        return removed
+
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if filename.endswith(Spool.SUFFIX):
+                # Uploads still being written are younger than this
+                try:
+                    if time.time() - os.path.getmtime(path) < spool_max_age:
+                        continue
+                except FileNotFoundError:
+                    continue
+            elif len(filename) != 64 or filename in referenced:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+    return removed
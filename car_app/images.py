@@ -0,0 +1,358 @@
+'''
+Module: images
+Builds the pre-sized variants of a car image that the catalog pages show,
+and takes uploaded images in.
+
+An upload is written to an image_store.Spool as the request body arrives
+(see UploadRequest), hashed on the way and cut off at UPLOAD_MAX_BYTES;
+MAX_CONTENT_LENGTH bounds the whole request. ingest_image() then checks
+the magic bytes and, from the header alone, the pixel count against
+UPLOAD_MAX_PIXELS before anything is decoded, and renames the spool into
+the store. Memory per upload stays flat whatever the file size.
+'''
+import io
+import time
+from datetime import datetime, timezone
+
+import click
+from flask import Request, Response, abort, current_app, request, send_file, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import is_resource_modified
+from PIL import Image, UnidentifiedImageError
+
+from car_app import image_store
+from car_app.db import get_db
+
+# Variant name -> longest edge in pixels. The widths are also used to build
+# the srcset attributes in the templates.
+IMAGE_SIZES = {
+    'thumb': 160,
+    'card': 400,
+    'detail': 960,
+}
+
+# Versioned image URLs never change content, so they can be cached for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Hex digits of the image hash image_url() puts in ?v=
+VERSION_LENGTH = 16
+
+# Leading bytes of the image formats the upload form accepts
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class InvalidImage(ValueError):
+    '''An upload the store does not take; the message follows "image",
+    as in "image is not a PNG, JPEG, GIF or WebP file"'''
+
+
+class UploadRequest(Request):
+    '''Request that streams uploaded files into image_store spools instead
+    of werkzeug's in-memory or anonymous temporary files'''
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        return image_store.Spool(current_app.config['UPLOAD_MAX_BYTES'])
+
+    def _load_form_data(self):
+        try:
+            super()._load_form_data()
+        except image_store.TooLarge:
+            raise RequestEntityTooLarge(
+                f'Images may be at most {format_megabytes(current_app.config["UPLOAD_MAX_BYTES"])}.')
+
+
+def format_megabytes(size):
+    return f'{size / (1024 * 1024):g} MB'
+
+
+def sniff_content_type(image_data):
+    '''Returns the MIME type of the image from its magic bytes, or None'''
+    for magic, content_type in MAGIC_NUMBERS:
+        if image_data.startswith(magic):
+            return content_type
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def store_original(image_data):
+    '''Writes an uploaded image to the image store and returns the columns
+    kept on the car row in its place'''
+    return {
+        'image_type': sniff_content_type(image_data),
+        'image_hash': image_store.put(image_data),
+        'image_updated': int(time.time()),
+    }
+
+
+def make_variants(image):
+    '''Returns {size: (content_type, data)} for every size in IMAGE_SIZES,
+    or None when image, its bytes or a file path, is not an image Pillow
+    can read'''
+    variants = {}
+    try:
+        original = Image.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+        # JPEGs are decoded straight at the smallest scale that still
+        # covers the largest variant, a fraction of the full pixels
+        largest = max(IMAGE_SIZES.values())
+        original.draft(None, (largest, largest))
+        original.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+
+    with original:
+        has_alpha = original.mode in ('RGBA', 'LA') or (
+            original.mode == 'P' and 'transparency' in original.info)
+        source = original.convert('RGBA' if has_alpha else 'RGB')
+
+    for size, edge in IMAGE_SIZES.items():
+        variant = source.copy()
+        # thumbnail() keeps the aspect ratio and never upscales
+        variant.thumbnail((edge, edge), Image.LANCZOS)
+        buffer = io.BytesIO()
+        variant.save(buffer, 'WEBP', quality=80, method=4)
+        variants[size] = ('image/webp', buffer.getvalue())
+
+    return variants
+
+
+def ingest_image(stream):
+    '''Checks an uploaded image and moves it into the image store. stream
+    is the spool UploadRequest wrote a form upload to, or any open binary
+    file, which is spooled first. Returns (the columns kept on the car
+    row, variants as make_variants returns them); raises InvalidImage.'''
+    config = current_app.config
+    try:
+        if isinstance(stream, image_store.Spool):
+            upload = stream
+        else:
+            upload = image_store.spool(stream, config['UPLOAD_MAX_BYTES'],
+                                       config['UPLOAD_CHUNK_SIZE'])
+    except image_store.TooLarge:
+        raise InvalidImage(f'is larger than {format_megabytes(config["UPLOAD_MAX_BYTES"])}')
+
+    try:
+        upload.seek(0)
+        content_type = sniff_content_type(upload.read(16))
+        if content_type is None:
+            raise InvalidImage('is not a PNG, JPEG, GIF or WebP file')
+
+        max_pixels = config['UPLOAD_MAX_PIXELS']
+        too_many_pixels = InvalidImage(f'has more than {max_pixels / 1e6:g} megapixels')
+        # open() reads the header only, the pixels stay on disk
+        try:
+            with Image.open(upload.path) as header:
+                width, height = header.size
+        except Image.DecompressionBombError:
+            raise too_many_pixels
+        except (UnidentifiedImageError, OSError):
+            raise InvalidImage('cannot be decoded')
+        if max_pixels and width * height > max_pixels:
+            raise too_many_pixels
+
+        variants = make_variants(upload.path)
+        if variants is None:
+            raise InvalidImage('cannot be decoded')
+        metadata = {
+            'image_type': content_type,
+            'image_hash': upload.commit(),
+            'image_updated': int(time.time()),
+        }
+    finally:
+        upload.close()
+    return metadata, variants
+
+
+def store_variants(variants):
+    '''Writes the variants to the image store and returns
+    [(size, content_type, image_hash)], ready for car_image rows'''
+    return [(size, content_type, image_store.put(data))
+            for size, (content_type, data) in variants.items()]
+
+
+def save_variants(db, car_id, variants):
+    '''Stores the variants of a car and replaces their rows, the caller commits'''
+    save_variant_rows(db, car_id, store_variants(variants))
+
+
+def save_variant_rows(db, car_id, stored):
+    '''Replaces the car_image rows of a car with those of variants already
+    stored by store_variants, the caller commits'''
+    db.execute('DELETE FROM car_image WHERE car_id = ?', (car_id,))
+    db.executemany(
+        'INSERT INTO car_image (car_id, size, content_type, image_hash)'
+        ' VALUES (?, ?, ?, ?)',
+        [(car_id, *row) for row in stored]
+    )
+
+
+def image_response(image_hash, version, updated, content_type):
+    '''Serves a stored image. Conditional requests are answered with 304
+    from the database row alone; otherwise the file is handed to the web
+    server (X-Accel-Redirect) or to send_file, so the bytes never go
+    through Python'''
+    if image_hash is None:
+        abort(404)
+    if updated:
+        updated = datetime.fromtimestamp(updated, timezone.utc)
+
+    accel_prefix = current_app.config.get('IMAGE_ACCEL_REDIRECT')
+    if not is_resource_modified(request.environ, etag=image_hash, last_modified=updated):
+        response = Response(status=304)
+    elif accel_prefix:
+        # nginx serves the file itself from an internal location
+        response = Response(content_type=content_type)
+        response.headers['X-Accel-Redirect'] = '/'.join(
+            (accel_prefix.rstrip('/'), image_store.relative_path(image_hash)))
+    else:
+        try:
+            response = send_file(image_store.path_for(image_hash),
+                                 mimetype=content_type, conditional=False, etag=False)
+        except FileNotFoundError:
+            abort(404)
+
+    response.set_etag(image_hash)
+    if updated:
+        response.last_modified = updated
+
+    # Only the exact version image_url() emits: a shorter prefix that
+    # happens to match would pin the image once it changes
+    requested_version = request.args.get('v')
+    if version and requested_version == version[:VERSION_LENGTH]:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Unversioned URLs still revalidate cheaply through the ETag
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.cache_control.max_age = None
+
+    return response
+
+
+def image_url(car_id, version, size=None):
+    '''URL of a car image, versioned so it can be cached as immutable'''
+    if version:
+        return url_for('uploaded_image', car_id=car_id, size=size, v=version[:VERSION_LENGTH])
+    return url_for('uploaded_image', car_id=car_id, size=size)
+
+
+def image_srcset(car_id, version):
+    '''srcset value listing every variant of a car image'''
+    return ', '.join(
+        f'{image_url(car_id, version, size)} {edge}w'
+        for size, edge in IMAGE_SIZES.items()
+    )
+
+
+@click.command('build-image-variants')
+def build_image_variants_command():
+    """Generate the resized variants for cars that do not have them yet."""
+    db = get_db()
+    cars = db.execute(
+        'SELECT id, image_hash FROM car'
+        ' WHERE image_hash IS NOT NULL'
+        ' AND id NOT IN (SELECT car_id FROM car_image)'
+    ).fetchall()
+
+    built = 0
+    for car in cars:
+        # One image at a time so a large fleet never sits in memory at once
+        variants = make_variants(image_store.read(car['image_hash']))
+        if variants is not None:
+            save_variants(db, car['id'], variants)
+            db.commit()
+            built += 1
+
+    click.echo(f'Built image variants for {built} cars.')
+
+
+def move_images_to_store(db):
+    '''Moves the image BLOBs of the car table into the image store and
+    drops the column, inside the caller's transaction. Returns the number
+    of images moved, None when there was no BLOB column left.'''
+    car_columns = {row['name'] for row in db.execute('PRAGMA table_info(car)')}
+    if 'image' not in car_columns:
+        return None
+
+    for column, column_type in (('image_type', 'TEXT'), ('image_hash', 'TEXT'),
+                                ('image_updated', 'INTEGER')):
+        if column not in car_columns:
+            db.execute(f'ALTER TABLE car ADD COLUMN {column} {column_type}')
+
+    # Variants are rebuilt from the originals, so the old table can go
+    db.execute('DROP TABLE IF EXISTS car_image')
+    db.execute(
+        'CREATE TABLE car_image ('
+        ' car_id INTEGER NOT NULL,'
+        ' size TEXT NOT NULL,'
+        ' content_type TEXT NOT NULL,'
+        ' image_hash TEXT NOT NULL,'
+        ' PRIMARY KEY (car_id, size),'
+        ' FOREIGN KEY (car_id) REFERENCES car (id))'
+    )
+
+    moved = 0
+    car_ids = [row['id'] for row in db.execute('SELECT id FROM car').fetchall()]
+    for car_id in car_ids:
+        image_data = db.execute(
+            'SELECT image FROM car WHERE id = ?', (car_id,)).fetchone()['image']
+        if not image_data:
+            continue
+
+        metadata = store_original(image_data)
+        db.execute(
+            'UPDATE car SET image_type = ?, image_hash = ?, image_updated = ?'
+            ' WHERE id = ?',
+            (metadata['image_type'], metadata['image_hash'],
+             metadata['image_updated'], car_id)
+        )
+        variants = make_variants(image_data)
+        if variants is not None:
+            save_variants(db, car_id, variants)
+        moved += 1
+
+    db.execute('ALTER TABLE car DROP COLUMN image')
+    return moved
+
+
+@click.command('migrate-images')
+def migrate_images_command():
+    """Move image BLOBs out of the database into the image store."""
+    db = get_db()
+    moved = move_images_to_store(db)
+    if moved is None:
+        click.echo('Car images are already in the image store.')
+        return
+
+    db.commit()
+    # Give the space the BLOBs used back to the file system
+    db.execute('VACUUM')
+    click.echo(f'Moved {moved} car images into the image store.')
+
+
+@click.command('prune-images')
+def prune_images_command():
+    """Delete stored image files that no car refers to any more."""
+    db = get_db()
+    referenced = {row[0] for row in db.execute(
+        'SELECT image_hash FROM car WHERE image_hash IS NOT NULL'
+        ' UNION SELECT image_hash FROM car_image')}
+    removed = image_store.prune(referenced)
+    click.echo(f'Removed {removed} unreferenced image files.')
+
+
+def init_app(app):
+    app.request_class = UploadRequest
+    app.jinja_env.globals['image_url'] = image_url
+    app.jinja_env.globals['image_srcset'] = image_srcset
+    app.cli.add_command(build_image_variants_command)
+    app.cli.add_command(migrate_images_command)
+    app.cli.add_command(prune_images_command)
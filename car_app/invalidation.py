@@ -0,0 +1,208 @@
+'''
+Module: invalidation
+Keeps the in-process caches of every worker in step with the writes of
+all workers.
+
+A worker caches rows it read, such as the logged in customers of
+customer.py, and a write made by another worker process never reaches
+that cache. The triggers of changes.sql add an entry to change_log for
+every car, customer and booking row written, inside the writing
+transaction. sync() reads the log from where this process stopped and
+hands the ids of the changed rows to the evict functions that caches
+registered with subscribe(). Caches call sync() before answering; it
+runs once per request.
+
+Most requests come after no write at all, so sync() first asks SQLite
+whether anything changed: PRAGMA data_version moves when another
+connection commits, total_changes when this one writes. If neither moved
+since this thread last looked, the log is not read. PostgreSQL has
+neither, so there every sync() runs the indexed log query.
+
+PostgreSQL hands out sequence numbers before commit, so a lower number
+can commit after a higher one was read. Numbers skipped over are looked
+for again until CHANGE_LOG_GAP_TIMEOUT seconds have passed. When more
+than CHANGE_LOG_MAX_READ changes are waiting, or entries this process
+had not read yet were trimmed, every subscribed cache is cleared.
+'''
+import threading
+import time
+
+import click
+from flask import current_app, g
+
+from car_app.db import get_db, get_dialect, immediate_transaction
+
+# Most gaps a process keeps looking for before it clears its caches
+MAX_GAPS = 100
+
+# table name -> evict functions, see subscribe()
+_subscribers = {}
+
+# How far this process has read the log, per database
+_positions = {}
+_positions_lock = threading.Lock()
+
+# What each thread's connection looked like when the thread last looked
+_local = threading.local()
+
+
+def subscribe(table, evict):
+    '''Registers evict(row_ids) to be called with the ids of the rows of
+    table ('car', 'customer' or 'booking') written since the last sync(),
+    or with None when the cache should drop everything. It is called in
+    the app context of the database the rows belong to.'''
+    _subscribers.setdefault(table, []).append(evict)
+
+
+class LogPosition:
+    '''How far a process has read the change log of one database'''
+
+    def __init__(self, seq):
+        self.seq = seq
+        # [first, last, expires] ranges of numbers skipped over that may
+        # still commit
+        self.gaps = []
+
+    def conditions(self):
+        '''WHERE clause and parameters matching the entries not read yet'''
+        clauses, parameters = ['seq > ?'], [self.seq]
+        for first, last, _ in self.gaps:
+            clauses.append('seq BETWEEN ? AND ?')
+            parameters += [first, last]
+        return ' OR '.join(clauses), parameters
+
+    def oldest_wanted(self):
+        return min([gap[0] for gap in self.gaps] + [self.seq + 1])
+
+    def take(self, seq, expires):
+        '''Marks seq as read, False if it had been read already'''
+        if seq > self.seq:
+            if seq > self.seq + 1:
+                self.gaps.append([self.seq + 1, seq - 1, expires])
+            self.seq = seq
+            return True
+        for gap in self.gaps:
+            if gap[0] <= seq <= gap[1]:
+                self.gaps.remove(gap)
+                self.gaps.extend(part for part in ([gap[0], seq - 1, gap[2]],
+                                                   [seq + 1, gap[1], gap[2]])
+                                 if part[0] <= part[1])
+                return True
+        return False
+
+    def expire(self, now):
+        self.gaps = [gap for gap in self.gaps if gap[2] > now]
+
+
+def database_key():
+    config = current_app.config
+    return config['DATABASE_URL'] or config['DATABASE']
+
+
+def last_seq(db):
+    return db.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+
+
+def changed(db):
+    '''False when no connection wrote to the database since this thread
+    last asked. Always True on PostgreSQL.'''
+    if get_dialect() == 'postgresql':
+        return True
+    state = (id(db), db.execute('PRAGMA data_version').fetchone()[0], db.total_changes)
+    seen = getattr(_local, 'seen', None)
+    if seen is None:
+        seen = _local.seen = {}
+    key = database_key()
+    if seen.get(key) == state:
+        return False
+    seen[key] = state
+    return True
+
+
+def sync():
+    '''Evicts the rows written since this process last looked from the
+    subscribed caches. Runs once per request, cheap when nothing changed.'''
+    if not _subscribers or g.get('_changes_synced'):
+        return
+    g._changes_synced = True
+
+    db = get_db()
+    if not changed(db):
+        return
+
+    config = current_app.config
+    key = database_key()
+    changes = {}
+    with _positions_lock:
+        position = _positions.get(key)
+        if position is None:
+            # Nothing was cached before the first look
+            _positions[key] = LogPosition(last_seq(db))
+            return
+
+        where, parameters = position.conditions()
+        rows = db.execute(
+            f'SELECT seq, table_name, row_id FROM change_log WHERE {where}'
+            ' ORDER BY seq LIMIT ?',
+            (*parameters, config['CHANGE_LOG_MAX_READ'] + 1)
+        ).fetchall()
+        if not rows:
+            return
+
+        oldest = db.execute('SELECT MIN(seq) FROM change_log').fetchone()[0]
+        clear = (len(rows) > config['CHANGE_LOG_MAX_READ']
+                 or (oldest is not None and position.oldest_wanted() < oldest))
+        if not clear:
+            now = time.monotonic()
+            expires = now + config['CHANGE_LOG_GAP_TIMEOUT']
+            for seq, table, row_id in rows:
+                if position.take(seq, expires):
+                    changes.setdefault(table, set()).add(row_id)
+            position.expire(now)
+            clear = len(position.gaps) > MAX_GAPS
+        if clear:
+            _positions[key] = LogPosition(last_seq(db))
+
+    if clear:
+        for functions in _subscribers.values():
+            for evict in functions:
+                evict(None)
+        return
+    for table, row_ids in changes.items():
+        for evict in _subscribers.get(table, ()):
+            evict(row_ids)
+
+
+def install_change_log(db):
+    '''Creates the change log and its triggers if they are missing. On
+    PostgreSQL they are part of schema_postgresql.sql.'''
+    if get_dialect() == 'postgresql':
+        return
+    with current_app.open_resource('changes.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+
+
+def trim_change_log(db, keep=None):
+    '''Drops all but the newest keep (CHANGE_LOG_KEEP) entries, inside the
+    caller's transaction. Returns how many were dropped.'''
+    if keep is None:
+        keep = current_app.config['CHANGE_LOG_KEEP']
+    # The newest entry always stays: a process that had not read up to it
+    # finds it after the older ones and learns they were dropped. An empty
+    # log would look like nothing had changed.
+    keep = max(keep, 1)
+    return db.execute('DELETE FROM change_log WHERE seq <= ?',
+                      (last_seq(db) - keep,)).rowcount
+
+
+@click.command('trim-change-log')
+@click.option('--keep', type=int, default=None,
+              help='Newest entries to keep (CHANGE_LOG_KEEP by default).')
+def trim_change_log_command(keep):
+    """Drop old entries of the cache invalidation change log."""
+    dropped = immediate_transaction(lambda db: trim_change_log(db, keep))
+    click.echo(f'Dropped {dropped} change log entries.')
+
+
+def init_app(app):
+    app.cli.add_command(trim_change_log_command)
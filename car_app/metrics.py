@@ -0,0 +1,430 @@
+'''
+Module: metrics
+Request, SQL and template timings, exposed on /metrics in the Prometheus
+text format.
+
+Every worker process counts into its own registry and writes it to
+METRICS_DIR/<pid>.json at most every METRICS_FLUSH_INTERVAL seconds. The
+/metrics view adds up the files of all workers, so whichever worker
+answers the scrape reports the whole host. Files of workers that have
+exited are folded into archive.json first, which keeps the counters from
+going backwards when gunicorn recycles a worker.
+
+SQL is timed by the connection class db.connect() uses: execute(),
+executemany() and the fetch calls on the cursors they return. Pooled
+server connections (engine.py) are timed the same way. Statements
+slower than SLOW_QUERY_MS are logged to the car_app.slow_queries logger
+with the endpoint that ran them and the types of their parameters, never
+the values: those include emails, phone numbers and password hashes.
+
+/metrics answers clients on the loopback address, or anyone sending
+METRICS_TOKEN as a bearer token when one is set.
+'''
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import abort, current_app, g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+
+from car_app import query_plans
+
+try:
+    import fcntl
+except ImportError:  # Windows, only used for local development
+    fcntl = None
+
+slow_query_log = logging.getLogger('car_app.slow_queries')
+
+HISTOGRAM_BUCKETS = {
+    'car_app_request_duration_seconds':
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'car_app_response_size_bytes':
+        (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+    'car_app_request_sql_queries':
+        (0, 1, 2, 3, 5, 10, 20, 50, 100),
+    'car_app_request_sql_seconds':
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+    'car_app_template_render_seconds':
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+}
+
+METRIC_HELP = {
+    'car_app_requests_total': ('counter', 'Requests handled.'),
+    'car_app_request_duration_seconds': ('histogram', 'Time from the start of a request to its response.'),
+    'car_app_response_size_bytes': ('histogram', 'Response body size, when known up front.'),
+    'car_app_request_sql_queries': ('histogram', 'SQL statements run per request.'),
+    'car_app_request_sql_seconds': ('histogram', 'Time spent in SQL per request.'),
+    'car_app_sql_queries_total': ('counter', 'SQL statements run.'),
+    'car_app_sql_seconds_total': ('counter', 'Time spent in SQL.'),
+    'car_app_slow_queries_total': ('counter', 'SQL statements slower than SLOW_QUERY_MS.'),
+    'car_app_template_render_seconds': ('histogram', 'Time spent rendering a template.'),
+    'car_app_cache_hits_total': ('counter', 'Cache lookups that found an entry.'),
+    'car_app_cache_misses_total': ('counter', 'Cache lookups that found nothing.'),
+}
+
+
+class Registry:
+    '''Counters and histograms of one worker process'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flushed = 0
+
+    @staticmethod
+    def key(name, labels):
+        return json.dumps([name, sorted(labels.items())])
+
+    def inc(self, name, labels, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAM_BUCKETS[name]
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(buckets), 'sum': 0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: {'buckets': list(h['buckets']), 'sum': h['sum'],
+                                     'count': h['count']}
+                               for key, h in self.histograms.items()},
+            }
+
+
+_registry = None
+_registry_pid = None
+
+
+def get_registry():
+    '''This process's registry; a forked worker starts an empty one'''
+    global _registry, _registry_pid
+    if _registry is None or _registry_pid != os.getpid():
+        _registry = Registry()
+        _registry_pid = os.getpid()
+    return _registry
+
+
+def request_stats():
+    '''SQL and template totals of the current request, None outside one'''
+    if not has_request_context():
+        return None
+    stats = g.get('_metrics')
+    if stats is None:
+        stats = g._metrics = {'queries': 0, 'sql_seconds': 0.0, 'templates': []}
+    return stats
+
+
+def describe_parameters(parameters):
+    '''The types of a statement's bind parameters, for the log'''
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {type(value).__name__}'
+                               for name, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return str(parameters)
+
+
+class StatementTimer:
+    '''Times a cursor's statements into the request totals and logs the
+    slow ones. Shared by TimedCursor and the pooled server connections
+    of engine.py.'''
+
+    def _start(self, sql, parameters):
+        self._sql, self._params, self._elapsed, self._logged = sql, parameters, 0.0, False
+        stats = request_stats()
+        if stats is not None:
+            stats['queries'] += 1
+        return stats
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._record(time.perf_counter() - started)
+
+    def _record(self, elapsed):
+        stats = request_stats()
+        if stats is not None:
+            stats['sql_seconds'] += elapsed
+        self._elapsed = getattr(self, '_elapsed', 0.0) + elapsed
+        threshold = current_app.config['SLOW_QUERY_MS'] if stats is not None else None
+        if threshold is not None and not getattr(self, '_logged', False) \
+                and self._elapsed * 1000 >= threshold:
+            self._logged = True
+            get_registry().inc('car_app_slow_queries_total',
+                               {'endpoint': request.endpoint or 'unknown'})
+            slow_query_log.warning(
+                'slow query %.1f ms on %s: %s params=%s',
+                self._elapsed * 1000, request.endpoint, ' '.join(self._sql.split()),
+                describe_parameters(self._params))
+
+
+class TimedCursor(StatementTimer, sqlite3.Cursor):
+    '''Adds the time spent executing and fetching to the request totals'''
+
+    def execute(self, sql, parameters=()):
+        if self._start(sql, parameters) is not None \
+                and current_app.config['QUERY_PLAN_AUDIT'] and query_plans.is_audited():
+            query_plans.check_plan(self.connection, sql, parameters)
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql, '(many)')
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._timed(super().fetchmany)
+        return self._timed(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''Connection whose shortcut methods go through TimedCursor. Rows read
+    by iterating a cursor are not timed, so streamed exports cost nothing
+    extra per row.'''
+
+    def execute(self, sql, parameters=()):
+        return self.cursor(TimedCursor).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor(TimedCursor).executemany(sql, seq_of_parameters)
+
+
+def start_request():
+    g._metrics_started = time.perf_counter()
+
+
+def finish_request(response):
+    started = g.get('_metrics_started')
+    if started is None:
+        return response
+    registry = get_registry()
+    endpoint = request.endpoint or 'unknown'
+    labels = {'endpoint': endpoint, 'method': request.method}
+
+    registry.inc('car_app_requests_total', dict(labels, status=str(response.status_code)))
+    registry.observe('car_app_request_duration_seconds', labels,
+                     time.perf_counter() - started)
+    if response.content_length is not None:
+        registry.observe('car_app_response_size_bytes', {'endpoint': endpoint},
+                         response.content_length)
+
+    stats = request_stats()
+    registry.observe('car_app_request_sql_queries', {'endpoint': endpoint}, stats['queries'])
+    registry.observe('car_app_request_sql_seconds', {'endpoint': endpoint}, stats['sql_seconds'])
+    registry.inc('car_app_sql_queries_total', {'endpoint': endpoint}, stats['queries'])
+    registry.inc('car_app_sql_seconds_total', {'endpoint': endpoint}, stats['sql_seconds'])
+
+    if time.monotonic() - registry.flushed >= current_app.config['METRICS_FLUSH_INTERVAL']:
+        flush(current_app)
+    return response
+
+
+def template_started(app, template, context, **extra):
+    stats = request_stats()
+    if stats is not None:
+        stats['templates'].append(time.perf_counter())
+
+
+def template_finished(app, template, context, **extra):
+    stats = request_stats()
+    if stats is not None and stats['templates']:
+        get_registry().observe('car_app_template_render_seconds',
+                               {'template': template.name or 'unknown'},
+                               time.perf_counter() - stats['templates'].pop())
+
+
+def get_metrics_dir(app):
+    return app.config['METRICS_DIR'] or os.path.join(app.instance_path, 'metrics')
+
+
+def write_json(path, data):
+    '''Atomic write, a reader never sees half a file'''
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_cache_stats(app, registry):
+    '''Copies the cache counters into the registry before a flush'''
+    cache = app.extensions.get('catalog_cache')
+    if cache is None:
+        return
+    with registry.lock:
+        for name, value in (('car_app_cache_hits_total', cache.hits),
+                            ('car_app_cache_misses_total', cache.misses)):
+            registry.counters[registry.key(name, {'cache': 'catalog'})] = value
+
+
+def flush(app):
+    '''Writes this worker's metrics to its file in METRICS_DIR'''
+    registry = get_registry()
+    registry.flushed = time.monotonic()
+    add_cache_stats(app, registry)
+    directory = get_metrics_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    write_json(os.path.join(directory, f'{os.getpid()}.json'), registry.snapshot())
+
+
+def merge(total, snapshot):
+    for key, value in snapshot['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for key, histogram in snapshot['histograms'].items():
+        merged = total['histograms'].get(key)
+        if merged is None:
+            total['histograms'][key] = {'buckets': list(histogram['buckets']),
+                                        'sum': histogram['sum'], 'count': histogram['count']}
+            continue
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+        merged['sum'] += histogram['sum']
+        merged['count'] += histogram['count']
+    return total
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect(app):
+    '''Sum of the metrics of every worker, live or gone'''
+    directory = get_metrics_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, 'archive.lock'), 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        archive_path = os.path.join(directory, 'archive.json')
+        archive = read_json(archive_path) or {'counters': {}, 'histograms': {}}
+        total = merge({'counters': {}, 'histograms': {}}, archive)
+        archived = False
+        for name in os.listdir(directory):
+            stem, extension = os.path.splitext(name)
+            if extension != '.json' or not stem.isdigit():
+                continue
+            snapshot = read_json(os.path.join(directory, name))
+            if snapshot is None:
+                continue
+            merge(total, snapshot)
+            if not pid_alive(int(stem)):
+                merge(archive, snapshot)
+                os.unlink(os.path.join(directory, name))
+                archived = True
+        if archived:
+            write_json(archive_path, archive)
+        return total
+    finally:
+        lock_file.close()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render(total):
+    '''Prometheus text exposition format'''
+    series = {}
+    for key, value in total['counters'].items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, value))
+    for key, histogram in total['histograms'].items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, histogram))
+
+    lines = []
+    for name in sorted(series):
+        metric_type, help_text = METRIC_HELP.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            labels = [tuple(label) for label in labels]
+            if metric_type != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS[name], value['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels + [("le", "+Inf")])} {value["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def scrape_allowed():
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        sent = request.headers.get('Authorization', '')
+        return hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode())
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def metrics_view():
+    if not scrape_allowed():
+        abort(403)
+    flush(current_app)
+    return current_app.response_class(
+        render(collect(current_app)), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,360 @@
+'''
+Module: migrations
+In place schema upgrades, tracked in PRAGMA user_version.
+
+    flask migrate            apply every pending migration
+    flask migrate --status   list them without applying anything
+
+schema.sql always describes the newest schema and init-db stamps a fresh
+database with the newest version. Databases from before this module are
+at version 0 and may have any of the hand made changes the README used
+to list, so every migration checks what is there before changing it.
+
+Each migration runs in its own BEGIN IMMEDIATE transaction together with
+the version bump: a failed migration leaves the database as it was.
+
+Migrations are SQLite only. A PostgreSQL database (DATABASE_URL) is
+created by init-db from schema_postgresql.sql at the newest schema.
+'''
+import sqlite3
+import time
+
+import click
+from flask import current_app
+
+from car_app.cache import bump_catalog_version
+from car_app.db import get_db, get_dialect, immediate_transaction
+from car_app.images import move_images_to_store
+from car_app.occupancy import fill_occupancy
+from car_app.stats import fill_stats
+
+MIGRATIONS = []
+
+
+def migration(function):
+    '''Adds function(db) as the next migration, its docstring is the
+    description. It may return a note for the person running it.'''
+    MIGRATIONS.append(function)
+    return function
+
+
+def latest_version():
+    return len(MIGRATIONS)
+
+
+def get_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def run_script(db, script):
+    '''Runs every statement of an SQL script inside the current transaction.
+    executescript() would commit first.'''
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            db.execute(statement)
+            statement = ''
+    if statement.strip():
+        db.execute(statement)
+
+
+def run_resource(db, name):
+    with current_app.open_resource(name) as f:
+        run_script(db, f.read().decode('utf8'))
+
+
+def table_exists(db, table):
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def columns(db, table):
+    '''{column name: declared type, with NOT NULL when the column has it}'''
+    return {row['name']: row['type'] + (' NOT NULL' if row['notnull'] else '')
+            for row in db.execute(f'PRAGMA table_info({table})')}
+
+
+def rebuild_table(db, table, create_sql, select_list):
+    '''Recreates table from create_sql (with the table name as {name}) and
+    copies the rows over through select_list. Indexes and triggers on the
+    old table are dropped with it; the migrations after this one create
+    them again. The AUTOINCREMENT counter is carried over so deleted ids
+    are never handed out again.'''
+    sequence = db.execute(
+        'SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    db.execute(create_sql.format(name=f'{table}_new'))
+    db.execute(f'INSERT INTO {table}_new SELECT {select_list} FROM {table}')
+    db.execute(f'DROP TABLE {table}')
+    db.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    if sequence is not None:
+        db.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?',
+                   (sequence[0], table))
+
+
+@migration
+def move_images_and_add_price(db):
+    '''Car images in the image store, price column on every car'''
+    notes = []
+    moved = move_images_to_store(db)
+    if moved is not None:
+        notes.append(f'moved {moved} car images into the image store,'
+                     ' VACUUM the database to give their space back')
+    if 'price' not in columns(db, 'car'):
+        db.execute("ALTER TABLE car ADD COLUMN price TEXT NOT NULL DEFAULT ''")
+        notes.append('added car.price, set the prices of the existing cars')
+    elif db.execute("SELECT 1 FROM car WHERE price IS NULL OR price = '' LIMIT 1").fetchone():
+        notes.append('some cars have no price, set them')
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS car_image ('
+        ' car_id INTEGER NOT NULL,'
+        ' size TEXT NOT NULL,'
+        ' content_type TEXT NOT NULL,'
+        ' image_hash TEXT NOT NULL,'
+        ' PRIMARY KEY (car_id, size),'
+        ' FOREIGN KEY (car_id) REFERENCES car (id))'
+    )
+    return '; '.join(notes) or None
+
+
+@migration
+def add_catalog_tables(db):
+    '''Catalog version, car change_seq and tombstones, booking archive'''
+    if not table_exists(db, 'catalog_version'):
+        db.execute('CREATE TABLE catalog_version (version INTEGER NOT NULL)')
+        db.execute('INSERT INTO catalog_version (version) VALUES (0)')
+    if 'change_seq' not in columns(db, 'car'):
+        db.execute('ALTER TABLE car ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0')
+    db.execute('CREATE TABLE IF NOT EXISTS car_tombstone ('
+               ' car_id INTEGER PRIMARY KEY, change_seq INTEGER NOT NULL)')
+    db.execute('CREATE TABLE IF NOT EXISTS booking_archive ('
+               ' id INTEGER PRIMARY KEY,'
+               ' customer_id INTEGER NOT NULL,'
+               ' car_id INTEGER NOT NULL,'
+               ' start_date DATE NOT NULL,'
+               ' end_date DATE NOT NULL,'
+               ' archived_at TIMESTAMP NOT NULL)')
+
+
+@migration
+def fix_declared_types(db):
+    '''car.price, customer.role and booking dates declared as in schema.sql'''
+    if columns(db, 'car')['price'] != 'TEXT NOT NULL':
+        # price was added by hand to some databases, nullable and last
+        rebuild_table(
+            db, 'car',
+            'CREATE TABLE {name} ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' name TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' seat INTEGER NOT NULL,'
+            ' door INTEGER NOT NULL,'
+            ' gearbox TEXT NOT NULL,'
+            ' image_type TEXT,'
+            ' image_hash TEXT NOT NULL,'
+            ' image_updated INTEGER,'
+            ' price TEXT NOT NULL,'
+            ' change_seq INTEGER NOT NULL DEFAULT 0)',
+            "id, name, model, status, seat, door, gearbox, image_type,"
+            " COALESCE(image_hash, ''), image_updated, COALESCE(price, ''), change_seq"
+        )
+
+    if columns(db, 'customer')['role'] != 'INTEGER NOT NULL':
+        rebuild_table(
+            db, 'customer',
+            'CREATE TABLE {name} ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' name TEXT NOT NULL,'
+            ' last_name TEXT NOT NULL,'
+            ' phone_number TEXT NOT NULL,'
+            ' email TEXT NOT NULL UNIQUE,'
+            ' password TEXT NOT NULL,'
+            ' role INTEGER NOT NULL DEFAULT 0)',
+            'id, name, last_name, phone_number, email, password,'
+            ' COALESCE(CAST(role AS INTEGER), 0)'
+        )
+
+    booking_columns = columns(db, 'booking')
+    if (booking_columns['start_date'], booking_columns['end_date']) != ('DATE NOT NULL',) * 2:
+        # TIMESTAMP columns may hold '2024-05-01 00:00:00', which the DATE
+        # converter cannot read, so the values are cut down to the day
+        rebuild_table(
+            db, 'booking',
+            'CREATE TABLE {name} ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' customer_id INTEGER NOT NULL,'
+            ' car_id INTEGER NOT NULL,'
+            ' start_date DATE NOT NULL,'
+            ' end_date DATE NOT NULL,'
+            ' FOREIGN KEY (customer_id) REFERENCES customer (id),'
+            ' FOREIGN KEY (car_id) REFERENCES car (id))',
+            'id, customer_id, car_id, date(start_date), date(end_date)'
+        )
+
+
+@migration
+def add_stats(db):
+    '''Dashboard statistics tables and their triggers'''
+    new = not table_exists(db, 'stats_counter')
+    run_resource(db, 'stats.sql')
+    if new:
+        fill_stats(db)
+
+
+@migration
+def add_search(db):
+    '''Fleet search index and its triggers'''
+    new = not table_exists(db, 'car_search')
+    run_resource(db, 'search.sql')
+    if new:
+        db.execute("INSERT INTO car_search (car_search) VALUES ('rebuild')")
+
+
+@migration
+def add_query_indexes(db):
+    '''Indexes behind the catalog, booking, customer and sweeper queries'''
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS car_name ON car (name)',
+        'CREATE INDEX IF NOT EXISTS car_change_seq ON car (change_seq, id)',
+        'CREATE INDEX IF NOT EXISTS car_tombstone_change_seq ON car_tombstone (change_seq)',
+        'CREATE INDEX IF NOT EXISTS customer_role_name ON customer (role, name)',
+        'CREATE INDEX IF NOT EXISTS booking_car_dates ON booking (car_id, end_date, start_date)',
+        'CREATE INDEX IF NOT EXISTS booking_start_date ON booking (start_date)',
+        'CREATE INDEX IF NOT EXISTS booking_end_date ON booking (end_date)',
+        'CREATE INDEX IF NOT EXISTS booking_customer_start ON booking (customer_id, start_date)',
+    ):
+        db.execute(statement)
+
+
+@migration
+def add_change_log(db):
+    '''Change log for cache invalidation and its triggers'''
+    run_resource(db, 'changes.sql')
+
+
+@migration
+def add_pricing(db):
+    '''Booking totals, pricing version and its triggers'''
+    for table in ('booking', 'booking_archive'):
+        if 'total_price' not in columns(db, table):
+            db.execute(f'ALTER TABLE {table} ADD COLUMN total_price REAL')
+    run_resource(db, 'pricing.sql')
+
+
+@migration
+def add_occupancy(db):
+    '''Per car occupancy bitmaps, filled from the bookings'''
+    db.execute('CREATE TABLE IF NOT EXISTS occupancy ('
+               ' year INTEGER NOT NULL,'
+               ' car_id INTEGER NOT NULL,'
+               ' days BLOB NOT NULL,'
+               ' PRIMARY KEY (year, car_id))')
+    fill_occupancy(db)
+
+
+@migration
+def keep_archived_bookings_in_stats(db):
+    '''Dashboard statistics count archived bookings'''
+    # Earlier sweeps took every booking they archived out of the figures
+    db.execute('DROP TRIGGER IF EXISTS booking_stats_delete')
+    run_resource(db, 'stats.sql')
+    fill_stats(db)
+
+
+@migration
+def add_pricing_index(db):
+    '''Covering index for the daily rates of the listed cars'''
+    run_resource(db, 'pricing.sql')
+
+
+@migration
+def skip_unchanged_car_prices(db):
+    '''Car saves that keep price and status leave the pricing version alone'''
+    db.execute('DROP TRIGGER IF EXISTS car_pricing_update')
+    run_resource(db, 'pricing.sql')
+
+
+@migration
+def relist_booked_cars(db):
+    '''Cars that bookings of the old booking flow left unlisted listed again'''
+    # Booking a car used to set its status to 0 until the booking was
+    # cancelled or expired. Availability now comes from the booking dates
+    # and status is only the admin's switch, so a car at 0 with bookings
+    # would stay out of the catalog for good. Cars at 0 without bookings
+    # were unlisted by hand and stay that way.
+    booked = ' OR '.join(f'id IN (SELECT car_id FROM {table})'
+                         for table in ('booking', 'booking_archive'))
+    relisted = [row[0] for row in db.execute(
+        f"SELECT id FROM car WHERE CAST(status AS INTEGER) = 0 AND ({booked}) ORDER BY id")]
+    if not relisted:
+        return None
+    db.execute(
+        f"UPDATE car SET status = '1', change_seq = ?"
+        f" WHERE id IN ({', '.join('?' * len(relisted))})",
+        (bump_catalog_version(db), *relisted)
+    )
+    return (f"listed {len(relisted)} cars the old booking flow had left at status 0"
+            f" again (ids {', '.join(map(str, relisted))}); unlist any that were"
+            " taken off on purpose")
+
+
+@migration
+def add_booking_archive_index(db):
+    '''Index of the archived bookings by car and dates'''
+    db.execute('CREATE INDEX IF NOT EXISTS booking_archive_car_dates'
+               ' ON booking_archive (car_id, end_date, start_date)')
+
+
+def migrate(db, echo=print):
+    '''Applies the pending migrations in order, returns how many ran'''
+    applied = 0
+    for version, function in enumerate(MIGRATIONS, 1):
+        def work(db):
+            # Checked again under the write lock, another process may
+            # have migrated in the meantime
+            if get_version(db) >= version:
+                return False, None
+            note = function(db)
+            db.execute(f'PRAGMA user_version = {version}')
+            return True, note
+
+        started = time.perf_counter()
+        ran, note = immediate_transaction(work)
+        if ran:
+            applied += 1
+            echo(f'{version:3d} {function.__doc__} ({time.perf_counter() - started:.2f}s)')
+            if note:
+                echo(f'    {note}')
+    return applied
+
+
+@click.command('migrate')
+@click.option('--status', is_flag=True, help='List the migrations without applying them.')
+def migrate_command(status):
+    """Bring the database schema up to date without losing data."""
+    if get_dialect() != 'sqlite':
+        raise click.ClickException(
+            'Migrations are for SQLite databases, init-db creates a PostgreSQL'
+            ' database at the newest schema.')
+    db = get_db()
+    current = get_version(db)
+    if status:
+        for version, function in enumerate(MIGRATIONS, 1):
+            state = 'applied' if version <= current else 'pending'
+            click.echo(f'{version:3d} {state:8} {function.__doc__}')
+        return
+
+    if current > latest_version():
+        raise click.ClickException(
+            f'The database is at version {current}, newer than this code ({latest_version()}).')
+    applied = migrate(db, echo=click.echo)
+    if applied:
+        click.echo(f'Migrated the database to version {latest_version()}.')
+    else:
+        click.echo(f'The database is up to date (version {current}).')
+
+
+def init_app(app):
+    app.cli.add_command(migrate_command)
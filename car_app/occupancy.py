@@ -0,0 +1,191 @@
+'''
+Module: occupancy
+The days each car is booked, kept as one bitmap per car and year.
+
+The occupancy table has a row per year and car with a bit for every day
+of that year, January 1st first: 46 bytes, however many bookings the car
+has. Booking writes set the bits of their days in the same transaction
+(mark()); a booking moved or deleted has its days worked out again from
+the car's other bookings, which may share them. The expired booking
+sweeper leaves the bitmaps alone, so archived bookings stay on the
+calendar.
+
+A year of the whole fleet is one indexed query and one np.unpackbits
+into a (cars, days) boolean matrix, which the admin calendar and the
+utilization report add up along either axis.
+
+`flask rebuild-occupancy` recomputes the table from booking and
+booking_archive, for bookings written behind the app's back.
+'''
+import time
+from calendar import month_name
+from datetime import date, timedelta
+
+import click
+import numpy as np
+from flask import current_app
+
+from car_app.db import immediate_transaction
+
+# 366 bits, rounded up to whole bytes
+YEAR_BYTES = 46
+
+
+def year_length(year):
+    return (date(year + 1, 1, 1) - date(year, 1, 1)).days
+
+
+def unpack(days):
+    '''The bits of a stored bitmap, one uint8 per day'''
+    return np.unpackbits(np.frombuffer(bytes(days), dtype=np.uint8))
+
+
+def pack(bits):
+    return np.packbits(bits).tobytes()
+
+
+def year_pieces(start_date, end_date):
+    '''(year, index of the first day, index of the last day) for every year
+    the range touches'''
+    for year in range(start_date.year, end_date.year + 1):
+        first = max(start_date, date(year, 1, 1))
+        last = min(end_date, date(year, 12, 31))
+        yield year, first.timetuple().tm_yday - 1, last.timetuple().tm_yday - 1
+
+
+def bookings_within(db, car_id, start_date, end_date):
+    '''(start date, end date) of the car's bookings, current and archived,
+    overlapping the range'''
+    for table in ('booking', 'booking_archive'):
+        yield from db.execute(
+            f'SELECT start_date, end_date FROM {table}'
+            ' WHERE car_id = ? AND end_date >= ? AND start_date <= ?',
+            (car_id, start_date.isoformat(), end_date.isoformat())
+        ).fetchall()
+
+
+def mark(db, car_id, start_date, end_date, booked=True):
+    '''Sets the car's bits for the range, inside the caller's transaction.
+    With booked=False, called once the booking was moved or deleted, the
+    range is worked out again from the bookings left on it.'''
+    others = [] if booked else list(bookings_within(db, car_id, start_date, end_date))
+    for year, first, last in year_pieces(start_date, end_date):
+        row = db.execute('SELECT days FROM occupancy WHERE year = ? AND car_id = ?',
+                         (year, car_id)).fetchone()
+        bits = unpack(row[0]) if row else np.zeros(YEAR_BYTES * 8, dtype=np.uint8)
+        bits[first:last + 1] = booked
+        for other_start, other_end in others:
+            for other_year, other_first, other_last in year_pieces(other_start, other_end):
+                if other_year == year:
+                    bits[max(first, other_first):min(last, other_last) + 1] = 1
+        db.execute(
+            'INSERT INTO occupancy (year, car_id, days) VALUES (?, ?, ?)'
+            ' ON CONFLICT (year, car_id) DO UPDATE SET days = excluded.days',
+            (year, car_id, pack(bits))
+        )
+
+
+def fill_occupancy(db):
+    '''Recomputes every bitmap from booking and booking_archive, inside the
+    caller's transaction. Returns how many there are.'''
+    db.execute('DELETE FROM occupancy')
+    bitmaps = {}
+    for table in ('booking', 'booking_archive'):
+        for car_id, start_date, end_date in db.execute(
+                f'SELECT car_id, start_date, end_date FROM {table}'
+                ' WHERE car_id IN (SELECT id FROM car)'):
+            for year, first, last in year_pieces(start_date, end_date):
+                bits = bitmaps.get((year, car_id))
+                if bits is None:
+                    bits = bitmaps[year, car_id] = np.zeros(YEAR_BYTES * 8, dtype=np.uint8)
+                bits[first:last + 1] = 1
+    db.executemany(
+        'INSERT INTO occupancy (year, car_id, days) VALUES (?, ?, ?)',
+        ((year, car_id, pack(bits)) for (year, car_id), bits in bitmaps.items())
+    )
+    return len(bitmaps)
+
+
+def year_matrix(db, year, car_ids):
+    '''Boolean matrix of the cars (car_ids, sorted) by the days of the
+    year, True where the car is booked'''
+    rows = db.execute('SELECT car_id, days FROM occupancy WHERE year = ?', (year,)).fetchall()
+    packed = np.zeros((len(car_ids), YEAR_BYTES), dtype=np.uint8)
+    if rows and len(car_ids):
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        days = np.frombuffer(b''.join(bytes(row[1]) for row in rows),
+                             dtype=np.uint8).reshape(len(rows), YEAR_BYTES)
+        positions = np.minimum(np.searchsorted(car_ids, ids), len(car_ids) - 1)
+        # Bitmaps of deleted cars are left out
+        found = car_ids[positions] == ids
+        packed[positions[found]] = days[found]
+    return np.unpackbits(packed, axis=1)[:, :year_length(year)].astype(bool)
+
+
+def utilization_report(db, year, limit=None):
+    '''Occupancy of the fleet over a year: per day for the calendar, and
+    per car for the limit least used cars (all of them by default)'''
+    car_ids = np.fromiter((row[0] for row in db.execute('SELECT id FROM car ORDER BY id')),
+                          dtype=np.int64)
+    booked = year_matrix(db, year, car_ids)
+    days = booked.shape[1]
+    per_day = booked.sum(axis=0)
+    per_car = booked.sum(axis=1)
+
+    fleet = len(car_ids)
+    shares = per_day / fleet if fleet else np.zeros(days)
+    first_day = date(year, 1, 1)
+    month_starts = [(date(year, month, 1) - first_day).days for month in range(1, 13)]
+    calendar = []
+    for month in range(1, 13):
+        start = month_starts[month - 1]
+        end = month_starts[month] if month < 12 else days
+        calendar.append({
+            'name': month_name[month],
+            'days': [{'date': first_day + timedelta(days=day), 'booked': int(per_day[day]),
+                      'share': float(shares[day])} for day in range(start, end)],
+        })
+
+    # Names and monthly figures only for the cars listed
+    order = np.argsort(per_car, kind='stable')[:limit]
+    per_month = np.add.reduceat(booked[order], month_starts, axis=1, dtype=np.int64)
+    if limit is None:
+        names = db.execute('SELECT id, name, model FROM car')
+    else:
+        chosen = car_ids[order].tolist()
+        names = db.execute('SELECT id, name, model FROM car'
+                           f" WHERE id IN ({', '.join('?' * len(chosen))})", chosen)
+    names = {row['id']: row for row in names}
+
+    saturated = current_app.config['OCCUPANCY_SATURATED']
+    busiest = int(per_day.argmax())
+    return {
+        'year': year,
+        'days': days,
+        'car_count': fleet,
+        'utilization': float(per_car.sum()) / (fleet * days) if fleet else 0.0,
+        'saturated': saturated,
+        'saturated_days': int((shares >= saturated).sum()) if fleet else 0,
+        'busiest_day': first_day + timedelta(days=busiest),
+        'busiest_booked': int(per_day[busiest]),
+        'idle_cars': int((per_car == 0).sum()),
+        'calendar': calendar,
+        'cars': [{
+            'id': car_id, 'name': names[car_id]['name'], 'model': names[car_id]['model'],
+            'booked_days': int(per_car[i]), 'utilization': float(per_car[i]) / days,
+            'months': months,
+        } for i, car_id, months in zip(order.tolist(), car_ids[order].tolist(),
+                                         per_month.tolist())],
+    }
+
+
+@click.command('rebuild-occupancy')
+def rebuild_occupancy_command():
+    """Recompute the occupancy bitmaps from the booking and booking_archive tables."""
+    started = time.perf_counter()
+    bitmaps = immediate_transaction(fill_occupancy)
+    click.echo(f'Rebuilt {bitmaps} occupancy bitmaps in {time.perf_counter() - started:.2f}s.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_occupancy_command)
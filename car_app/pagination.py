@@ -0,0 +1,94 @@
+'''
+Module: pagination
+Keyset (cursor) pagination for the admin listings and streamed CSV dumps.
+
+A page is fetched with WHERE (sort columns) > (values of the last row seen)
+instead of OFFSET, so every page costs one index range scan however deep
+into the table it is. The last sort column is always the unique id, which
+makes the order total and stable while rows are added.
+'''
+import base64
+import csv
+import io
+import json
+
+from flask import current_app, request, stream_template
+from werkzeug.exceptions import abort
+
+
+def encode_cursor(values):
+    data = json.dumps([str(value) if not isinstance(value, (int, float)) else value
+                       for value in values])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    '''Returns the sort values stored in a cursor, or None for the first page'''
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except ValueError:
+        abort(400, 'Invalid page cursor.')
+    if not isinstance(values, list):
+        abort(400, 'Invalid page cursor.')
+    return values
+
+
+def get_page_size():
+    '''Page size from ?per_page=, capped by MAX_PAGE_SIZE'''
+    size = request.args.get('per_page', type=int) or current_app.config['PAGE_SIZE']
+    return max(1, min(size, current_app.config['MAX_PAGE_SIZE']))
+
+
+def keyset_page(db, query, order_by, row_key, where=None, params=()):
+    '''Runs query (a SELECT ... FROM ... without WHERE or ORDER BY) for the
+    page after the ?after= cursor. order_by lists the ascending sort
+    columns, ending with the id; row_key(row) returns their values.
+    Returns (rows, cursor of the next page or None).'''
+    cursor = decode_cursor(request.args.get('after'))
+    limit = get_page_size()
+
+    conditions = [where] if where else []
+    args = list(params)
+    if cursor is not None:
+        if len(cursor) != len(order_by):
+            abort(400, 'Invalid page cursor.')
+        conditions.append(
+            f"({', '.join(order_by)}) > ({', '.join('?' * len(order_by))})")
+        args.extend(cursor)
+
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += f" ORDER BY {', '.join(order_by)} LIMIT ?"
+    # One extra row tells us whether there is a next page
+    rows = db.execute(query, args + [limit + 1]).fetchall()
+
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(row_key(rows[limit - 1]))
+    return rows, None
+
+
+def csv_row(values):
+    '''Jinja filter formatting one row as a CSV line'''
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='').writerow(
+        ['' if value is None else value for value in values])
+    return buffer.getvalue()
+
+
+def stream_csv(filename, header, rows):
+    '''Streams rows (any iterable, typically a live sqlite cursor) as a CSV
+    download. Nothing is fetched ahead, so memory stays flat whatever the
+    size of the table.'''
+    response = current_app.response_class(
+        stream_template('admin/export.csv', header=header, rows=rows),
+        mimetype='text/csv',
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+
+def init_app(app):
+    app.jinja_env.filters['csv_row'] = csv_row
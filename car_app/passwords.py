@@ -0,0 +1,76 @@
+'''
+Module: passwords
+Password hashing for the customer views.
+
+PASSWORD_METHOD and PASSWORD_SALT_LENGTH are passed straight to werkzeug's
+generate_password_hash, e.g. 'scrypt', 'scrypt:65536:8:1' or
+'pbkdf2:sha256:600000'. Hashes made with other parameters still verify and
+are replaced by one with the current parameters on the next login.
+
+With PASSWORD_HASH_WORKERS set, hashing runs in a pool of that many
+processes per worker. The pool caps how many cores a burst of logins can
+take, and threaded workers keep serving other requests while they wait.
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+_executor = None
+_executor_pid = None
+
+
+def get_executor():
+    '''The hashing pool of this process, None when hashing runs inline'''
+    global _executor, _executor_pid
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if not workers:
+        return None
+    # A pool inherited from a forking parent cannot be used
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def run(function, *args):
+    executor = get_executor()
+    if executor is None:
+        return function(*args)
+    return executor.submit(function, *args).result()
+
+
+def hash_password(password):
+    return run(generate_password_hash, password,
+               current_app.config['PASSWORD_METHOD'],
+               current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    return run(check_password_hash, password_hash, password)
+
+
+def current_method():
+    '''The method prefix hashes with the current settings start with, with
+    werkzeug's defaults filled in ('scrypt' becomes 'scrypt:32768:8:1')'''
+    method = current_app.config['PASSWORD_METHOD']
+    prefixes = current_app.extensions.setdefault('password_methods', {})
+    if method not in prefixes:
+        prefixes[method] = generate_password_hash('', method, 1).split('$', 1)[0]
+    return prefixes[method]
+
+
+def needs_rehash(password_hash):
+    '''True when password_hash was made with other parameters than the
+    current PASSWORD_METHOD'''
+    return password_hash.split('$', 1)[0] != current_method()
+
+
+def replacement_hash(password_hash, password):
+    '''The hash to store when a customer submits password over one stored
+    as password_hash: None when it is the same password and its hash is
+    current, so the row is left alone'''
+    if verify_password(password_hash, password) and not needs_rehash(password_hash):
+        return None
+    return hash_password(password)
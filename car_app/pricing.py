@@ -0,0 +1,163 @@
+'''
+Module: pricing
+Price quotes: what renting a car from one day to another, both included,
+costs.
+
+A car's daily base rate is the number its price starts with (see
+db.price_value). Every day of the range costs the base rate times the
+multipliers that apply to that day:
+
+  PRICING_WEEKEND_MULTIPLIER  on PRICING_WEEKEND_DAYS (Monday = 0)
+  PRICING_SEASONS             ('MM-DD', 'MM-DD', multiplier) per season, both
+                              days included; a season may run over new year
+                              and overlapping seasons multiply
+
+and the sum is reduced by the largest of PRICING_LENGTH_DISCOUNTS,
+(days, fraction off) pairs, whose number of days the rental reaches.
+
+None of the multipliers depend on the car, so a range comes down to one
+factor and quoting the whole fleet is a single multiplication of the
+array of base rates. That array is read once per pricing version: the
+triggers of pricing.sql bump pricing_version whenever a car is added,
+removed, repriced, listed or unlisted, and bookings leave it alone.
+Quotes are kept per (pricing version, range) in a per worker LRU cache of
+PRICING_CACHE_SIZE entries. Bookings store the quote they were made at in
+booking.total_price.
+'''
+import zlib
+
+import numpy as np
+from flask import current_app
+
+from car_app.cache import LRUCache
+from car_app.db import get_dialect, price_value
+
+
+def install_pricing(db):
+    '''Creates the pricing version and its triggers if they are missing.
+    On PostgreSQL they are part of schema_postgresql.sql.'''
+    if get_dialect() == 'postgresql':
+        return
+    with current_app.open_resource('pricing.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+
+
+def get_pricing_version(db):
+    return db.execute('SELECT version FROM pricing_version').fetchone()[0]
+
+
+def rules_key():
+    '''Short fingerprint of the configured rules, for cache keys that
+    outlive the worker process'''
+    config = current_app.config
+    rules = (config['PRICING_WEEKEND_DAYS'], config['PRICING_WEEKEND_MULTIPLIER'],
+             config['PRICING_SEASONS'], config['PRICING_LENGTH_DISCOUNTS'])
+    return f'{zlib.crc32(repr(rules).encode()):08x}'
+
+
+def month_day(text):
+    '''1215 for '12-15' '''
+    month, day = text.split('-')
+    return int(month) * 100 + int(day)
+
+
+def day_factors(start_date, end_date):
+    '''Multiplier of every day of the range, in order'''
+    config = current_app.config
+    days = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    factors = np.ones(len(days))
+
+    # Day 0, 1970-01-01, was a Thursday
+    weekdays = (days.astype(np.int64) + 3) % 7
+    factors[np.isin(weekdays, config['PRICING_WEEKEND_DAYS'])] *= (
+        config['PRICING_WEEKEND_MULTIPLIER'])
+
+    if config['PRICING_SEASONS']:
+        months = days.astype('datetime64[M]')
+        month_days = ((months.astype(np.int64) % 12 + 1) * 100
+                      + (days - months).astype(np.int64) + 1)
+        for first, last, multiplier in config['PRICING_SEASONS']:
+            first, last = month_day(first), month_day(last)
+            if first <= last:
+                inside = (month_days >= first) & (month_days <= last)
+            else:
+                inside = (month_days >= first) | (month_days <= last)
+            factors[inside] *= multiplier
+    return factors
+
+
+def length_discount(days):
+    '''Fraction taken off a rental of that many days'''
+    return max((fraction for least, fraction in current_app.config['PRICING_LENGTH_DISCOUNTS']
+                if days >= least), default=0.0)
+
+
+def range_factor(start_date, end_date):
+    '''What a daily base rate is multiplied by to quote the range'''
+    factors = day_factors(start_date, end_date)
+    return factors.sum() * (1 - length_discount(len(factors)))
+
+
+def quote_rates(rates, start_date, end_date):
+    '''Totals for an array of daily base rates, rounded to cents'''
+    return np.round(rates * range_factor(start_date, end_date), 2)
+
+
+def fleet_rates(db):
+    '''(pricing version, ids, base rates) of the listed cars, ids sorted.
+    Read again only when the pricing version moved.'''
+    version = get_pricing_version(db)
+    fleet = current_app.extensions.get('pricing_fleet')
+    if fleet is not None and fleet[0] == version:
+        return fleet
+
+    # Sorted here, ORDER BY id would sort the fleet in a temporary B-tree
+    rows = db.execute(
+        f"SELECT id, {price_value('price')} FROM car WHERE status = 1"
+    ).fetchall()
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    rates = np.fromiter((row[1] or 0.0 for row in rows), dtype=np.float64, count=len(rows))
+    order = np.argsort(ids, kind='stable')
+    fleet = current_app.extensions['pricing_fleet'] = (version, ids[order], rates[order])
+    return fleet
+
+
+def get_quote_cache():
+    extensions = current_app.extensions
+    if 'price_quotes' not in extensions:
+        extensions['price_quotes'] = LRUCache(current_app.config['PRICING_CACHE_SIZE'])
+    return extensions['price_quotes']
+
+
+def fleet_quotes(db, start_date, end_date):
+    '''(ids, totals) of every listed car for the range, cached per pricing
+    version and range'''
+    version, ids, rates = fleet_rates(db)
+    cache = get_quote_cache()
+    key = (version, start_date, end_date)
+    quotes = cache.get(key)
+    if quotes is None:
+        quotes = (ids, quote_rates(rates, start_date, end_date))
+        cache.set(key, quotes)
+    return quotes
+
+
+def quote_cars(db, car_ids, start_date, end_date):
+    '''{car id: total} for those of car_ids that are listed'''
+    ids, totals = fleet_quotes(db, start_date, end_date)
+    if not len(ids) or not car_ids:
+        return {}
+    wanted = np.asarray(car_ids, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(ids, wanted), len(ids) - 1)
+    found = ids[positions] == wanted
+    return dict(zip(wanted[found].tolist(), totals[positions[found]].tolist()))
+
+
+def quote_car(db, car_id, start_date, end_date):
+    '''Total for one car, listed or not, None when there is no such car.
+    Read from the car row, so it is current inside a write transaction.'''
+    row = db.execute(f"SELECT {price_value('price')} FROM car WHERE id = ?",
+                     (car_id,)).fetchone()
+    if row is None:
+        return None
+    return float(quote_rates(np.array([row[0] or 0.0]), start_date, end_date)[0])
@@ -0,0 +1,34 @@
+-- Pricing version for the price quotes, see pricing.py. The triggers below
+-- bump it whenever a car is added, removed, repriced, listed or unlisted,
+-- so each worker rereads the daily rates of the fleet only then, not after
+-- every booking the way it would with catalog_version.
+
+CREATE TABLE IF NOT EXISTS pricing_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO pricing_version (version)
+SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM pricing_version);
+
+-- Covers fleet_rates' read of the listed cars and their prices. With the
+-- expression index car_status_price alone, ANALYZE finding most cars
+-- listed makes SQLite scan the whole car table instead.
+CREATE INDEX IF NOT EXISTS car_status_rate ON car (status, price);
+
+CREATE TRIGGER IF NOT EXISTS car_pricing_insert AFTER INSERT ON car
+BEGIN
+  UPDATE pricing_version SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_pricing_delete AFTER DELETE ON car
+BEGIN
+  UPDATE pricing_version SET version = version + 1;
+END;
+
+-- car.update writes price and status on every save, edits of anything
+-- else leave the version alone
+CREATE TRIGGER IF NOT EXISTS car_pricing_update AFTER UPDATE OF price, status ON car
+WHEN OLD.price IS NOT NEW.price OR OLD.status IS NOT NEW.status
+BEGIN
+  UPDATE pricing_version SET version = version + 1;
+END;
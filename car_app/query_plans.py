@@ -0,0 +1,94 @@
+'''
+Module: query_plans
+Query plan audit for development and tests.
+
+With QUERY_PLAN_AUDIT on, every statement a hot endpoint runs through
+get_db() is first passed to EXPLAIN QUERY PLAN, and QueryPlanError is
+raised when SQLite would read a whole table or sort the rows in a
+temporary B-tree. Walking an index in order (SCAN ... USING INDEX) only
+passes in a statement with a LIMIT: that is how a page sorted by the
+index is read, without one it reads the whole index.
+
+    QUERY_PLAN_AUDIT = True       # in instance/config.py
+    python -m benchmarks.run --audit
+
+Tables that only ever hold a handful of rows are listed in
+QUERY_PLAN_SCAN_ALLOWED and may be scanned. A statement that ends with
+SORT_ALLOWED may sort: one whose rows are cut down by filters no single
+index can order, such as the catalog search. One that ends with FULL_DUMP
+is not audited at all: the CSV exports stream every row on purpose. Audit a database that has not
+been ANALYZEd, or one with production sized tables: statistics gathered
+on a few test rows tell SQLite that sorting them costs nothing.
+'''
+import sqlite3
+import threading
+
+from flask import current_app, request
+
+# Endpoints audited when QUERY_PLAN_AUDIT_ENDPOINTS is None
+HOT_ENDPOINTS = (
+    'car.guest_mode', 'car.available', 'car.index',
+    'booking.my_bookings', 'booking.create', 'booking.index',
+    'customer.login', 'customer.index', 'customer.admin_dashboard',
+    'uploaded_image',
+    'api.cars', 'api.available', 'api.car', 'api.bookings',
+)
+
+AUDITED_STATEMENTS = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')
+
+# Appended to a statement whose temporary B-tree sort is expected
+SORT_ALLOWED = ' /* sort allowed */'
+
+# Appended to a deliberate full table dump, such as a streamed CSV export
+FULL_DUMP = ' /* full dump */'
+
+# Statements whose plan already passed, per process
+_passed = set()
+_passed_lock = threading.Lock()
+
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+def plan_problems(plan, allowed_scans, limited=False, sort_allowed=False):
+    '''The lines of an EXPLAIN QUERY PLAN result that fail the audit'''
+    problems = []
+    for row in plan:
+        detail = row[3]
+        if detail.startswith('SCAN '):
+            words = detail.split()
+            if words[1] in allowed_scans or words[1] == 'CONSTANT' or 'VIRTUAL' in words:
+                continue
+            if limited and 'INDEX' in words:
+                continue
+            problems.append(detail)
+        elif detail.startswith('USE TEMP B-TREE') and 'ORDER BY' in detail and not sort_allowed:
+            problems.append(detail)
+    return problems
+
+
+def is_audited():
+    config = current_app.config
+    endpoints = config['QUERY_PLAN_AUDIT_ENDPOINTS'] or HOT_ENDPOINTS
+    return request.endpoint in endpoints
+
+
+def check_plan(db, sql, parameters):
+    '''Raises QueryPlanError when the plan of sql scans or sorts'''
+    if not sql.lstrip().upper().startswith(AUDITED_STATEMENTS) or sql.endswith(FULL_DUMP):
+        return
+    key = (current_app.config['DATABASE'], sql)
+    if key in _passed:
+        return
+
+    # Straight to sqlite3, so the EXPLAIN is neither timed nor audited
+    plan = sqlite3.Connection.execute(db, f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+    problems = plan_problems(plan, current_app.config['QUERY_PLAN_SCAN_ALLOWED'],
+                             limited=' LIMIT ' in sql.upper(),
+                             sort_allowed=sql.endswith(SORT_ALLOWED))
+    if problems:
+        raise QueryPlanError(
+            f"{request.endpoint}: {'; '.join(problems)} in: {' '.join(sql.split())}")
+    with _passed_lock:
+        _passed.add(key)
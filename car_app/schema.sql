@@ -8,10 +8,25 @@ CREATE TABLE car (
   seat INTEGER NOT NULL,
   door INTEGER NOT NULL,
   gearbox TEXT NOT NULL,
-  image BLOB NOT NULL,
-  price TEXT NOT NULL
+  image_type TEXT,
+  image_hash TEXT NOT NULL,
+  image_updated INTEGER,
+  price TEXT NOT NULL,
+  change_seq INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE INDEX car_name ON car (name);
+-- The API's changed_since sync walks cars in change_seq order
+CREATE INDEX car_change_seq ON car (change_seq, id);
+
+-- Deleted cars, so API clients syncing with changed_since can drop them
+CREATE TABLE car_tombstone (
+  car_id INTEGER PRIMARY KEY,
+  change_seq INTEGER NOT NULL
+);
+
+CREATE INDEX car_tombstone_change_seq ON car_tombstone (change_seq);
+
 CREATE TABLE customer (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   name TEXT NOT NULL,
@@ -19,15 +34,69 @@ CREATE TABLE customer (
   phone_number TEXT NOT NULL,
   email TEXT NOT NULL UNIQUE,
   password TEXT NOT NULL,
-  role TEXT INTEGER DEFAULT 0
+  role INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE INDEX customer_role_name ON customer (role, name);
+
 CREATE TABLE booking (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   customer_id INTEGER NOT NULL,
   car_id INTEGER NOT NULL,
-  start_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  end_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  start_date DATE NOT NULL,
+  end_date DATE NOT NULL,
+  -- Quote the booking was made at, see pricing.py. NULL for bookings made
+  -- before quotes were stored.
+  total_price REAL,
   FOREIGN KEY (customer_id) REFERENCES customer (id),
   FOREIGN KEY (car_id) REFERENCES car (id)
 );
+
+-- Availability lookups seek on car_id and skip every booking that ended
+-- before the requested start (see availability.py)
+CREATE INDEX booking_car_dates ON booking (car_id, end_date, start_date);
+CREATE INDEX booking_start_date ON booking (start_date);
+CREATE INDEX booking_end_date ON booking (end_date);
+-- A customer's bookings in date order, for my_bookings
+CREATE INDEX booking_customer_start ON booking (customer_id, start_date);
+
+-- Bookings that ended, moved here by the expired booking sweeper
+CREATE TABLE booking_archive (
+  id INTEGER PRIMARY KEY,
+  customer_id INTEGER NOT NULL,
+  car_id INTEGER NOT NULL,
+  start_date DATE NOT NULL,
+  end_date DATE NOT NULL,
+  total_price REAL,
+  archived_at TIMESTAMP NOT NULL
+);
+
+-- Archived bookings of a car over a date range, for occupancy.mark()
+CREATE INDEX booking_archive_car_dates ON booking_archive (car_id, end_date, start_date);
+
+-- Days each car is booked, a bit per day of the year (see occupancy.py).
+-- Kept by the booking views, archived bookings stay on it.
+CREATE TABLE occupancy (
+  year INTEGER NOT NULL,
+  car_id INTEGER NOT NULL,
+  days BLOB NOT NULL,
+  PRIMARY KEY (year, car_id)
+);
+
+CREATE TABLE car_image (
+  car_id INTEGER NOT NULL,
+  size TEXT NOT NULL,
+  content_type TEXT NOT NULL,
+  image_hash TEXT NOT NULL,
+  PRIMARY KEY (car_id, size),
+  FOREIGN KEY (car_id) REFERENCES car (id)
+);
+
+-- One row, bumped whenever something shown in the public catalog changes.
+-- Cached catalog fragments and API ETags are keyed by it (see cache.py),
+-- and cars record the version they were last changed at in change_seq.
+CREATE TABLE catalog_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO catalog_version (version) VALUES (0);
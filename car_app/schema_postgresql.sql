@@ -0,0 +1,271 @@
+-- The schema of schema.sql, stats.sql, search.sql, changes.sql and
+-- pricing.sql for PostgreSQL, used by init-db when DATABASE_URL points at
+-- a PostgreSQL server. Keep the five in step with this file: a table or
+-- column added there is added here too. Migrations are SQLite only, a PostgreSQL database is
+-- created at the newest schema.
+
+DROP TABLE IF EXISTS
+  car_image, booking_archive, occupancy, booking, customer, car_tombstone, car,
+  catalog_version, stats_counter, stats_car, stats_day, change_log,
+  pricing_version CASCADE;
+
+-- Prices are stored as text such as '645.8 Birr'. This reads the leading
+-- number the way SQLite's CAST(price AS REAL) does, 0 when there is none.
+CREATE OR REPLACE FUNCTION price_value(price TEXT) RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+  SELECT COALESCE(substring(
+    price FROM '^\s*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)'
+  )::DOUBLE PRECISION, 0)
+$$;
+
+CREATE TABLE car (
+  id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  name TEXT NOT NULL,
+  model TEXT NOT NULL,
+  status INTEGER NOT NULL,
+  seat INTEGER NOT NULL,
+  door INTEGER NOT NULL,
+  gearbox TEXT NOT NULL,
+  image_type TEXT,
+  image_hash TEXT NOT NULL,
+  image_updated BIGINT,
+  price TEXT NOT NULL,
+  change_seq INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX car_name ON car (name);
+CREATE INDEX car_change_seq ON car (change_seq, id);
+
+CREATE TABLE car_tombstone (
+  car_id INTEGER PRIMARY KEY,
+  change_seq INTEGER NOT NULL
+);
+
+CREATE INDEX car_tombstone_change_seq ON car_tombstone (change_seq);
+
+CREATE TABLE customer (
+  id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  name TEXT NOT NULL,
+  last_name TEXT NOT NULL,
+  phone_number TEXT NOT NULL,
+  email TEXT NOT NULL UNIQUE,
+  password TEXT NOT NULL,
+  role INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX customer_role_name ON customer (role, name);
+
+-- No foreign keys: SQLite does not enforce those of schema.sql, and
+-- deleting a car or customer leaves their bookings on both backends
+CREATE TABLE booking (
+  id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  customer_id INTEGER NOT NULL,
+  car_id INTEGER NOT NULL,
+  start_date DATE NOT NULL,
+  end_date DATE NOT NULL,
+  total_price DOUBLE PRECISION
+);
+
+CREATE INDEX booking_car_dates ON booking (car_id, end_date, start_date);
+CREATE INDEX booking_start_date ON booking (start_date);
+CREATE INDEX booking_end_date ON booking (end_date);
+CREATE INDEX booking_customer_start ON booking (customer_id, start_date);
+
+CREATE TABLE booking_archive (
+  id INTEGER PRIMARY KEY,
+  customer_id INTEGER NOT NULL,
+  car_id INTEGER NOT NULL,
+  start_date DATE NOT NULL,
+  end_date DATE NOT NULL,
+  total_price DOUBLE PRECISION,
+  archived_at TIMESTAMP NOT NULL
+);
+CREATE INDEX booking_archive_car_dates ON booking_archive (car_id, end_date, start_date);
+
+CREATE TABLE occupancy (
+  year INTEGER NOT NULL,
+  car_id INTEGER NOT NULL,
+  days BYTEA NOT NULL,
+  PRIMARY KEY (year, car_id)
+);
+
+CREATE TABLE car_image (
+  car_id INTEGER NOT NULL,
+  size TEXT NOT NULL,
+  content_type TEXT NOT NULL,
+  image_hash TEXT NOT NULL,
+  PRIMARY KEY (car_id, size)
+);
+
+CREATE TABLE catalog_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO catalog_version (version) VALUES (0);
+
+-- Dashboard statistics, see stats.sql
+
+CREATE TABLE stats_counter (
+  name TEXT PRIMARY KEY,
+  value DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+CREATE TABLE stats_car (
+  car_id INTEGER PRIMARY KEY,
+  bookings INTEGER NOT NULL DEFAULT 0,
+  booked_days INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX stats_car_bookings ON stats_car (bookings);
+
+CREATE TABLE stats_day (
+  day DATE PRIMARY KEY,
+  active_bookings INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO stats_counter (name, value)
+VALUES ('cars', 0), ('customers', 0), ('bookings', 0), ('revenue', 0);
+
+CREATE OR REPLACE FUNCTION car_stats() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    UPDATE stats_counter SET value = value + 1 WHERE name = 'cars';
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE stats_counter SET value = value - 1 WHERE name = 'cars';
+    UPDATE stats_counter
+    SET value = value - COALESCE(
+      (SELECT booked_days FROM stats_car WHERE car_id = OLD.id), 0
+    ) * price_value(OLD.price)
+    WHERE name = 'revenue';
+    DELETE FROM stats_car WHERE car_id = OLD.id;
+  ELSIF NEW.price IS DISTINCT FROM OLD.price THEN
+    UPDATE stats_counter
+    SET value = value + COALESCE(
+      (SELECT booked_days FROM stats_car WHERE car_id = NEW.id), 0
+    ) * (price_value(NEW.price) - price_value(OLD.price))
+    WHERE name = 'revenue';
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER car_stats AFTER INSERT OR DELETE OR UPDATE OF price ON car
+FOR EACH ROW EXECUTE FUNCTION car_stats();
+
+CREATE OR REPLACE FUNCTION customer_stats() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  UPDATE stats_counter
+  SET value = value + CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END
+  WHERE name = 'customers';
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER customer_stats AFTER INSERT OR DELETE ON customer
+FOR EACH ROW EXECUTE FUNCTION customer_stats();
+
+-- An update is the old booking taken away and the new one added. A
+-- booking the sweeper moved to booking_archive stays in the figures.
+CREATE OR REPLACE FUNCTION booking_stats() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  IF TG_OP = 'DELETE' AND EXISTS (SELECT 1 FROM booking_archive WHERE id = OLD.id) THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    UPDATE stats_counter
+    SET value = value - (OLD.end_date - OLD.start_date + 1)
+      * COALESCE((SELECT price_value(price) FROM car WHERE id = OLD.car_id), 0)
+    WHERE name = 'revenue';
+    UPDATE stats_car SET
+      bookings = bookings - 1,
+      booked_days = booked_days - (OLD.end_date - OLD.start_date + 1)
+    WHERE car_id = OLD.car_id;
+    UPDATE stats_day SET active_bookings = active_bookings - 1
+    WHERE day BETWEEN OLD.start_date AND OLD.end_date;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    UPDATE stats_counter
+    SET value = value + (NEW.end_date - NEW.start_date + 1)
+      * COALESCE((SELECT price_value(price) FROM car WHERE id = NEW.car_id), 0)
+    WHERE name = 'revenue';
+    INSERT INTO stats_car AS s (car_id, bookings, booked_days)
+    VALUES (NEW.car_id, 1, NEW.end_date - NEW.start_date + 1)
+    ON CONFLICT (car_id) DO UPDATE SET
+      bookings = s.bookings + 1,
+      booked_days = s.booked_days + excluded.booked_days;
+    INSERT INTO stats_day AS s (day, active_bookings)
+    SELECT day, 1 FROM generate_series(NEW.start_date, NEW.end_date, interval '1 day') AS day
+    ON CONFLICT (day) DO UPDATE SET active_bookings = s.active_bookings + 1;
+  END IF;
+  IF TG_OP <> 'UPDATE' THEN
+    UPDATE stats_counter
+    SET value = value + CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END
+    WHERE name = 'bookings';
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER booking_stats
+AFTER INSERT OR DELETE OR UPDATE OF car_id, start_date, end_date ON booking
+FOR EACH ROW EXECUTE FUNCTION booking_stats();
+
+-- Fleet search, see search.sql. The text index is an expression index;
+-- search.py matches on exactly this expression.
+CREATE INDEX car_search ON car
+USING gin (to_tsvector('simple', name || ' ' || model));
+
+CREATE INDEX car_status_gearbox_seat ON car (status, gearbox, seat, door);
+CREATE INDEX car_status_name ON car (status, name);
+CREATE INDEX car_status_price ON car (status, price_value(price));
+
+-- Change log for cache invalidation, see changes.sql. Sequence numbers are
+-- taken before commit, so they can commit out of order; invalidation.py
+-- rereads gaps for a while.
+CREATE TABLE change_log (
+  seq BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+  table_name TEXT NOT NULL,
+  row_id INTEGER NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION log_change() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  INSERT INTO change_log (table_name, row_id)
+  VALUES (TG_TABLE_NAME, CASE TG_OP WHEN 'DELETE' THEN OLD.id ELSE NEW.id END);
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER car_change AFTER INSERT OR UPDATE OR DELETE ON car
+FOR EACH ROW EXECUTE FUNCTION log_change();
+CREATE TRIGGER customer_change AFTER INSERT OR UPDATE OR DELETE ON customer
+FOR EACH ROW EXECUTE FUNCTION log_change();
+CREATE TRIGGER booking_change AFTER INSERT OR UPDATE OR DELETE ON booking
+FOR EACH ROW EXECUTE FUNCTION log_change();
+
+-- Pricing version for the price quotes, see pricing.sql
+CREATE TABLE pricing_version (
+  version INTEGER NOT NULL
+);
+
+INSERT INTO pricing_version (version) VALUES (0);
+
+CREATE OR REPLACE FUNCTION bump_pricing_version() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+  UPDATE pricing_version SET version = version + 1;
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER car_pricing AFTER INSERT OR DELETE ON car
+FOR EACH ROW EXECUTE FUNCTION bump_pricing_version();
+
+CREATE TRIGGER car_pricing_update AFTER UPDATE OF price, status ON car
+FOR EACH ROW
+WHEN (OLD.price IS DISTINCT FROM NEW.price OR OLD.status IS DISTINCT FROM NEW.status)
+EXECUTE FUNCTION bump_pricing_version();
@@ -0,0 +1,169 @@
+'''
+Module: search
+Text search and structured filters over the listed, available cars.
+
+Text goes through the car_search FTS5 index, the filters through the
+composite indexes in search.sql; both are combined with the same
+status = 1 and date range conditions the plain catalog uses. On
+PostgreSQL the text index is a tsvector expression index over the same
+two columns (see schema_postgresql.sql).
+'''
+import re
+import time
+
+import click
+from flask import current_app
+
+from car_app.availability import NOT_BOOKED
+from car_app.db import get_db, get_dialect, immediate_transaction, price_value
+from car_app.query_plans import SORT_ALLOWED
+
+# ?sort= value -> ORDER BY clause, {price} being the car's price_value()
+SORT_ORDERS = {
+    'relevance': 'hits.rank, car.name, car.id',
+    'name': 'car.name, car.id',
+    'price': '{price}, car.id',
+    'price_desc': '{price} DESC, car.id',
+}
+
+# The indexed document of a car on PostgreSQL, exactly as car_search
+# indexes it
+DOCUMENT = "to_tsvector('simple', name || ' ' || model)"
+
+# Query string arguments read by parse_filters and their types
+FILTERS = {
+    'q': str,
+    'gearbox': str,
+    'min_seats': int,
+    'doors': int,
+    'min_price': float,
+    'max_price': float,
+    'sort': str,
+}
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def install_search(db):
+    '''Creates the search index, its triggers and the filter indexes if
+    they are missing. On PostgreSQL they are part of schema_postgresql.sql.'''
+    if get_dialect() == 'postgresql':
+        return
+    with current_app.open_resource('search.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+
+
+def parse_filters(args):
+    '''Reads the search filters from a request's query string. Blank values
+    are left out; raises InvalidFilter for values of the wrong type.'''
+    filters = {}
+    for name, convert in FILTERS.items():
+        value = (args.get(name) or '').strip()
+        if not value:
+            continue
+        try:
+            filters[name] = convert(value)
+        except ValueError:
+            raise InvalidFilter(f'{name.replace("_", " ").capitalize()} must be a number.')
+    if filters.get('sort', 'relevance') not in SORT_ORDERS:
+        raise InvalidFilter('Unknown sort order.')
+    return filters
+
+
+def match_expression(text, dialect='sqlite'):
+    '''FTS5 query for text: every word must match, the last one as a prefix
+    so results show up while a word is still being typed ("toyota cor"
+    finds "Toyota Corolla"). Quoting the words keeps FTS5 syntax out.
+    The same query in to_tsquery syntax for PostgreSQL.'''
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    if dialect == 'postgresql':
+        return ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+    return ' '.join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+def text_matches(dialect, ranked):
+    '''Subquery of the cars matching a match_expression() parameter, their
+    ids as rowid and, when ranked, their rank (lower is better)'''
+    if dialect == 'postgresql':
+        rank = f', -ts_rank({DOCUMENT}, query) AS rank' if ranked else ''
+        return (f"SELECT id AS rowid{rank} FROM car, to_tsquery('simple', ?) AS query"
+                f' WHERE {DOCUMENT} @@ query')
+    return f"SELECT rowid{', rank' if ranked else ''} FROM car_search WHERE car_search MATCH ?"
+
+
+def search_cars(db, start_date, end_date, columns, filters, limit=None):
+    '''Listed cars free over the range that match filters (see
+    parse_filters). columns is the SELECT list, read from the car table.'''
+    dialect = get_dialect()
+    price = price_value('car.price')
+    joins = ''
+    conditions = ['car.status = 1', NOT_BOOKED]
+    params = []
+
+    match = match_expression(filters.get('q', ''), dialect)
+    sort = filters.get('sort', 'relevance')
+    if sort == 'relevance' and not match:
+        sort = 'name'
+    if match:
+        # bm25 costs as much as the rest of the query, only ask for it
+        # when the results are ordered by it
+        joins = (f' JOIN ({text_matches(dialect, ranked=sort == "relevance")})'
+                 ' AS hits ON hits.rowid = car.id')
+        params.append(match)
+    params += [start_date.isoformat(), end_date.isoformat()]
+
+    if 'gearbox' in filters:
+        conditions.append('car.gearbox = ?')
+        params.append(filters['gearbox'])
+    if 'min_seats' in filters:
+        conditions.append('car.seat >= ?')
+        params.append(filters['min_seats'])
+    if 'doors' in filters:
+        conditions.append('car.door = ?')
+        params.append(filters['doors'])
+    if 'min_price' in filters:
+        conditions.append(f'{price} >= ?')
+        params.append(filters['min_price'])
+    if 'max_price' in filters:
+        conditions.append(f'{price} <= ?')
+        params.append(filters['max_price'])
+
+    query = (f'SELECT {columns} FROM car{joins}'
+             f" WHERE {' AND '.join(conditions)}"
+             f' ORDER BY {SORT_ORDERS[sort].format(price=price)}')
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    if match or len(conditions) > 2:
+        # No index orders an arbitrary mix of filters, the matching
+        # cars are sorted after they are found
+        query += SORT_ALLOWED
+    return db.execute(query, params).fetchall()
+
+
+def gearbox_choices(db):
+    '''Distinct gearbox values of the listed cars, for the filter form'''
+    return [row[0] for row in db.execute(
+        'SELECT DISTINCT gearbox FROM car WHERE status = 1 ORDER BY gearbox')]
+
+
+@click.command('rebuild-search')
+def rebuild_search_command():
+    """Create the fleet search index if needed and rebuild it from the car table."""
+    db = get_db()
+    started = time.perf_counter()
+    if get_dialect() == 'postgresql':
+        db.execute('REINDEX INDEX car_search')
+    else:
+        install_search(db)
+        immediate_transaction(
+            lambda db: db.execute("INSERT INTO car_search (car_search) VALUES ('rebuild')"))
+    click.echo(f'Rebuilt the search index in {time.perf_counter() - started:.2f}s.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_search_command)
@@ -0,0 +1,37 @@
+-- Fleet search. car_search is a full text index over car.name and
+-- car.model that stores no copy of the text (content='car'); the triggers
+-- below keep it in step with the car table. `flask rebuild-search`
+-- recreates it from the car table.
+
+CREATE VIRTUAL TABLE IF NOT EXISTS car_search USING fts5 (
+  name, model,
+  content = 'car', content_rowid = 'id',
+  tokenize = 'unicode61 remove_diacritics 2',
+  prefix = '2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS car_search_insert AFTER INSERT ON car
+BEGIN
+  INSERT INTO car_search (rowid, name, model) VALUES (NEW.id, NEW.name, NEW.model);
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_search_delete AFTER DELETE ON car
+BEGIN
+  INSERT INTO car_search (car_search, rowid, name, model)
+  VALUES ('delete', OLD.id, OLD.name, OLD.model);
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_search_update AFTER UPDATE OF name, model ON car
+BEGIN
+  INSERT INTO car_search (car_search, rowid, name, model)
+  VALUES ('delete', OLD.id, OLD.name, OLD.model);
+  INSERT INTO car_search (rowid, name, model) VALUES (NEW.id, NEW.name, NEW.model);
+END;
+
+-- Structured filters. Prices are stored as text such as '645.8 Birr', so
+-- they are compared through CAST(price AS REAL), which reads the leading
+-- number; the queries in search.py use exactly this expression.
+CREATE INDEX IF NOT EXISTS car_status_gearbox_seat ON car (status, gearbox, seat, door);
+-- The unfiltered catalog, listed cars in name order
+CREATE INDEX IF NOT EXISTS car_status_name ON car (status, name);
+CREATE INDEX IF NOT EXISTS car_status_price ON car (status, CAST(price AS REAL));
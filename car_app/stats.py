@@ -0,0 +1,124 @@
+'''
+Module: stats
+Precomputed figures for the admin dashboard. The tables and the triggers
+that maintain them live in stats.sql. Bookings the sweeper archived are
+counted with the current ones.
+'''
+import time
+
+import click
+from flask import current_app
+
+from car_app.db import get_db, get_dialect, immediate_transaction, price_value
+
+# Every booking the figures count, current and archived
+ALL_BOOKINGS = ('(SELECT car_id, start_date, end_date FROM booking'
+                ' UNION ALL SELECT car_id, start_date, end_date FROM booking_archive)')
+
+
+def install_stats(db):
+    '''Creates the stats tables and triggers if they are missing. On
+    PostgreSQL they are part of schema_postgresql.sql.'''
+    if get_dialect() == 'postgresql':
+        return
+    with current_app.open_resource('stats.sql') as f:
+        db.executescript(f.read().decode('utf8'))
+
+
+def get_dashboard_stats(db, today, top_cars=10):
+    '''Every figure on the dashboard, read from the precomputed tables'''
+    counters = {row['name']: row['value'] for row in db.execute(
+        'SELECT name, value FROM stats_counter')}
+    active_row = db.execute(
+        'SELECT active_bookings FROM stats_day WHERE day = ?',
+        (today.isoformat(),)
+    ).fetchone()
+    active_today = active_row['active_bookings'] if active_row else 0
+    car_count = int(counters.get('cars', 0))
+
+    bookings_per_car = db.execute(
+        'SELECT c.id, c.name, c.model, s.bookings, s.booked_days'
+        ' FROM stats_car s JOIN car c ON c.id = s.car_id'
+        ' WHERE s.bookings > 0'
+        ' ORDER BY s.bookings DESC'
+        ' LIMIT ?',
+        (top_cars,)
+    ).fetchall()
+
+    return {
+        'car_count': car_count,
+        'customer_count': int(counters.get('customers', 0)),
+        'booking_count': int(counters.get('bookings', 0)),
+        'revenue': counters.get('revenue', 0),
+        'active_today': active_today,
+        'utilization': active_today / car_count if car_count else 0,
+        'bookings_per_car': bookings_per_car,
+    }
+
+
+def fill_stats(db):
+    '''Recomputes every stats table from the source tables, inside the
+    caller's transaction'''
+    postgresql = get_dialect() == 'postgresql'
+    db.execute('DELETE FROM stats_car')
+    db.execute('DELETE FROM stats_day')
+    booked_days = ('end_date - start_date + 1' if postgresql
+                   else 'julianday(end_date) - julianday(start_date) + 1')
+    db.execute(
+        'INSERT INTO stats_car (car_id, bookings, booked_days)'
+        f' SELECT car_id, COUNT(*), SUM({booked_days})'
+        f' FROM {ALL_BOOKINGS} AS b'
+        ' WHERE car_id IN (SELECT id FROM car)'
+        ' GROUP BY car_id'
+    )
+    if postgresql:
+        db.execute(
+            'INSERT INTO stats_day (day, active_bookings)'
+            ' SELECT day, COUNT(*)'
+            f' FROM {ALL_BOOKINGS} AS b,'
+            " generate_series(start_date, end_date, interval '1 day') AS day"
+            ' GROUP BY day'
+        )
+    else:
+        db.execute(
+            'INSERT INTO stats_day (day, active_bookings)'
+            ' WITH RECURSIVE days (day, end_date) AS ('
+            f'  SELECT start_date, end_date FROM {ALL_BOOKINGS}'
+            '  UNION ALL'
+            "  SELECT date(day, '+1 day'), end_date FROM days WHERE day < end_date"
+            ' )'
+            ' SELECT day, COUNT(*) FROM days GROUP BY day'
+        )
+    for name, query in (
+        ('cars', 'SELECT COUNT(*) FROM car'),
+        ('customers', 'SELECT COUNT(*) FROM customer'),
+        ('bookings', f'SELECT COUNT(*) FROM {ALL_BOOKINGS} AS b'),
+        ('revenue', f"SELECT COALESCE(SUM(s.booked_days * {price_value('c.price')}), 0)"
+                    ' FROM stats_car s JOIN car c ON c.id = s.car_id'),
+    ):
+        db.execute(
+            'INSERT INTO stats_counter (name, value)'
+            f' VALUES (?, ({query}))'
+            ' ON CONFLICT (name) DO UPDATE SET value = excluded.value',
+            (name,)
+        )
+
+
+def rebuild_stats():
+    '''Recomputes every stats table in one transaction; the triggers keep
+    them current from there on'''
+    immediate_transaction(fill_stats)
+
+
+@click.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the dashboard statistics from the source tables, archived bookings included."""
+    db = get_db()
+    started = time.perf_counter()
+    install_stats(db)
+    rebuild_stats()
+    click.echo(f'Rebuilt dashboard statistics in {time.perf_counter() - started:.2f}s.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_stats_command)
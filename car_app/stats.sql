@@ -0,0 +1,135 @@
+-- Dashboard statistics. The triggers below keep these tables current on
+-- every write to car, customer and booking, so the admin dashboard reads a
+-- handful of rows instead of scanning tables. `flask rebuild-stats`
+-- recomputes everything from scratch if they ever drift.
+--
+-- Archived bookings count as much as current ones: the sweeper copies a
+-- booking into booking_archive before deleting it, and a deleted booking
+-- that is already in the archive is left in the figures.
+
+CREATE TABLE IF NOT EXISTS stats_counter (
+  name TEXT PRIMARY KEY,
+  value REAL NOT NULL DEFAULT 0
+);
+
+-- Revenue is booked days times the car's current daily price
+CREATE TABLE IF NOT EXISTS stats_car (
+  car_id INTEGER PRIMARY KEY,
+  bookings INTEGER NOT NULL DEFAULT 0,
+  booked_days INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS stats_car_bookings ON stats_car (bookings);
+
+-- Number of bookings covering each day
+CREATE TABLE IF NOT EXISTS stats_day (
+  day DATE PRIMARY KEY,
+  active_bookings INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO stats_counter (name, value)
+VALUES ('cars', 0), ('customers', 0), ('bookings', 0), ('revenue', 0);
+
+CREATE TRIGGER IF NOT EXISTS car_stats_insert AFTER INSERT ON car
+BEGIN
+  UPDATE stats_counter SET value = value + 1 WHERE name = 'cars';
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_stats_delete AFTER DELETE ON car
+BEGIN
+  UPDATE stats_counter SET value = value - 1 WHERE name = 'cars';
+  UPDATE stats_counter
+  SET value = value - COALESCE(
+    (SELECT booked_days FROM stats_car WHERE car_id = OLD.id), 0
+  ) * CAST(OLD.price AS REAL)
+  WHERE name = 'revenue';
+  DELETE FROM stats_car WHERE car_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS car_stats_price AFTER UPDATE OF price ON car
+BEGIN
+  UPDATE stats_counter
+  SET value = value + COALESCE(
+    (SELECT booked_days FROM stats_car WHERE car_id = NEW.id), 0
+  ) * (CAST(NEW.price AS REAL) - CAST(OLD.price AS REAL))
+  WHERE name = 'revenue';
+END;
+
+CREATE TRIGGER IF NOT EXISTS customer_stats_insert AFTER INSERT ON customer
+BEGIN
+  UPDATE stats_counter SET value = value + 1 WHERE name = 'customers';
+END;
+
+CREATE TRIGGER IF NOT EXISTS customer_stats_delete AFTER DELETE ON customer
+BEGIN
+  UPDATE stats_counter SET value = value - 1 WHERE name = 'customers';
+END;
+
+CREATE TRIGGER IF NOT EXISTS booking_stats_insert AFTER INSERT ON booking
+BEGIN
+  UPDATE stats_counter SET value = value + 1 WHERE name = 'bookings';
+  UPDATE stats_counter
+  SET value = value + (julianday(NEW.end_date) - julianday(NEW.start_date) + 1)
+    * COALESCE((SELECT CAST(price AS REAL) FROM car WHERE id = NEW.car_id), 0)
+  WHERE name = 'revenue';
+  INSERT INTO stats_car (car_id, bookings, booked_days)
+  VALUES (NEW.car_id, 1, julianday(NEW.end_date) - julianday(NEW.start_date) + 1)
+  ON CONFLICT (car_id) DO UPDATE SET
+    bookings = bookings + 1,
+    booked_days = booked_days + excluded.booked_days;
+  INSERT INTO stats_day (day, active_bookings)
+  WITH RECURSIVE days (day) AS (
+    SELECT NEW.start_date
+    UNION ALL
+    SELECT date(day, '+1 day') FROM days WHERE day < NEW.end_date
+  )
+  SELECT day, 1 FROM days WHERE true
+  ON CONFLICT (day) DO UPDATE SET active_bookings = active_bookings + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS booking_stats_delete AFTER DELETE ON booking
+WHEN NOT EXISTS (SELECT 1 FROM booking_archive WHERE id = OLD.id)
+BEGIN
+  UPDATE stats_counter SET value = value - 1 WHERE name = 'bookings';
+  UPDATE stats_counter
+  SET value = value - (julianday(OLD.end_date) - julianday(OLD.start_date) + 1)
+    * COALESCE((SELECT CAST(price AS REAL) FROM car WHERE id = OLD.car_id), 0)
+  WHERE name = 'revenue';
+  UPDATE stats_car SET
+    bookings = bookings - 1,
+    booked_days = booked_days - (julianday(OLD.end_date) - julianday(OLD.start_date) + 1)
+  WHERE car_id = OLD.car_id;
+  UPDATE stats_day SET active_bookings = active_bookings - 1
+  WHERE day BETWEEN OLD.start_date AND OLD.end_date;
+END;
+
+CREATE TRIGGER IF NOT EXISTS booking_stats_update
+AFTER UPDATE OF car_id, start_date, end_date ON booking
+BEGIN
+  UPDATE stats_counter
+  SET value = value
+    - (julianday(OLD.end_date) - julianday(OLD.start_date) + 1)
+      * COALESCE((SELECT CAST(price AS REAL) FROM car WHERE id = OLD.car_id), 0)
+    + (julianday(NEW.end_date) - julianday(NEW.start_date) + 1)
+      * COALESCE((SELECT CAST(price AS REAL) FROM car WHERE id = NEW.car_id), 0)
+  WHERE name = 'revenue';
+  UPDATE stats_car SET
+    bookings = bookings - 1,
+    booked_days = booked_days - (julianday(OLD.end_date) - julianday(OLD.start_date) + 1)
+  WHERE car_id = OLD.car_id;
+  INSERT INTO stats_car (car_id, bookings, booked_days)
+  VALUES (NEW.car_id, 1, julianday(NEW.end_date) - julianday(NEW.start_date) + 1)
+  ON CONFLICT (car_id) DO UPDATE SET
+    bookings = bookings + 1,
+    booked_days = booked_days + excluded.booked_days;
+  UPDATE stats_day SET active_bookings = active_bookings - 1
+  WHERE day BETWEEN OLD.start_date AND OLD.end_date;
+  INSERT INTO stats_day (day, active_bookings)
+  WITH RECURSIVE days (day) AS (
+    SELECT NEW.start_date
+    UNION ALL
+    SELECT date(day, '+1 day') FROM days WHERE day < NEW.end_date
+  )
+  SELECT day, 1 FROM days WHERE true
+  ON CONFLICT (day) DO UPDATE SET active_bookings = active_bookings + 1;
+END;
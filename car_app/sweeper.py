@@ -0,0 +1,146 @@
+'''
+Module: sweeper
+Moves bookings that ended before today into booking_archive.
+
+Availability is worked out from the booking dates (see availability.py),
+so archiving an expired booking is all it takes to free its car. The
+dashboard figures and the occupancy bitmaps keep archived bookings. The
+work is set based and done in chunks, each chunk in its own short
+BEGIN IMMEDIATE transaction, so a large backlog never holds the write
+lock for long.
+'''
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+
+from car_app.cache import bump_catalog_version
+from car_app.db import get_db, immediate_transaction
+from car_app.invalidation import trim_change_log
+from car_app.shared_variables import get_today_date
+
+try:
+    import fcntl
+except ImportError:  # Windows, only used for local development
+    fcntl = None
+
+
+def sweep_chunk(db, today, chunk_size):
+    '''Archives up to chunk_size expired bookings and returns
+    (bookings archived, ids of the cars they belonged to)'''
+    db.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS sweep_batch'
+        ' (id INTEGER PRIMARY KEY, car_id INTEGER NOT NULL)'
+    )
+    db.execute('DELETE FROM sweep_batch')
+    db.execute(
+        'INSERT INTO sweep_batch (id, car_id)'
+        ' SELECT id, car_id FROM booking WHERE end_date < ? LIMIT ?',
+        (today.isoformat(), chunk_size)
+    )
+    archived = db.execute('SELECT COUNT(*) FROM sweep_batch').fetchone()[0]
+    if not archived:
+        return 0, set()
+
+    car_ids = {row[0] for row in db.execute('SELECT DISTINCT car_id FROM sweep_batch')}
+    db.execute(
+        'INSERT INTO booking_archive'
+        ' (id, customer_id, car_id, start_date, end_date, total_price, archived_at)'
+        ' SELECT id, customer_id, car_id, start_date, end_date, total_price, CURRENT_TIMESTAMP'
+        ' FROM booking WHERE id IN (SELECT id FROM sweep_batch)'
+    )
+    db.execute('DELETE FROM booking WHERE id IN (SELECT id FROM sweep_batch)')
+    bump_catalog_version(db)
+    return archived, car_ids
+
+
+def sweep_expired_bookings(today=None, chunk_size=None):
+    '''Archives every booking that ended before today.
+    Returns a report dict with rows, cars, chunks and seconds.'''
+    today = today or get_today_date()
+    chunk_size = chunk_size or current_app.config['SWEEPER_CHUNK_SIZE']
+    started = time.perf_counter()
+    report = {'rows': 0, 'chunks': 0}
+    freed = set()
+
+    while True:
+        archived, car_ids = immediate_transaction(
+            lambda db: sweep_chunk(db, today, chunk_size))
+        if not archived:
+            break
+        report['rows'] += archived
+        report['chunks'] += 1
+        freed |= car_ids
+        if archived < chunk_size:
+            break
+
+    report['cars'] = len(freed)
+    report['seconds'] = time.perf_counter() - started
+    return report
+
+
+def format_report(report):
+    return (f"Archived {report['rows']} expired bookings of {report['cars']} cars"
+            f" in {report['chunks']} chunks, {report['seconds']:.3f}s.")
+
+
+@click.command('sweep-bookings')
+@click.option('--chunk-size', type=int, default=None,
+              help='Bookings archived per transaction.')
+def sweep_bookings_command(chunk_size):
+    """Archive bookings that ended before today."""
+    click.echo(format_report(sweep_expired_bookings(chunk_size=chunk_size)))
+
+
+def acquire_sweeper_lock(app):
+    '''Takes an exclusive lock file so only one worker process on the host
+    runs the scheduled sweep. The lock is held until the process exits,
+    at which point the next worker to try takes over.'''
+    if fcntl is None:
+        return True
+    if getattr(app, '_sweeper_lock', None) is not None:
+        return True
+
+    lock_file = open(os.path.join(app.instance_path, 'sweeper.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    app._sweeper_lock = lock_file
+    return True
+
+
+def run_scheduler(app):
+    interval = app.config['SWEEPER_INTERVAL']
+    while True:
+        if acquire_sweeper_lock(app):
+            try:
+                with app.app_context():
+                    app.logger.info(format_report(sweep_expired_bookings()))
+                    # The change log needs trimming as often, see invalidation.py
+                    immediate_transaction(trim_change_log)
+            except Exception:
+                app.logger.exception('Expired booking sweep failed')
+        time.sleep(interval)
+
+
+def init_app(app):
+    app.cli.add_command(sweep_bookings_command)
+
+    started = threading.Lock()
+
+    # Started on the first request rather than in create_app, so CLI
+    # commands and a preloading gunicorn master never run the scheduler
+    @app.before_request
+    def start_scheduler():
+        if not app.config['SWEEPER_INTERVAL'] or getattr(app, '_sweeper_thread', None):
+            return
+        with started:
+            if getattr(app, '_sweeper_thread', None):
+                return
+            app._sweeper_thread = threading.Thread(
+                target=run_scheduler, args=(app,), name='booking-sweeper', daemon=True)
+            app._sweeper_thread.start()
@@ -0,0 +1,210 @@
+'''
+Module: writer
+Group commit of the writes of request handlers, for SQLite.
+
+With SQLITE_WRITE_COORDINATOR on, request handlers read through a
+query_only connection and immediate_transaction() hands their work to the
+writer thread of the worker process instead of running it. The writer
+takes the work queued so far, waits up to SQLITE_WRITE_BATCH_WINDOW
+seconds for more, up to SQLITE_WRITE_BATCH_SIZE units in all, and runs
+them in one BEGIN IMMEDIATE transaction: one trip through the write lock
+and one commit (one fsync under synchronous = FULL) per batch instead of
+per request. Each unit runs in its own savepoint, so a unit that raises is
+undone on its own and the request that submitted it gets the exception;
+the rest of the batch still commits. A request waits until its batch has
+committed.
+
+A request waits at most twice as long as one batch can take to get
+through a busy database (see wait_timeout()), or until the writer thread
+dies. It then fails with the same busy error as a locked database, which
+the views answer with 503; work the writer had not started by then is
+dropped, never committed behind the request's back.
+
+Work runs on the writer thread. It gets the writer's connection, which
+get_db() returns there too, and the app context, but no request context:
+it must not touch request, session or g. Slow steps such as hashing a
+password or storing an image belong before the submit.
+
+Each worker process has its own writer, so batching pays off with
+threaded workers; the writers of separate processes still take turns on
+the SQLite write lock as before. CLI commands and the sweeper thread,
+which run outside requests, keep writing directly.
+'''
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+from car_app.db import connect, run_immediate
+
+# Coordinators are created on first use, one per app and process
+_coordinators_lock = threading.Lock()
+
+# States of a WriteUnit
+QUEUED, CLAIMED, ABANDONED = 'queued', 'claimed', 'abandoned'
+
+
+class WriteUnit:
+    '''One submitted work function and, once done is set, its outcome'''
+
+    __slots__ = ('work', 'result', 'error', 'done', 'state')
+
+    def __init__(self, work):
+        self.work = work
+        self.result = self.error = None
+        self.done = threading.Event()
+        # Queued until the writer takes it or the request gives up on it
+        self.state = QUEUED
+
+
+def busy_error(message):
+    '''The error a locked database raises, so callers answer it alike'''
+    error = sqlite3.OperationalError(f'database is busy: {message}')
+    error.sqlite_errorcode = sqlite3.SQLITE_BUSY
+    return error
+
+
+def wait_timeout(config):
+    '''Seconds a request waits for its batch: the longest one batch can
+    spend retrying a busy database, for the batch ahead of it and its own'''
+    attempts = config['SQLITE_WRITE_ATTEMPTS']
+    batch = (attempts * config['SQLITE_BUSY_TIMEOUT'] / 1000
+             + config['SQLITE_WRITE_BACKOFF'] * 2 ** attempts
+             + config['SQLITE_WRITE_BATCH_WINDOW'])
+    return 2 * batch
+
+
+class WriteCoordinator:
+    '''Owns the writer thread of one app in one process'''
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.batches = self.units = 0
+        self.thread = threading.Thread(target=self.run, name='sqlite-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, work):
+        '''Queues work(db) and waits for its batch to commit. Returns what
+        work returned, or raises what it raised. Raises a busy error when
+        the writer does not get to it in time.'''
+        if not self.thread.is_alive():
+            raise busy_error('the writer thread is not running')
+        unit = WriteUnit(work)
+        self.queue.put(unit)
+        if not self.wait(unit):
+            with self.lock:
+                if unit.state == QUEUED:
+                    unit.state = ABANDONED
+            # A unit already running gets one more timeout to commit
+            if unit.state == ABANDONED or not self.wait(unit):
+                raise busy_error('timed out waiting for the writer thread')
+        if unit.error is not None:
+            raise unit.error
+        return unit.result
+
+    def wait(self, unit):
+        '''True once unit is done, False when the wait timed out or the
+        writer thread died'''
+        deadline = time.monotonic() + wait_timeout(self.app.config)
+        while not unit.done.wait(min(max(deadline - time.monotonic(), 0), 1.0)):
+            if time.monotonic() >= deadline or not self.thread.is_alive():
+                return False
+        return True
+
+    def claim(self, batch):
+        '''The units of batch whose requests are still waiting, taken'''
+        with self.lock:
+            batch = [unit for unit in batch if unit.state == QUEUED]
+            for unit in batch:
+                unit.state = CLAIMED
+        return batch
+
+    def collect(self):
+        '''Blocks for the next unit, then gathers the batch it starts'''
+        config = self.app.config
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + config['SQLITE_WRITE_BATCH_WINDOW']
+        while len(batch) < config['SQLITE_WRITE_BATCH_SIZE']:
+            remaining = deadline - time.monotonic()
+            try:
+                # Past the deadline this only takes what is already queued
+                batch.append(self.queue.get(remaining > 0, max(remaining, 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        with self.app.app_context():
+            db = None
+            while True:
+                batch = self.claim(self.collect())
+                if not batch:
+                    continue
+                try:
+                    if db is None:
+                        db = g.db = connect()
+                    run_immediate(db, lambda db: [apply(db, unit) for unit in batch])
+                    self.batches += 1
+                    self.units += len(batch)
+                except Exception as e:
+                    # Nothing of the batch was committed
+                    for unit in batch:
+                        unit.result, unit.error = None, e
+                    current_app.logger.exception('Write batch of %d units failed', len(batch))
+                    db = discard(db)
+                finally:
+                    for unit in batch:
+                        unit.done.set()
+
+    def stats(self):
+        return {'batches': self.batches, 'units': self.units}
+
+
+def apply(db, unit):
+    '''Runs one unit inside its own savepoint of the batch transaction'''
+    unit.result = unit.error = None
+    db.execute('SAVEPOINT write_unit')
+    try:
+        unit.result = unit.work(db)
+    except Exception as e:
+        db.execute('ROLLBACK TO write_unit')
+        unit.error = e
+    db.execute('RELEASE write_unit')
+
+
+def discard(db):
+    '''Closes a connection that may be broken; the next batch opens another'''
+    if db is not None:
+        try:
+            db.close()
+        except Exception:
+            pass
+    g.pop('db', None)
+    return None
+
+
+def get_coordinator():
+    '''The write coordinator of the current app in this process, started on
+    first use; a forked worker starts its own, and a writer thread that
+    died is replaced'''
+    app = current_app._get_current_object()
+    coordinator = app.extensions.get('write_coordinator')
+    if not usable(coordinator):
+        with _coordinators_lock:
+            coordinator = app.extensions.get('write_coordinator')
+            if not usable(coordinator):
+                if coordinator is not None and coordinator.pid == os.getpid():
+                    app.logger.error('The SQLite writer thread died, starting another')
+                coordinator = app.extensions['write_coordinator'] = WriteCoordinator(app)
+    return coordinator
+
+
+def usable(coordinator):
+    return (coordinator is not None and coordinator.pid == os.getpid()
+            and coordinator.thread.is_alive())
@@ -0,0 +1,121 @@
+'''
+A write made by one process reaches the caches of another through the
+change log (invalidation.sync) and the catalog version, with either
+catalog cache backend. The two processes share nothing but the database
+file, and the cache file for CATALOG_CACHE = 'sqlite'.
+'''
+import multiprocessing
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from car_app import create_app, invalidation
+from car_app.cache import bump_catalog_version, get_catalog_cache
+from car_app.db import get_db, immediate_transaction, init_db
+
+# Fresh interpreters, so no state is inherited from the test process
+context = multiprocessing.get_context('spawn')
+
+# Seconds to wait for the other process
+TIMEOUT = 60
+
+
+def make_app(directory, backend):
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'DATABASE': str(directory / 'db.sqlite'),
+        'METRICS_ENABLED': False,
+        'CUSTOMER_CACHE_TTL': 3600,
+        'CATALOG_CACHE': backend,
+        'CATALOG_CACHE_PATH': str(directory / 'cache.sqlite'),
+    })
+
+
+def catalog_shows(client, name):
+    page = client.get('/wheels_on_rent/car/guest_mode').get_data(as_text=True)
+    return f'>{name}</h5>' in page
+
+
+def reader(directory, backend, connection):
+    '''Caches customer 1 and the catalog, then reports what it sees after
+    the writer changed both'''
+    from car_app.customer import _customer_cache, get_cached_customer
+
+    app = make_app(directory, backend)
+    client = app.test_client()
+    key = (app.config['DATABASE'], 1)
+    with app.test_request_context():
+        get_cached_customer(1)
+    client.get('/wheels_on_rent/car/guest_mode')
+    with app.app_context():
+        cached_pages = get_catalog_cache().stats()['entries']
+    connection.send((key in _customer_cache, cached_pages))
+
+    connection.recv()
+    with app.test_request_context():
+        invalidation.sync()
+        evicted = key not in _customer_cache
+        name = get_cached_customer(1)['name']
+    connection.send((evicted, name, catalog_shows(client, 'Renamed car')))
+
+
+def writer(directory, backend, connection):
+    app = make_app(directory, backend)
+    connection.recv()
+    with app.test_request_context():
+        immediate_transaction(lambda db: db.execute(
+            "UPDATE customer SET name = 'Renamed' WHERE id = 1"))
+        immediate_transaction(lambda db: db.execute(
+            "UPDATE car SET name = 'Renamed car', change_seq = ? WHERE id = 1",
+            (bump_catalog_version(db),)))
+    connection.send('written')
+
+
+def receive(connection):
+    assert connection.poll(TIMEOUT), 'the other process did not answer'
+    return connection.recv()
+
+
+@pytest.mark.parametrize('backend', ['lru', 'sqlite'])
+def test_write_reaches_other_process(tmp_path, backend):
+    app = make_app(tmp_path, backend)
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.execute(
+            'INSERT INTO customer (name, last_name, phone_number, email, password)'
+            " VALUES ('Cached', 'Customer', '000', 'cached@example.com', ?)",
+            (generate_password_hash('test'),))
+        db.execute(
+            'INSERT INTO car (name, model, status, seat, door, gearbox, image_hash, price)'
+            " VALUES ('Cached car', 'Test', '1', 5, 4, 'Manual', '', '100')")
+        db.commit()
+
+    reading, reader_end = context.Pipe()
+    writing, writer_end = context.Pipe()
+    processes = [
+        context.Process(target=reader, args=(tmp_path, backend, reader_end)),
+        context.Process(target=writer, args=(tmp_path, backend, writer_end)),
+    ]
+    for process in processes:
+        process.start()
+    try:
+        customer_cached, cached_pages = receive(reading)
+        assert customer_cached
+        assert cached_pages >= 1
+
+        writing.send('write')
+        assert receive(writing) == 'written'
+
+        reading.send('check')
+        evicted, name, catalog_renamed = receive(reading)
+        assert evicted
+        assert name == 'Renamed'
+        assert catalog_renamed
+    finally:
+        for process in processes:
+            process.join(TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+    assert [process.exitcode for process in processes] == [0, 0]